@@ -72,6 +72,8 @@ setup(
     license = "BSD",
     zip_safe = False,
     install_requires = ["six", "future"],
+    extras_require = {"msgpack": ["msgpack>=0.5.2"],
+                      "opentelemetry": ["opentelemetry-api"]},
     classifiers = [
         "Programming Language :: Python",
         "Programming Language :: Python :: 2.6",
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.bench
+    ~~~~~~~~~~~
+
+    Provides a benchmark suite for the hot paths of Sijax - dispatching
+    calls, serializing responses, streaming, Comet fan-out and uploads.
+
+    Run it using::
+
+        python -m sijax.bench --output results.json
+
+    Results are saved as JSON, so that runs made on different commits
+    can be compared.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import fnmatch
+import io
+import math
+import platform
+import subprocess
+import sys
+import time
+from types import GeneratorType
+
+from ..helper import json
+from ..instrument import clock
+
+
+#: The version of the results file format
+RESULTS_FORMAT_VERSION = 1
+
+#: The modules that define the benchmarks (see :func:`benchmark`)
+SUITES = ('dispatch', 'serialization', 'streaming', 'comet', 'upload')
+
+_benchmarks = []
+
+
+class Benchmark(object):
+    """A benchmark, run once for every set of parameters.
+
+    The setup function is called with the parameters (as keyword
+    arguments) and returns the operation to time (a function without
+    arguments), or an (operation, info dictionary) tuple.
+    The info dictionary ends up in the results (sizes, ratios, etc.).
+
+    Setup functions that need to clean up may be generators, yielding
+    the operation once. They are resumed when the benchmark is done.
+    """
+
+    def __init__(self, name, setup, params=None, quick_params=None):
+        self.name = name
+        self.setup = setup
+        self.params = params or [{}]
+        self.quick_params = quick_params or self.params[:1]
+
+    @staticmethod
+    def get_id(name, params):
+        """Returns the id of a benchmark case (``name[key=value,...]``)."""
+        if not params:
+            return name
+        return '%s[%s]' % (name, ','.join('%s=%s' % item
+                                          for item in sorted(params.items())))
+
+
+def benchmark(name, params=None, quick_params=None):
+    """Registers the decorated setup function as a benchmark::
+
+        @benchmark('dispatch.process_request', params=[{'commands': 1},
+                                                       {'commands': 100}])
+        def bench_process_request(commands):
+            sijax_instance = ...
+            return sijax_instance.process_request
+
+    :param name: the (dotted) name of the benchmark
+    :param params: a list of parameter dictionaries, one per case
+    :param quick_params: the cases to run in quick mode
+                         (the first one only, by default)
+    """
+    def decorator(func):
+        _benchmarks.append(Benchmark(name, func, params, quick_params))
+        return func
+    return decorator
+
+
+def get_benchmarks():
+    """Returns all the benchmarks of the suite."""
+    for suite in SUITES:
+        __import__('%s.%s' % (__name__, suite))
+    return list(_benchmarks)
+
+
+def _time(operation, number):
+    started = clock()
+    for _ in range(number):
+        operation()
+    return clock() - started
+
+
+def _get_percentile(values, percent):
+    """Returns the percentile of the (sorted) values (nearest rank)."""
+    rank = int(math.ceil(len(values) * percent / 100.0))
+    return values[max(rank, 1) - 1]
+
+
+def measure(operation, repeat=5, min_time=0.1, latency_samples=100):
+    """Times the operation, returning a dictionary of statistics
+    (seconds per operation).
+
+    The number of operations per run is chosen so that a run takes
+    at least ``min_time`` seconds, and ``repeat`` runs are made.
+    The per-run timings are kept (as ``timings``), so that results
+    can be compared statistically (see :mod:`sijax.bench.baseline`).
+
+    The tail latency is measured by timing operations one by one,
+    in ``repeat`` rounds of up to ``latency_samples`` operations (or
+    about ``min_time`` seconds). The 99th percentile of each round is
+    kept (as ``p99_runs``), and ``p99`` is their median.
+    """
+    number = 1
+    while True:
+        elapsed = _time(operation, number)
+        if elapsed >= min_time or number >= 10 ** 7:
+            break
+        # Aim a bit higher than needed, to avoid another round
+        if elapsed <= 0:
+            number *= 10
+        else:
+            number = max(number + 1, int(number * min_time * 1.2 / elapsed))
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        timings.append(_time(operation, number) / number)
+
+    p99_runs = []
+    for _ in range(repeat):
+        latencies = []
+        started = clock()
+        while len(latencies) < latency_samples:
+            latencies.append(_time(operation, 1))
+            if len(latencies) >= 10 and clock() - started >= min_time:
+                break
+        p99_runs.append(_get_percentile(sorted(latencies), 99))
+
+    ordered = sorted(timings)
+    mean = sum(timings) / len(timings)
+    variance = sum((timing - mean) ** 2 for timing in timings) / len(timings)
+    median = ordered[len(ordered) // 2]
+    return {
+        'number': number,
+        'repeat': len(timings),
+        'timings': timings,
+        'min': ordered[0],
+        'median': median,
+        'mean': mean,
+        'stdev': math.sqrt(variance),
+        'ops_per_sec': 1.0 / median if median > 0 else None,
+        'p99_runs': p99_runs,
+        'p99': sorted(p99_runs)[len(p99_runs) // 2],
+    }
+
+
+def measure_memory(operation):
+    """Runs the operation once, under ``tracemalloc``, returning
+    the peak memory it used (``peak_bytes``) and the number of memory
+    blocks allocated by it and still alive when it returns, including
+    its result (``allocated_blocks``).
+
+    The operation should be run once before (caches warmed up, etc.),
+    to get the memory that every run needs.
+    """
+    import gc
+    import tracemalloc
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    gc.collect()
+    try:
+        before = tracemalloc.take_snapshot()
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Python 3.9+ (before that, the peak includes the snapshot)
+            tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        result = operation()
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+        del result
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    blocks = sum(stat.count_diff for stat in after.filter_traces(filters)
+                 .compare_to(before.filter_traces(filters), 'filename'))
+    return {'peak_bytes': max(peak - current, 0),
+            'allocated_blocks': max(blocks, 0)}
+
+
+def run_case(bench, params, repeat=5, min_time=0.1, memory=True):
+    """Runs a single case of a benchmark, returning its result.
+
+    :param memory: measure the memory used as well (see :func:`measure_memory`)
+    """
+    prepared = bench.setup(**params)
+    teardown = None
+    if isinstance(prepared, GeneratorType):
+        teardown, prepared = prepared, next(prepared)
+
+    info = {}
+    if isinstance(prepared, tuple):
+        prepared, info = prepared
+
+    try:
+        result = measure(prepared, repeat, min_time)
+        if memory:
+            result.update(measure_memory(prepared))
+    finally:
+        if teardown is not None:
+            for _ in teardown:
+                pass
+
+    result.update({'id': Benchmark.get_id(bench.name, params),
+                   'name': bench.name, 'params': params, 'info': info})
+    return result
+
+
+def run(patterns=None, quick=False, repeat=5, min_time=0.1, report=None,
+        memory=True):
+    """Runs the benchmarks (the cases whose ids match any of the given
+    shell-style patterns, or all of them), returning their results.
+
+    :param quick: run only a few cases of every benchmark
+    :param report: a function called with every result, as it's ready
+    :param memory: measure the memory used as well (see :func:`measure_memory`)
+    """
+    results = []
+    for bench in get_benchmarks():
+        for params in (bench.quick_params if quick else bench.params):
+            case_id = Benchmark.get_id(bench.name, params)
+            if patterns and not any(fnmatch.fnmatch(case_id, pattern)
+                                    for pattern in patterns):
+                continue
+            result = run_case(bench, params, repeat, min_time, memory)
+            if report is not None:
+                report(result)
+            results.append(result)
+    return results
+
+
+def _get_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+
+def get_fingerprint():
+    """Returns an id of the machine (and Python) that the benchmarks run on.
+
+    Results are only comparable when they have the same fingerprint.
+    """
+    import hashlib
+    import multiprocessing
+
+    machine = [platform.system(), platform.machine(), platform.processor(),
+               '%d' % multiprocessing.cpu_count(),
+               platform.python_implementation(),
+               '%d.%d' % sys.version_info[:2]]
+    return hashlib.sha1('|'.join(machine).encode('utf-8')).hexdigest()[:12]
+
+
+def get_environment():
+    """Describes the environment that the benchmarks run in."""
+    from .. import __version__
+
+    return {
+        'sijax': __version__,
+        'commit': _get_commit(),
+        'fingerprint': get_fingerprint(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+    }
+
+
+def save_results(results, path, environment=None):
+    """Saves the results (see :func:`run`) to a JSON file."""
+    data = {
+        'version': RESULTS_FORMAT_VERSION,
+        'environment': environment or get_environment(),
+        'results': results,
+    }
+    with io.open(path, 'w', encoding='utf-8') as fp:
+        fp.write(json.dumps(data, indent=2, sort_keys=True))
+
+
+def load_results(path):
+    """Loads results saved using :func:`save_results`."""
+    with io.open(path, encoding='utf-8') as fp:
+        return json.loads(fp.read())
+
+
+def format_result(result):
+    """Returns a line describing the result, for humans."""
+    median = result['median']
+    if median >= 1e-3:
+        timing = '%.3f ms' % (median * 1e3)
+    else:
+        timing = '%.3f us' % (median * 1e6)
+    line = '%-60s %14s' % (result['id'], timing)
+    if result.get('info'):
+        line += '  %s' % ', '.join('%s=%s' % item
+                                   for item in sorted(result['info'].items()))
+    return line
+
+
+def main(argv=None):
+    """The command line interface (``python -m sijax.bench``)."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m sijax.bench',
+                                     description='Runs the Sijax benchmarks.')
+    parser.add_argument('patterns', nargs='*', metavar='PATTERN',
+                        help='run only the cases matching these '
+                             '(shell-style) patterns')
+    parser.add_argument('-o', '--output', help='save the results to this JSON file')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='run only a few cases, quickly')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='how many times to run every case')
+    parser.add_argument('-t', '--min-time', type=float, default=0.1,
+                        help='the minimum duration of a run, in seconds')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the cases, without running them')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="don't measure the memory used")
+    parser.add_argument('--baseline-dir', default='.benchmarks',
+                        help='the directory to keep baselines in '
+                             '(one per machine fingerprint)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="save the results as this machine's baseline")
+    parser.add_argument('--check', action='store_true',
+                        help="compare the results to this machine's baseline, "
+                             'failing if anything regressed')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='like --check, but against the given results file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='how much worse a metric may get, before it counts '
+                             'as a regression (default: 0.1, which is 10%%)')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='the confidence needed to report a slowdown')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show all the changes, not only the regressions')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.repeat = min(args.repeat, 3)
+        args.min_time = min(args.min_time, 0.02)
+
+    if args.list:
+        for bench in get_benchmarks():
+            for params in (bench.quick_params if args.quick else bench.params):
+                print(Benchmark.get_id(bench.name, params))
+        return 0
+
+    from . import baseline as baselines
+
+    reference = None
+    if args.compare:
+        reference = load_results(args.compare)
+    elif args.check:
+        reference = baselines.load_baseline(args.baseline_dir)
+        if reference is None:
+            print('No baseline for this machine (%s), save one using '
+                  '--save-baseline' % get_fingerprint())
+            return 2
+
+    def report(result):
+        print(format_result(result))
+        sys.stdout.flush()
+
+    results = run(args.patterns, args.quick, args.repeat, args.min_time, report,
+                  args.memory)
+    if args.output:
+        save_results(results, args.output)
+    if args.save_baseline:
+        path = baselines.save_baseline(results, args.baseline_dir)
+        print('Saved the baseline to %s' % path)
+
+    if reference is None:
+        return 0
+    changes = baselines.compare_results(reference, {'results': results},
+                                        args.threshold, args.confidence)
+    regressions = [change for change in changes if change.is_regression]
+    diff = baselines.format_changes(changes, args.verbose)
+    print('')
+    print('Compared %d metrics to the baseline (positive changes are worse).'
+          % len(changes))
+    if diff:
+        print(diff)
+    if regressions:
+        print('%d regression(s) found.' % len(regressions))
+        return 1
+    print('No regressions found.')
+    return 0
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+import sys
+
+from sijax.bench import main
+
+
+sys.exit(main())
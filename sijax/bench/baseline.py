@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.bench.baseline
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Stores baseline benchmark results (per machine fingerprint)
+    and compares new results against them, to catch regressions::
+
+        python -m sijax.bench --save-baseline
+        # after some changes
+        python -m sijax.bench --check
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import math
+import os
+
+from . import (get_fingerprint, save_results, load_results)
+
+
+#: The directory that baselines are stored in, by default
+DEFAULT_DIRECTORY = '.benchmarks'
+
+#: The tracked metrics, whether higher values are better, and the
+#: per-run samples that they're compared statistically with (if any)
+METRICS = (
+    ('ops_per_sec', True, 'timings'),
+    ('p99', False, 'p99_runs'),
+    ('peak_bytes', False, None),
+    ('allocated_blocks', False, None),
+)
+
+
+def get_baseline_path(directory=DEFAULT_DIRECTORY, fingerprint=None):
+    """Returns the path of the baseline for the given machine fingerprint
+    (this machine's, if None)."""
+    if fingerprint is None:
+        fingerprint = get_fingerprint()
+    return os.path.join(directory, '%s.json' % fingerprint)
+
+
+def save_baseline(results, directory=DEFAULT_DIRECTORY):
+    """Saves the results as the baseline of this machine,
+    returning the path of the baseline file."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = get_baseline_path(directory)
+    save_results(results, path)
+    return path
+
+
+def load_baseline(directory=DEFAULT_DIRECTORY):
+    """Loads the baseline of this machine (None if there's none)."""
+    path = get_baseline_path(directory)
+    if not os.path.exists(path):
+        return None
+    return load_results(path)
+
+
+def _get_ranks(values):
+    """Returns the ranks of the values (1-based, ties get their average rank)."""
+    ordered = sorted(range(len(values)), key=lambda idx: values[idx])
+    ranks = [0.0] * len(values)
+    start = 0
+    while start < len(ordered):
+        end = start
+        while (end + 1 < len(ordered)
+               and values[ordered[end + 1]] == values[ordered[start]]):
+            end += 1
+        for idx in ordered[start:end + 1]:
+            ranks[idx] = (start + end) / 2.0 + 1
+        start = end + 1
+    return ranks
+
+
+def get_slowdown_p_value(baseline_timings, timings):
+    """Returns the (one-sided) p-value of the timings not being slower
+    (higher) than the baseline timings, using the Mann-Whitney U test
+    (with the normal approximation).
+
+    Small values mean that the timings are slower with confidence.
+    """
+    n, m = len(timings), len(baseline_timings)
+    if not n or not m:
+        return 1.0
+    ranks = _get_ranks(list(timings) + list(baseline_timings))
+    u = sum(ranks[:n]) - n * (n + 1) / 2.0
+    mean = n * m / 2.0
+    sigma = math.sqrt(n * m * (n + m + 1) / 12.0)
+    z = (u - mean) / sigma
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+class Change(object):
+    """The change of a metric of a benchmark case,
+    between the baseline and the current results."""
+
+    def __init__(self, case_id, metric, baseline, current, higher_is_better,
+                 p_value=None, is_regression=False):
+        self.case_id = case_id
+        self.metric = metric
+        self.baseline = baseline
+        self.current = current
+        self.higher_is_better = higher_is_better
+
+        #: The p-value of the slowdown, for metrics compared statistically
+        self.p_value = p_value
+        self.is_regression = is_regression
+
+    @property
+    def ratio(self):
+        """How much worse (positive) or better (negative) the metric got,
+        relative to the baseline (0.1 means 10% worse)."""
+        if not self.baseline:
+            return 0.0
+        ratio = (self.current - self.baseline) / float(self.baseline)
+        return -ratio if self.higher_is_better else ratio
+
+    def __repr__(self):
+        return '<Change %s %s %+.1f%%>' % (self.case_id, self.metric,
+                                           self.ratio * 100)
+
+
+def compare_results(baseline, current, threshold=0.1, confidence=0.95,
+                    min_bytes=1024, min_blocks=10):
+    """Compares the current results against the baseline ones
+    (as loaded using :func:`sijax.bench.load_results`), returning
+    a :class:`Change` for every metric of the cases in both.
+
+    A metric regresses when it gets worse by more than ``threshold``
+    (0.1 is 10%) and:
+
+    - for throughput (``ops_per_sec``) and tail latency (``p99``) - when
+      the per-run timings (or per-run latencies) are slower with the given
+      ``confidence`` (see :func:`get_slowdown_p_value`)
+    - for memory (``peak_bytes``, ``allocated_blocks``) - when it grows by
+      at least ``min_bytes`` or ``min_blocks`` (small allocations vary a bit)
+    """
+    baseline_results = dict((result['id'], result)
+                            for result in baseline['results'])
+    changes = []
+    for result in current['results']:
+        old = baseline_results.get(result['id'])
+        if old is None:
+            continue
+        for metric, higher_is_better, samples in METRICS:
+            if old.get(metric) is None or result.get(metric) is None:
+                continue
+            change = Change(result['id'], metric, old[metric], result[metric],
+                            higher_is_better)
+            is_worse = change.ratio > threshold
+            if samples is not None:
+                change.p_value = get_slowdown_p_value(old.get(samples, ()),
+                                                      result.get(samples, ()))
+                is_worse = is_worse and change.p_value < 1 - confidence
+            elif metric == 'peak_bytes':
+                is_worse = is_worse and change.current - change.baseline >= min_bytes
+            elif metric == 'allocated_blocks':
+                is_worse = is_worse and change.current - change.baseline >= min_blocks
+            change.is_regression = is_worse
+            changes.append(change)
+    return changes
+
+
+def _format_value(metric, value):
+    if metric == 'ops_per_sec':
+        return '%.1f/s' % value
+    if metric == 'p99':
+        return '%.3f us' % (value * 1e6)
+    return '%d' % value
+
+
+def format_changes(changes, verbose=False):
+    """Returns a readable diff of the changes (only the regressions,
+    unless ``verbose``)."""
+    lines = []
+    for change in changes:
+        if not (verbose or change.is_regression):
+            continue
+        line = '%-60s %-16s %14s -> %-14s %+7.1f%%' % (
+            change.case_id, change.metric,
+            _format_value(change.metric, change.baseline),
+            _format_value(change.metric, change.current),
+            change.ratio * 100)
+        if change.p_value is not None:
+            line += '  p=%.3f' % change.p_value
+        if change.is_regression:
+            line += '  REGRESSION'
+        lines.append(line)
+    return '\n'.join(lines)
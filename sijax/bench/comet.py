@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.bench.comet
+    ~~~~~~~~~~~~~~~~~
+
+    Benchmarks the Comet hub (fan-out to many subscribers)
+    and the latency and throughput of its broadcast backends,
+    across processes.
+
+    The Redis cases run only when ``SIJAX_BENCH_REDIS_URL`` is set
+    (to the URL of a Redis server to use, like ``redis://localhost``),
+    and the ``redis`` library is installed.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from six.moves import queue
+
+from ..core import Sijax
+from ..plugin.comet import (CometResponse, Hub, Message, RedisBackend,
+                            UnixSocketBackend)
+from . import (benchmark, _get_percentile)
+
+
+#: The Redis server to run the Redis cases against (if any)
+REDIS_URL = os.environ.get('SIJAX_BENCH_REDIS_URL')
+
+#: How long to wait for messages to be delivered, in seconds
+DELIVERY_TIMEOUT = 5
+
+#: How many messages are published to measure the throughput
+BURST_SIZE = 200
+
+#: How many of them may be in flight at once (few enough to fit
+#: in the socket queues of the receivers - see ``net.unix.max_dgram_qlen``)
+BURST_WINDOW = 8
+
+
+def _get_backend_params(**params):
+    """Returns a case for every available backend, with the given params."""
+    backends = ['unix_socket']
+    if REDIS_URL is not None:
+        try:
+            __import__('redis')
+        except ImportError:
+            pass
+        else:
+            backends.append('redis')
+    return [dict(params, backend=backend) for backend in backends]
+
+
+def _create_backend(backend, directory):
+    if backend == 'redis':
+        import redis
+
+        return RedisBackend(redis.Redis.from_url(REDIS_URL),
+                            prefix='sijax-bench:')
+    return UnixSocketBackend(directory)
+
+
+def _create_message(selector, sequence):
+    message = Message()
+    message.html(selector, '%d:%r' % (sequence, time.time()))
+    return message
+
+
+def _run_subscriber(backend, directory, ready, acks, results):
+    """Runs in a subscriber process: acknowledges every message
+    once it's been pushed to (and drained from) a Comet response,
+    and reports the publish-to-flush latencies when told to stop."""
+    hub = Hub(queue_size=BURST_SIZE * 2,
+              backend=_create_backend(backend, directory))
+    response = CometResponse(Sijax(), [])
+    subscription = hub.subscribe('channel', response)
+    ready.put(os.getpid())
+    latencies = []
+    try:
+        while True:
+            subscription._wait(DELIVERY_TIMEOUT)
+            with subscription._condition:
+                commands = [message._commands[0]
+                            for message in subscription._queue]
+            subscription._push_pending()
+            for _ in response._drain():
+                pass
+            flushed = time.time()
+            for command in commands:
+                if command['selector'] == '#stop':
+                    results.put(latencies)
+                    return
+                sequence, published = command['html'].split(':')
+                if command['selector'] == '#price':
+                    latencies.append(flushed - float(published))
+                acks.put(int(sequence))
+    finally:
+        subscription.close()
+        hub.backend.close()
+
+
+@benchmark('comet.fanout',
+           params=[{'subscribers': 10}, {'subscribers': 1000},
+                   {'subscribers': 10000}])
+def bench_fanout(subscribers):
+    """Publishes a message and sends it to all the subscribers."""
+    hub = Hub()
+    sijax_instance = Sijax()
+    subscriptions = []
+    for _ in range(subscribers):
+        response = CometResponse(sijax_instance, [])
+        # Get the padding out of the way
+        response.alert('subscribed')
+        response._flush()
+        subscriptions.append(hub.subscribe('channel', response))
+
+    def publish():
+        message = Message()
+        message.html('#price', '10.50')
+        hub.publish('channel', message)
+        for subscription in subscriptions:
+            subscription._push_pending()
+            for _ in subscription._obj_response._drain():
+                pass
+    return publish
+
+
+@benchmark('comet.backend_latency', params=[{'backend': 'unix_socket'}])
+def bench_backend_latency(backend):
+    """Publishes a message in one hub and waits for another one
+    (with its own backend) to deliver it."""
+    directory = tempfile.mkdtemp()
+    publisher = Hub(backend=UnixSocketBackend(directory))
+    receiver = Hub(backend=UnixSocketBackend(directory))
+    response = CometResponse(Sijax(), [])
+    subscription = receiver.subscribe('channel', response)
+
+    def round_trip():
+        message = Message()
+        message.html('#price', '10.50')
+        publisher.publish('channel', message)
+        subscription._wait(1)
+        if not subscription._push_pending():
+            raise RuntimeError('The message was not delivered in time')
+        for _ in response._drain():
+            pass
+
+    try:
+        yield round_trip
+    finally:
+        subscription.close()
+        publisher.backend.close()
+        receiver.backend.close()
+        shutil.rmtree(directory)
+
+
+@benchmark('comet.backend_processes',
+           params=_get_backend_params(processes=8))
+def bench_backend_processes(backend, processes):
+    """Publishes a message and waits until every subscriber process
+    (each with its own hub and backend) has flushed it.
+
+    The info of the result has the publish-to-flush latency
+    percentiles (in seconds), and the throughput of a burst of messages
+    (``messages_per_sec`` published, ``deliveries_per_sec`` flushed
+    by all the subscribers together, and how many deliveries the
+    backend ``dropped``, because a subscriber wasn't keeping up).
+    """
+    directory = tempfile.mkdtemp()
+    ready, acks, results = (multiprocessing.Queue(), multiprocessing.Queue(),
+                            multiprocessing.Queue())
+    workers = [multiprocessing.Process(target=_run_subscriber,
+                                       args=(backend, directory, ready, acks,
+                                             results))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    publisher = None
+    info = {}
+    try:
+        for _ in workers:
+            ready.get(timeout=DELIVERY_TIMEOUT * 2)
+        publisher = Hub(backend=_create_backend(backend, directory))
+        if backend == 'redis':
+            # Subscribing happens in a thread, after the hub is created
+            time.sleep(0.5)
+        counter = [0]
+
+        def wait_for_acks(count):
+            deadline = time.time() + DELIVERY_TIMEOUT
+            for _ in range(count):
+                try:
+                    acks.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    raise RuntimeError('The message was not delivered in time')
+
+        def round_trip():
+            counter[0] += 1
+            publisher.publish('channel', _create_message('#price', counter[0]))
+            wait_for_acks(processes)
+
+        yield round_trip, info
+
+        dropped = getattr(publisher.backend, 'dropped_count', 0)
+        started = time.time()
+        for _ in range(0, BURST_SIZE, BURST_WINDOW):
+            dropped_before = getattr(publisher.backend, 'dropped_count', 0)
+            for _ in range(BURST_WINDOW):
+                counter[0] += 1
+                publisher.publish('channel', _create_message('#burst', counter[0]))
+            wait_for_acks(BURST_WINDOW * processes - (
+                getattr(publisher.backend, 'dropped_count', 0) - dropped_before))
+        elapsed = time.time() - started
+        dropped = getattr(publisher.backend, 'dropped_count', 0) - dropped
+
+        publisher.publish('channel', _create_message('#stop', 0))
+        latencies = []
+        for _ in workers:
+            latencies.extend(results.get(timeout=DELIVERY_TIMEOUT))
+        latencies.sort()
+        info.update({
+            'latency_p50': _get_percentile(latencies, 50),
+            'latency_p99': _get_percentile(latencies, 99),
+            'latency_max': latencies[-1],
+            'messages_per_sec': BURST_SIZE / elapsed,
+            'deliveries_per_sec': (BURST_SIZE * processes - dropped) / elapsed,
+            'dropped': dropped,
+        })
+    finally:
+        for worker in workers:
+            worker.join(DELIVERY_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+        if publisher is not None:
+            publisher.backend.close()
+        shutil.rmtree(directory)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.bench.dispatch
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks function registration and request dispatching.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+from ..core import Sijax
+from . import benchmark
+
+
+def _handler(obj_response, *args):
+    pass
+
+
+def _make_request(sijax_instance, function_name, args='[]'):
+    cls = sijax_instance.__class__
+    data = {cls.PARAM_REQUEST: function_name, cls.PARAM_ARGS: args}
+
+    def request():
+        sijax_instance.set_data(data)
+        return sijax_instance.process_request()
+    return request
+
+
+@benchmark('dispatch.process_request',
+           params=[{'commands': 1}, {'commands': 10}, {'commands': 100}])
+def bench_process_request(commands):
+    def handler(obj_response, name):
+        for idx in range(commands):
+            obj_response.html('#item-%d' % idx, name)
+
+    sijax_instance = Sijax()
+    sijax_instance.register_callback('handler', handler)
+    return _make_request(sijax_instance, 'handler', '["value"]')
+
+
+@benchmark('dispatch.invalid_request')
+def bench_invalid_request():
+    return _make_request(Sijax(), 'missing')
+
+
+@benchmark('dispatch.observed',
+           params=[{'observer': 'none'}, {'observer': 'histogram'},
+                   {'observer': 'metrics'}, {'observer': 'tracing'}],
+           quick_params=[{'observer': 'none'}, {'observer': 'metrics'}])
+def bench_observed(observer):
+    from ..instrument import HistogramAggregator
+    from ..metrics import MetricsRegistry
+    from ..tracing import (InMemoryTracer, install_tracing)
+
+    def handler(obj_response, name):
+        obj_response.alert(name)
+
+    sijax_instance = Sijax()
+    sijax_instance.register_callback('handler', handler)
+    if observer == 'histogram':
+        sijax_instance.add_observer(HistogramAggregator())
+    elif observer == 'metrics':
+        MetricsRegistry().track(sijax_instance)
+    elif observer == 'tracing':
+        install_tracing(sijax_instance, InMemoryTracer(max_spans=100))
+    return _make_request(sijax_instance, 'handler', '["value"]')
+
+
+_SIZES = [{'functions': 10}, {'functions': 100}, {'functions': 1000},
+          {'functions': 10000}]
+
+
+@benchmark('dispatch.register_callback', params=_SIZES)
+def bench_register_callback(functions):
+    names = ['function_%d' % idx for idx in range(functions)]
+
+    def register():
+        sijax_instance = Sijax()
+        for name in names:
+            sijax_instance.register_callback(name, _handler)
+    return register
+
+
+@benchmark('dispatch.register_object', params=_SIZES)
+def bench_register_object(functions):
+    attributes = dict(('function_%d' % idx, staticmethod(_handler))
+                      for idx in range(functions))
+    handlers = type(str('Handlers'), (object, ), attributes)
+
+    def register():
+        Sijax().register_object(handlers)
+    return register
+
+
+@benchmark('dispatch.lookup', params=_SIZES, quick_params=_SIZES[-1:])
+def bench_lookup(functions):
+    sijax_instance = Sijax()
+    for idx in range(functions):
+        sijax_instance.register_callback('function_%d' % idx, _handler)
+    return _make_request(sijax_instance, 'function_%d' % (functions // 2))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.bench.serialization
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks serializing responses (formats and codecs),
+    decoding call arguments and compressing responses.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+from ..core import Sijax
+from ..response import BaseResponse
+from . import benchmark
+
+
+def _make_response(commands, html_size, data=None):
+    sijax_instance = Sijax()
+    sijax_instance.set_data(data or {})
+    response = BaseResponse(sijax_instance, [])
+    html = 'x' * html_size
+    for idx in range(commands):
+        response.html('#item-%d .value' % (idx % 50), html)
+    return response
+
+
+@benchmark('serialization.get_json',
+           params=[{'commands': 10, 'html': 16}, {'commands': 10, 'html': 4096},
+                   {'commands': 1000, 'html': 16}, {'commands': 1000, 'html': 4096},
+                   {'commands': 10000, 'html': 16}])
+def bench_get_json(commands, html):
+    response = _make_response(commands, html)
+    return response._get_json, {'bytes': len(response._get_json())}
+
+
+@benchmark('serialization.compact_format',
+           params=[{'commands': 100}, {'commands': 1000}])
+def bench_compact_format(commands):
+    data = {Sijax.PARAM_FORMAT: Sijax.FORMAT_COMPACT}
+    response = _make_response(commands, 16, data)
+    size = len(response._get_json())
+    default_size = len(_make_response(commands, 16)._get_json())
+    return response._get_json, {'bytes': size,
+                                'ratio': round(float(size) / default_size, 3)}
+
+
+@benchmark('serialization.codec',
+           params=[{'codec': 'json'}, {'codec': 'msgpack'}])
+def bench_codec_output(codec):
+    response = _make_response(1000, 16, {Sijax.PARAM_CODEC: codec})
+    if response._sijax.codec.name != codec:
+        # The codec's library is not installed
+        return (lambda: None), {'skipped': True}
+    return response._get_output, {'bytes': len(response._get_output())}
+
+
+@benchmark('serialization.decode_args',
+           params=[{'codec': 'json'}, {'codec': 'msgpack'}])
+def bench_decode_args(codec):
+    import base64
+
+    sijax_instance = Sijax()
+    codec_obj = sijax_instance._codecs[codec]
+    if not codec_obj.is_available():
+        return (lambda: None), {'skipped': True}
+
+    args = [{'id': idx, 'name': 'item %d' % idx, 'tags': ['a', 'b']}
+            for idx in range(100)]
+    if codec_obj.is_binary:
+        encoded = base64.b64encode(codec_obj.dumps(args)).decode('ascii')
+    else:
+        encoded = codec_obj.dumps(args)
+    data = {Sijax.PARAM_REQUEST: 'handler', Sijax.PARAM_ARGS: encoded,
+            Sijax.PARAM_CODEC: codec}
+
+    def decode():
+        sijax_instance.set_data(data)
+        return sijax_instance.request_args
+    return decode, {'bytes': len(encoded)}
+
+
+@benchmark('serialization.compression',
+           params=[{'encoding': 'gzip', 'level': 1}, {'encoding': 'gzip', 'level': 6},
+                   {'encoding': 'deflate', 'level': 6}])
+def bench_compression(encoding, level):
+    from ..compression import compress_chunks
+
+    output = _make_response(1000, 64)._get_json().encode('utf-8')
+    compressed = b''.join(compress_chunks([output], encoding, level))
+
+    def compress():
+        for _ in compress_chunks([output], encoding, level):
+            pass
+    return compress, {'bytes': len(output),
+                      'ratio': round(float(len(compressed)) / len(output), 3)}
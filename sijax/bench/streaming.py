@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.bench.streaming
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks streaming responses (flushing and whole streams).
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+from ..core import Sijax
+from ..response import StreamingIframeResponse
+from . import benchmark
+
+
+_TRANSPORTS = {'iframe': Sijax.TRANSPORT_DEFAULT, 'fetch': Sijax.TRANSPORT_FETCH}
+
+
+@benchmark('streaming.flush',
+           params=[{'commands': 1, 'transport': 'iframe'},
+                   {'commands': 10, 'transport': 'iframe'},
+                   {'commands': 100, 'transport': 'iframe'},
+                   {'commands': 10, 'transport': 'fetch'}])
+def bench_flush(commands, transport):
+    sijax_instance = Sijax()
+    sijax_instance.set_data({Sijax.PARAM_TRANSPORT: _TRANSPORTS[transport]})
+    response = StreamingIframeResponse(sijax_instance, [])
+    # The first flush is padded
+    response.alert('first')
+    response._flush()
+
+    def flush():
+        for idx in range(commands):
+            response.html('#progress', '%d%%' % idx)
+        return response._flush()
+    return flush, {'bytes': len(flush())}
+
+
+@benchmark('streaming.stream',
+           params=[{'flushes': 10}, {'flushes': 100}])
+def bench_stream(flushes):
+    def handler(obj_response):
+        for idx in range(flushes):
+            obj_response.html('#progress', '%d%%' % idx)
+            yield obj_response
+
+    sijax_instance = Sijax()
+    sijax_instance.register_callback('handler', handler,
+                                     response_class=StreamingIframeResponse)
+    data = {Sijax.PARAM_REQUEST: 'handler', Sijax.PARAM_ARGS: '[]'}
+
+    def stream():
+        sijax_instance.set_data(data)
+        for _ in sijax_instance.process_request():
+            pass
+    return stream
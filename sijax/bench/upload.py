@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.bench.upload
+    ~~~~~~~~~~~~~~~~~~
+
+    Benchmarks the handling of upload form values and uploaded files.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+from io import BytesIO
+
+from ..core import Sijax
+from ..plugin.upload import (UploadResponse, register_upload_callback)
+from . import benchmark
+
+
+@benchmark('upload.form_values',
+           params=[{'fields': 10}, {'fields': 1000}, {'fields': 10000}])
+def bench_form_values(fields):
+    """Processes an upload request, reading a single form value."""
+    def handler(obj_response, form_values):
+        obj_response.alert(form_values['field_0'])
+
+    sijax_instance = Sijax()
+    register_upload_callback(sijax_instance, 'form', handler)
+    data = dict(('field_%d' % idx, 'value') for idx in range(fields))
+    data[Sijax.PARAM_REQUEST] = 'form_upload'
+    data[Sijax.PARAM_ARGS] = '["form"]'
+
+    def upload():
+        sijax_instance.set_data(data)
+        for _ in sijax_instance.process_request():
+            pass
+    return upload
+
+
+@benchmark('upload.stream_file',
+           params=[{'size': 64 * 1024}, {'size': 4 * 1024 * 1024}])
+def bench_stream_file(size):
+    """Reads an uploaded file, computing its checksum."""
+    data = b'x' * size
+    sijax_instance = Sijax()
+    sijax_instance.set_data({})
+    response = UploadResponse(sijax_instance, ['form'])
+
+    def stream():
+        response.stream_file(BytesIO(data), BytesIO()).consume()
+        response.clear_commands()
+    return stream
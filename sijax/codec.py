@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.codec
+    ~~~~~~~~~~~
+
+    Provides the codecs used to decode the call arguments (``sijax_args``)
+    and to encode the commands sent back to the browser.
+
+    JSON is always used, unless the client asks for another codec
+    (using the ``sijax_codec`` request parameter).
+    MessagePack is supported if the ``msgpack`` library is installed.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import base64
+
+from .helper import (json, msgpack)
+
+
+class JsonCodec(object):
+    """The default codec, which represents everything as JSON text."""
+
+    #: The name by which clients ask for this codec
+    name = 'json'
+
+    #: The content type of responses encoded with this codec
+    content_type = 'application/json'
+
+    #: Whether :meth:`dumps` produces bytes (True) or text (False)
+    is_binary = False
+
+    def is_available(self):
+        """Tells whether the codec can be used (its library is available)."""
+        return True
+
+    def dumps(self, obj, default=None):
+        """Encodes the given object.
+
+        :param default: a function called for objects that can't
+                        otherwise be serialized, returning
+                        a serializable version of them
+        """
+        return json.dumps(obj, separators=(',', ':'), default=default)
+
+    def loads(self, data):
+        """Decodes the given (encoded) data,
+        raising :class:`ValueError` for malformed input."""
+        return json.loads(data)
+
+    def decode_args(self, value):
+        """Decodes the raw ``sijax_args`` request parameter value."""
+        return self.loads(value)
+
+
+class MsgpackCodec(JsonCodec):
+    """A binary codec using MessagePack.
+
+    Clients send ``sijax_args`` either as a base64 encoded string
+    or as a binary (file) part of a multipart request.
+    Responses are raw MessagePack bytes.
+    """
+
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    is_binary = True
+
+    def is_available(self):
+        try:
+            msgpack.packb
+        except RuntimeError:
+            return False
+        return True
+
+    def dumps(self, obj, default=None):
+        return msgpack.packb(obj, use_bin_type=True, default=default)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            # msgpack raises various exceptions for malformed input,
+            # not all of them being ValueError subclasses
+            raise ValueError('Invalid MessagePack data: %s' % e)
+
+    def decode_args(self, value):
+        if hasattr(value, 'read'):
+            # Sent as a binary part of a multipart request
+            return self.loads(value.read())
+        try:
+            data = base64.b64decode(value)
+        except Exception as e:
+            raise ValueError('Invalid base64 data: %s' % e)
+        return self.loads(data)
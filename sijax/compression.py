@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.compression
+    ~~~~~~~~~~~~~~~~~
+
+    Provides transparent gzip/deflate compression for Sijax responses,
+    negotiated using the ``Accept-Encoding`` request header.
+
+    Streaming responses (Comet, Upload) are compressed chunk by chunk.
+    Every chunk is followed by a ``Z_SYNC_FLUSH``, so that the browser can
+    decompress (and execute) each flush as soon as it arrives.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import zlib
+
+from .exception import SijaxError
+
+
+ENCODING_GZIP = 'gzip'
+ENCODING_DEFLATE = 'deflate'
+
+#: Window bits to pass to :func:`zlib.compressobj` for each encoding.
+#: ``deflate`` in HTTP means the zlib format (RFC 1950), not raw deflate.
+_WBITS = {
+    ENCODING_GZIP: 16 + zlib.MAX_WBITS,
+    ENCODING_DEFLATE: zlib.MAX_WBITS,
+}
+
+#: Content types worth compressing. Sijax responses are JSON (regular
+#: functions) or HTML with script tags (streaming functions).
+COMPRESSIBLE_CONTENT_TYPES = (
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+)
+
+
+def negotiate_encoding(accept_encoding, encodings=(ENCODING_GZIP, ENCODING_DEFLATE)):
+    """Picks the best content encoding the client accepts.
+
+    Only encodings from ``encodings`` are considered (in order of preference).
+    Quality values (``gzip;q=0``) are respected.
+
+    :param accept_encoding: the value of the ``Accept-Encoding`` header
+    :param encodings: the supported encodings, best first
+    :return: the chosen encoding or None if no compression should be used
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        pieces = part.strip().split(';')
+        name = pieces[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in pieces[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0:
+            return encoding
+    return None
+
+
+class Compressor(object):
+    """Incremental gzip/deflate compressor.
+
+    Each call to :meth:`compress` returns all the compressed data for the
+    given chunk (the zlib stream is synced after it),
+    which is what streaming responses need.
+
+    :param encoding: ``gzip`` or ``deflate``
+    :param level: the zlib compression level (1-9)
+    """
+
+    def __init__(self, encoding, level=6):
+        if encoding not in _WBITS:
+            raise SijaxError('Unsupported encoding: %s' % encoding)
+        if not 1 <= level <= 9:
+            raise SijaxError('Compression level needs to be between 1 and 9!')
+        self.encoding = encoding
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED,
+                                             _WBITS[encoding])
+
+    def compress(self, chunk):
+        """Compresses the chunk and syncs the stream, so that everything
+        returned so far can be decompressed by the client."""
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        return (self._compressobj.compress(chunk) +
+                self._compressobj.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        """Finishes the stream, returning the remaining data (trailer)."""
+        return self._compressobj.flush(zlib.Z_FINISH)
+
+
+def compress_chunks(chunks, encoding, level=6):
+    """Generator compressing the given chunks (strings or bytes).
+
+    A sync flush is done after every chunk, so each generated piece
+    can be sent to the browser right away.
+    """
+    compressor = Compressor(encoding, level)
+    for chunk in chunks:
+        if not chunk:
+            continue
+        yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def compress_response(response, accept_encoding, level=6,
+                      encodings=(ENCODING_GZIP, ENCODING_DEFLATE)):
+    """Compresses the result of :meth:`sijax.Sijax.process_request`.
+
+    This is meant to be used by framework integrations, which know
+    the ``Accept-Encoding`` header and can set response headers::
+
+        response = sijax_instance.process_request()
+        body, encoding = compress_response(response, accept_encoding)
+        if encoding is not None:
+            # set the `Content-Encoding: <encoding>` header
+
+    Regular responses (strings) are compressed all at once, producing bytes.
+    Streaming responses (generators) result in a generator,
+    which compresses every flush separately.
+
+    :param response: the string or generator to compress
+    :param accept_encoding: the value of the ``Accept-Encoding`` header
+    :param level: the zlib compression level (1-9)
+    :param encodings: the supported encodings, best first
+    :return: two-tuple (response, encoding or None if not compressed)
+    """
+    encoding = negotiate_encoding(accept_encoding, encodings)
+    if encoding is None:
+        return response, None
+
+    if isinstance(response, (bytes, type(''))):
+        compressor = Compressor(encoding, level)
+        return compressor.compress(response) + compressor.finish(), encoding
+
+    return compress_chunks(response, encoding, level), encoding
+
+
+class CompressionMiddleware(object):
+    """WSGI middleware compressing responses with gzip or deflate.
+
+    Responses are compressed chunk by chunk, with a sync flush after each
+    chunk, which keeps Comet/Upload streaming working (every flush still
+    reaches the browser immediately)::
+
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app, level=6)
+
+    :param app: the WSGI application to wrap
+    :param level: the zlib compression level (1-9)
+    :param min_size: responses with a known ``Content-Length``
+                     smaller than this are not compressed
+    :param encodings: the supported encodings, best first
+    :param content_types: only responses of these content types are compressed
+    """
+
+    def __init__(self, app, level=6, min_size=200,
+                 encodings=(ENCODING_GZIP, ENCODING_DEFLATE),
+                 content_types=COMPRESSIBLE_CONTENT_TYPES):
+        if not 1 <= level <= 9:
+            raise SijaxError('Compression level needs to be between 1 and 9!')
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.encodings = encodings
+        self.content_types = content_types
+
+    def _should_compress(self, status, headers):
+        if status[:3] in ('204', '304') or int(status[:3]) < 200:
+            return False
+
+        content_type = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'content-length':
+                try:
+                    if int(value) < self.min_size:
+                        return False
+                except ValueError:
+                    pass
+            if name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+
+        return content_type in self.content_types
+
+    @staticmethod
+    def _add_vary(headers):
+        """Returns the headers, with ``Accept-Encoding`` added
+        to the ``Vary`` header (caches need to keep compressed
+        and uncompressed responses apart)."""
+        headers = list(headers)
+        for idx, (name, value) in enumerate(headers):
+            if name.lower() != 'vary':
+                continue
+            fields = [field.strip().lower() for field in value.split(',')]
+            if 'accept-encoding' not in fields and '*' not in fields:
+                headers[idx] = (name, '%s, Accept-Encoding' % value)
+            return headers
+        headers.append(('Vary', 'Accept-Encoding'))
+        return headers
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'),
+                                      self.encodings)
+        if encoding is None:
+            def start_uncompressed_response(status, headers, exc_info=None):
+                # Other clients may get the same response compressed
+                if self._should_compress(status, headers):
+                    headers = self._add_vary(headers)
+                return start_response(status, headers, exc_info)
+            return self.app(environ, start_uncompressed_response)
+
+        state = {'compressor': None}
+
+        def start_compressed_response(status, headers, exc_info=None):
+            if self._should_compress(status, headers):
+                compressor = Compressor(encoding, self.level)
+                state['compressor'] = compressor
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'content-length']
+                headers.append(('Content-Encoding', encoding))
+                headers = self._add_vary(headers)
+                write = start_response(status, headers, exc_info)
+                return lambda data: write(compressor.compress(data))
+            state['compressor'] = None
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, start_compressed_response)
+        return self._iterate(app_iter, state)
+
+    def _iterate(self, app_iter, state):
+        try:
+            for chunk in app_iter:
+                compressor = state['compressor']
+                if compressor is None:
+                    yield chunk
+                elif chunk:
+                    yield compressor.compress(chunk)
+            if state['compressor'] is not None:
+                yield state['compressor'].finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -14,9 +14,13 @@ from __future__ import (absolute_import, unicode_literals)
 """
 
 from builtins import str
+from types import GeneratorType
+from six import (string_types, integer_types)
 from .helper import json
+from .codec import (JsonCodec, MsgpackCodec)
 from .response.base import BaseResponse
 from .exception import SijaxError
+from .instrument import (CallRecord, get_size)
 
 class Sijax(object):
     """The main Sijax object is what manages function registration and calling.
@@ -44,6 +48,53 @@ class Sijax(object):
     PARAM_REQUEST = 'sijax_rq'
     PARAM_ARGS = 'sijax_args'
 
+    #: An optional request parameter, by which the client asks for
+    #: a response format different than the default one.
+    PARAM_FORMAT = 'sijax_format'
+
+    #: The default response format - a JSON list of command objects.
+    FORMAT_DEFAULT = 'default'
+
+    #: A compact response format, which sends a string table and encodes
+    #: each command as an array of indexes into it.
+    #: See :meth:`sijax.response.BaseResponse._get_compact_commands`.
+    FORMAT_COMPACT = 'compact'
+
+    #: An optional request parameter, by which the client asks for
+    #: a codec other than JSON (see :meth:`sijax.Sijax.register_codec`).
+    PARAM_CODEC = 'sijax_codec'
+
+    #: An optional request parameter (JSON list of argument indexes),
+    #: telling which call arguments were sent out-of-band, as separate
+    #: (multipart) request fields.
+    #: The arguments at those indexes are placeholders,
+    #: containing the name of the field to get the actual value from.
+    PARAM_REFS = 'sijax_refs'
+
+    #: The prefix of the names of fields containing out-of-band arguments
+    PARAM_ARG_PREFIX = 'sijax_arg_'
+
+    #: An optional request parameter, by which the client tells how the
+    #: request was made, for plugins whose default transport
+    #: is not a regular ajax request (like the Upload plugin's iframe).
+    PARAM_TRANSPORT = 'sijax_transport'
+
+    #: The default transport (whatever the response class expects)
+    TRANSPORT_DEFAULT = 'default'
+
+    #: The request was made using ``XMLHttpRequest``, expecting
+    #: the commands in a single (non-streaming) response.
+    TRANSPORT_XHR = 'xhr'
+
+    #: The request was made using ``fetch()``, reading the (streamed)
+    #: response body as newline-delimited JSON (NDJSON).
+    TRANSPORT_FETCH = 'fetch'
+
+    #: Internal request parameters, which are not part of any form
+    #: that the client may have submitted.
+    SYSTEM_PARAMS = (PARAM_REQUEST, PARAM_ARGS, PARAM_FORMAT, PARAM_CODEC,
+                     PARAM_REFS, PARAM_TRANSPORT)
+
     #: Event called immediately before calling the response function.
     #: The event handler function receives the Response object argument.
     EVENT_BEFORE_PROCESSING = 'before_processing'
@@ -53,7 +104,8 @@ class Sijax(object):
     EVENT_AFTER_PROCESSING = 'after_processing'
 
     #: Event called when the function to be called is unknown
-    #: (not registered with Sijax).
+    #: (not registered with Sijax), or when the arguments were encoded
+    #: using a codec which is not available (see :attr:`codec`).
     #: The event handler function receives the Response object argument
     #: followed by the public name of the function that was
     #: supposed to be called.
@@ -100,6 +152,17 @@ class Sijax(object):
         #: to be passed to the requested function
         self._request_args = None
 
+        #: The codecs that clients may ask for (name => codec object)
+        #: JSON is the default one, used when no other is requested
+        self._codecs = {}
+        self._default_codec = JsonCodec()
+
+        #: The observers that get call records (see :meth:`add_observer`)
+        self._observers = []
+
+        #: Profiles sampled calls (see :meth:`set_profiler`)
+        self._profiler = None
+
         def invalid_request(obj_response, func_name):
             """Handler to be called when an unknown function is called."""
             msg = 'The action you performed is unavailable! (Sijax error)'
@@ -119,6 +182,9 @@ class Sijax(object):
         self.register_event(cls.EVENT_INVALID_REQUEST, invalid_request)
         self.register_event(cls.EVENT_INVALID_CALL, invalid_call)
 
+        self.register_codec(self._default_codec)
+        self.register_codec(MsgpackCodec())
+
     def set_data(self, data):
         """Sets the incoming data dictionary (usually POST).
 
@@ -224,6 +290,36 @@ class Sijax(object):
             if hasattr(attribute, '__call__'):
                 self.register_callback(attr_name, attribute, **options)
 
+    def add_observer(self, observer):
+        """Adds an observer, which gets a :class:`sijax.instrument.CallRecord`
+        for every call, telling how long each of its stages took::
+
+            from sijax.instrument import HistogramAggregator
+
+            aggregator = HistogramAggregator()
+            instance.add_observer(aggregator)
+
+        Calls are only timed when there are observers.
+
+        :param observer: a :class:`sijax.instrument.Observer`
+        """
+        self._observers.append(observer)
+        return self
+
+    def remove_observer(self, observer):
+        """Removes an observer added using :meth:`add_observer`."""
+        self._observers.remove(observer)
+        return self
+
+    def set_profiler(self, profiler):
+        """Sets the :class:`sijax.profiling.CallProfiler`, which profiles
+        a sampled fraction of the calls to the functions it's enabled for.
+
+        Pass None to remove it.
+        """
+        self._profiler = profiler
+        return self
+
     @property
     def is_sijax_request(self):
         """Tells whether this page request looks like
@@ -253,6 +349,12 @@ class Sijax(object):
         It should be noted that this is not necessarily the arguments list
         that the callback function will actually receive.
         Custom Response objects are allowed to override the arguments list.
+
+        Large arguments may be sent out-of-band by the client
+        (as separate multipart fields, instead of inside ``sijax_args``).
+        Those are passed to the function as they were given to
+        :meth:`sijax.Sijax.set_data` - usually file-like objects
+        that the function can read in chunks.
         """
         key_args = self.__class__.PARAM_ARGS
         if self._request_args is None:
@@ -260,13 +362,136 @@ class Sijax(object):
             self._request_args = []
             if key_args in self._data:
                 try:
-                    args = json.loads(self._data[key_args])
+                    args = self.codec.decode_args(self._data[key_args])
                     if isinstance(args, list):
-                        self._request_args = args
+                        self._request_args = self._resolve_refs(args)
                 except (ValueError):
                     pass
         return self._request_args
 
+    def _resolve_refs(self, args):
+        """Replaces the placeholders of out-of-band arguments
+        with the values of the fields that they refer to.
+
+        The values themselves are not read (decoded) in any way.
+        A :class:`ValueError` is raised for invalid references.
+        """
+        cls = self.__class__
+        if cls.PARAM_REFS not in self._data:
+            return args
+
+        try:
+            refs = json.loads(self._data[cls.PARAM_REFS])
+        except TypeError:
+            # Not a string (e.g. sent as a file)
+            raise ValueError('Invalid out-of-band argument references')
+        if not isinstance(refs, list):
+            raise ValueError('Invalid out-of-band argument references')
+
+        args = list(args)
+        for idx in refs:
+            if (not isinstance(idx, integer_types) or isinstance(idx, bool) or
+                not 0 <= idx < len(args)):
+                raise ValueError('Invalid out-of-band argument index')
+            field_name = args[idx]
+            if (not isinstance(field_name, string_types) or
+                not field_name.startswith(cls.PARAM_ARG_PREFIX) or
+                field_name not in self._data):
+                raise ValueError('Invalid out-of-band argument field')
+            args[idx] = self._data[field_name]
+        return args
+
+    def register_codec(self, codec):
+        """Registers a codec that clients can ask for by name.
+
+        A codec is used to decode the call arguments and (for regular,
+        non-streaming functions) to encode the response.
+        JSON (:class:`sijax.codec.JsonCodec`) and MessagePack
+        (:class:`sijax.codec.MsgpackCodec`) are registered by default.
+
+        Registering a codec with the name of an existing one replaces it.
+
+        :param codec: the codec object to register
+        """
+        self._codecs[codec.name] = codec
+        return self
+
+    @property
+    def codec(self):
+        """The codec that the client asked for.
+
+        Falls back to JSON if no codec (or an unknown or unavailable
+        codec) was requested, which is what older clients
+        always get, as they don't know about codecs.
+
+        Calls asking for a codec which is registered, but not available
+        (like MessagePack, without the ``msgpack`` library), are rejected
+        by :meth:`process_request`, as their arguments can't be decoded.
+        """
+        param = self.__class__.PARAM_CODEC
+        if param in self._data:
+            codec = self._codecs.get(self._data[param])
+            if codec is not None and codec.is_available():
+                return codec
+        return self._default_codec
+
+    def _is_codec_unavailable(self):
+        """Tells whether the requested codec is registered,
+        but not available (see :attr:`codec`)."""
+        param = self.__class__.PARAM_CODEC
+        if param not in self._data:
+            return False
+        codec = self._codecs.get(self._data[param])
+        return codec is not None and not codec.is_available()
+
+    @property
+    def response_content_type(self):
+        """The content type of the response to the current request.
+
+        Frameworks can use it to set the ``Content-Type`` header
+        of the result of :meth:`sijax.Sijax.process_request`.
+        """
+        options = {}
+        if not self._is_codec_unavailable():
+            options = self._callbacks.get(self.requested_function, {})
+        response_class = options.get(self.__class__.PARAM_RESPONSE_CLASS,
+                                     BaseResponse)
+        if hasattr(response_class, 'get_content_type'):
+            return response_class.get_content_type(self)
+        return BaseResponse.get_content_type(self)
+
+    @property
+    def response_format(self):
+        """The response format that the client asked for.
+
+        Clients that don't know about response formats (older versions
+        of ``sijax.js``) never send the format parameter,
+        so they always get :attr:`sijax.Sijax.FORMAT_DEFAULT`.
+        Unknown formats are also ignored.
+        """
+        cls = self.__class__
+        requested = None
+        if cls.PARAM_FORMAT in self._data:
+            requested = self._data[cls.PARAM_FORMAT]
+        if requested == cls.FORMAT_COMPACT:
+            return cls.FORMAT_COMPACT
+        return cls.FORMAT_DEFAULT
+
+    @property
+    def transport(self):
+        """The transport that the client used to make the request.
+
+        This is :attr:`sijax.Sijax.TRANSPORT_DEFAULT`, unless the client
+        said otherwise. Unknown transports are ignored.
+        """
+        cls = self.__class__
+        requested = None
+        if cls.PARAM_TRANSPORT in self._data:
+            requested = self._data[cls.PARAM_TRANSPORT]
+        if requested in (cls.TRANSPORT_XHR, cls.TRANSPORT_FETCH):
+            return requested
+        return cls.TRANSPORT_DEFAULT
+
     def process_request(self):
         """Executes the Sijax request and returns the response.
 
@@ -276,9 +501,10 @@ class Sijax(object):
         if this method is called for non-Sijax requests.
 
         If the function that was called from the browser is not
-        registered (the function is unknown to Sijax),
+        registered (the function is unknown to Sijax), or if its arguments
+        were encoded using an unavailable codec (see :attr:`codec`),
         the :attr:`sijax.Sijax.EVENT_INVALID_REQUEST` event handler will
-        be called instead.
+        be called instead (and the response is JSON).
 
         Refer to :meth:`sijax.Sijax.execute_callback` to see how the main
         handler is called and what the response (return value) is.
@@ -287,17 +513,30 @@ class Sijax(object):
             raise SijaxError('You should not call this for non-Sijax requests!')
 
         function_name = self.requested_function
-        if function_name in self._callbacks:
+        record = None
+        if self._observers:
+            record = CallRecord(function_name, list(self._observers), self._data)
+
+        if function_name in self._callbacks and not self._is_codec_unavailable():
             options = self._callbacks[function_name]
-            args = self.request_args
+            if record is None:
+                args = self.request_args
+            else:
+                record.request_size = get_size(self._data[self.__class__.PARAM_ARGS])
+                started = record._start_stage(CallRecord.STAGE_DECODE_ARGS)
+                args = self.request_args
+                record._end_stage(CallRecord.STAGE_DECODE_ARGS, started)
         else:
-            # Function not registered.. Let's call the invalid request handler
-            # passing to it the function name that should've been called
+            # Function not registered (or its arguments can't be decoded)..
+            # Let's call the invalid request handler passing to it
+            # the function name that should've been called
             args = [function_name]
             callback = self._events[self.__class__.EVENT_INVALID_REQUEST]
             options = {self.__class__.PARAM_CALLBACK: callback}
+            if record is not None:
+                record.status = CallRecord.STATUS_INVALID_REQUEST
 
-        return self.execute_callback(args, **options)
+        return self._execute_callback(function_name, record, args, **options)
 
     def execute_callback(self, args, callback, **params):
         """Executes the given callback function and returns a response.
@@ -317,6 +556,26 @@ class Sijax(object):
                                        to see what else is available
         :return: string for regular callbacks or generator for streaming callbacks
         """
+        record = None
+        if self._observers:
+            record = CallRecord(None, list(self._observers))
+        # There's no public name - profiled by the name of the callback
+        function_name = getattr(callback, '__name__', None)
+        return self._execute_callback(function_name, record, args, callback,
+                                      **params)
+
+    def _execute_callback(self, function_name, record, args, callback, **params):
+        """Implements :meth:`execute_callback`, profiling the call
+        if it's sampled (see :meth:`set_profiler`)."""
+        profiler = self._profiler
+        if profiler is not None and profiler._should_sample(function_name):
+            return profiler._profile(function_name, self._run_callback,
+                                     record, args, callback, **params)
+        return self._run_callback(record, args, callback, **params)
+
+    def _run_callback(self, record, args, callback, **params):
+        """Runs the callback, timing the call
+        if a :class:`sijax.instrument.CallRecord` is given."""
         cls = self.__class__
 
         # Another response class could be used to extend behavior
@@ -336,7 +595,13 @@ class Sijax(object):
         # to override the arguments list.
         # Note that we're not passing args_extra to it, as we don't
         # want responses to know anything about that.
-        obj_response = response_class(self, args)
+        if record is None:
+            obj_response = response_class(self, args)
+        else:
+            started = record._start_stage(CallRecord.STAGE_CREATE_RESPONSE)
+            obj_response = response_class(self, args)
+            record._end_stage(CallRecord.STAGE_CREATE_RESPONSE, started)
+            obj_response._call_record = record
         call_args = args_extra + obj_response._get_request_args()
 
         call_chain = [
@@ -344,7 +609,18 @@ class Sijax(object):
             (callback, call_args),
             (self._events[cls.EVENT_AFTER_PROCESSING], [])
         ]
-        return obj_response._process_call_chain(call_chain)
+        if record is None:
+            return obj_response._process_call_chain(call_chain)
+
+        try:
+            result = obj_response._process_call_chain(call_chain)
+        except Exception as e:
+            record._finish(e)
+            raise
+        if isinstance(result, GeneratorType):
+            return record._finish_after(result)
+        record._finish()
+        return result
 
     def register_event(self, event_name, callback):
         """Register a callback function to be called when the event occurs.
@@ -5,3 +5,12 @@ from __future__ import (absolute_import, unicode_literals)
 class SijaxError(Exception):
     """Exception class for Sijax errors."""
 
+
+
+class UploadTooLargeError(SijaxError):
+    """Raised when an uploaded file exceeds the allowed size."""
+
+
+class ChunkedUploadError(SijaxError):
+    """Raised when a chunked upload can't proceed
+    (unknown upload, chunks out of order, etc.)."""
@@ -39,6 +39,32 @@ if json is None:
     json = _JSON()
 
 
+# MessagePack support is optional. It's only needed if clients
+# ask for the binary wire format (see :mod:`sijax.codec`).
+msgpack = None
+try:
+    import msgpack
+except ImportError:
+    pass
+if msgpack is None:
+    class _MsgPack(object):
+        def __getattr__(self, name):
+            raise RuntimeError('You need the msgpack library to use '
+                               'the binary wire format!')
+    msgpack = _MsgPack()
+
+
+# OpenTelemetry support is optional. Without it, tracing
+# (see :mod:`sijax.tracing`) only works with the tracers Sijax provides.
+otel_trace = None
+otel_context = None
+try:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry import context as otel_context
+except ImportError:
+    pass
+
+
 def init_static_path(static_path):
     """Mirrors the important static files from the whole Sijax package
     into a directory of your choice.
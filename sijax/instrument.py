@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.instrument
+    ~~~~~~~~~~~~~~~~
+
+    Provides stage-level timing of Sijax calls.
+
+    Observers added using :meth:`sijax.Sijax.add_observer` receive a
+    :class:`CallRecord` for every call, telling how long each stage
+    of it took (decoding the arguments, running the handler,
+    serializing the response, every streaming flush, etc.).
+    Nothing is timed (or recorded) when there are no observers.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from types import GeneratorType
+
+from six import text_type
+
+
+#: The clock used for timing (monotonic, where available)
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def get_size(value):
+    """Returns the size of the given value in bytes, once it's encoded
+    (as UTF-8) for sending. File-like (and other) values count as 0."""
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, text_type):
+        if getattr(value, 'isascii', None) is not None and value.isascii():
+            return len(value)
+        return len(value.encode('utf-8'))
+    return 0
+
+
+class CallRecord(object):
+    """Describes a single Sijax call, as it's seen by observers.
+
+    Stages are recorded in the order in which they complete.
+    Some of them (like :attr:`STAGE_FLUSH`) may be recorded many times.
+    """
+
+    #: Decoding the call arguments (``sijax_args``)
+    STAGE_DECODE_ARGS = 'decode_args'
+
+    #: Constructing the response object
+    STAGE_CREATE_RESPONSE = 'create_response'
+
+    #: Running the :attr:`sijax.Sijax.EVENT_BEFORE_PROCESSING` handler
+    STAGE_BEFORE_PROCESSING = 'before_processing'
+
+    #: Running the function itself (for streaming functions,
+    #: the time spent inside the generator, excluding flushes)
+    STAGE_HANDLER = 'handler'
+
+    #: Running the :attr:`sijax.Sijax.EVENT_AFTER_PROCESSING` handler
+    STAGE_AFTER_PROCESSING = 'after_processing'
+
+    #: Serializing the commands of a regular (non-streaming) response
+    STAGE_SERIALIZE = 'serialize'
+
+    #: Serializing and framing the commands of a single streaming flush
+    STAGE_FLUSH = 'flush'
+
+    #: The call was processed
+    STATUS_OK = 'ok'
+
+    #: The call raised an exception
+    STATUS_ERROR = 'error'
+
+    #: The requested function is not registered
+    #: (see :attr:`sijax.Sijax.EVENT_INVALID_REQUEST`)
+    STATUS_INVALID_REQUEST = 'invalid_request'
+
+    #: The function was called with bad arguments
+    #: (see :attr:`sijax.Sijax.EVENT_INVALID_CALL`)
+    STATUS_INVALID_CALL = 'invalid_call'
+
+    def __init__(self, function_name, observers=(), request_data=None):
+        #: The public name of the requested function (None for calls
+        #: made using :meth:`sijax.Sijax.execute_callback` directly)
+        self.function_name = function_name
+
+        #: The request data given to :meth:`sijax.Sijax.set_data`
+        #: (None for calls made using :meth:`sijax.Sijax.execute_callback`)
+        self.request_data = request_data
+
+        #: One of the ``STATUS_*`` constants
+        self.status = self.__class__.STATUS_OK
+
+        #: The exception raised during the call (if any)
+        self.error = None
+
+        #: A list of (stage name, seconds) tuples
+        self.stages = []
+
+        #: The (wall clock) time at which the call started
+        self.started_at = time.time()
+
+        #: How long the whole call took, in seconds
+        #: (available once the call has finished).
+        #: For streaming functions, that's until the stream ended,
+        #: including the time spent waiting (see :attr:`busy_time`).
+        self.duration = None
+
+        #: Whether the call streamed its response (Comet, etc.)
+        self.is_streaming = False
+
+        #: The size of the (encoded) call arguments, in bytes
+        #: (0 when they're sent as a file part of a multipart request)
+        self.request_size = 0
+
+        #: The size of the response sent to the browser, in bytes (UTF-8)
+        self.response_size = 0
+
+        #: How many commands were serialized for the browser
+        self.commands_count = 0
+
+        #: A dictionary in which observers can keep
+        #: their own per-call state
+        self.extra = {}
+
+        self._observers = observers
+        self._started = clock()
+        cls = self.__class__
+        # The call chain (see Sijax.execute_callback)
+        self._chain_stages = deque((cls.STAGE_BEFORE_PROCESSING,
+                                    cls.STAGE_HANDLER,
+                                    cls.STAGE_AFTER_PROCESSING))
+        for observer in observers:
+            observer.call_started(self)
+
+    def add_stage(self, name, seconds):
+        """Records that a stage took the given number of seconds."""
+        self.stages.append((name, seconds))
+
+    def get_stage_time(self, name):
+        """Returns the total time spent in the given stage
+        (0 if it was never recorded)."""
+        return sum(seconds for stage, seconds in self.stages if stage == name)
+
+    @property
+    def busy_time(self):
+        """The time spent working on the call (in all of its stages),
+        excluding the time that streams spend waiting."""
+        return sum(seconds for _, seconds in self.stages)
+
+    def _start_stage(self, name):
+        """Notifies the observers that the stage started,
+        returning the time it started at."""
+        for observer in self._observers:
+            observer.stage_started(self, name)
+        return clock()
+
+    def _end_stage(self, name, started, error=None):
+        self._finish_stage(name, clock() - started, error)
+
+    def _finish_stage(self, name, seconds, error=None):
+        self.add_stage(name, seconds)
+        for observer in self._observers:
+            observer.stage_finished(self, name, seconds, error)
+
+    def _next_chain_stage(self):
+        """Returns the name of the stage of the next callback
+        in the call chain."""
+        if self._chain_stages:
+            return self._chain_stages.popleft()
+        return self.__class__.STAGE_HANDLER
+
+    def _time_generator(self, name, generator, started):
+        """Wraps a generator (created by a stage that started at
+        ``started``), recording the time spent inside it (not the time
+        spent by whoever iterates over it) as a single stage,
+        once it's exhausted or closed.
+
+        Observers are told when the stage gets suspended (the generator
+        yields) and resumed (it's being iterated again).
+        """
+        elapsed = clock() - started
+        observers = self._observers
+        error = None
+        for observer in observers:
+            observer.stage_suspended(self, name)
+        try:
+            while True:
+                for observer in observers:
+                    observer.stage_resumed(self, name)
+                started = clock()
+                try:
+                    value = next(generator)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    elapsed += clock() - started
+                    for observer in observers:
+                        observer.stage_suspended(self, name)
+                yield value
+        finally:
+            generator.close()
+            self._finish_stage(name, elapsed, error)
+
+    def _finish(self, error=None):
+        self.duration = clock() - self._started
+        if error is not None:
+            self.status = self.__class__.STATUS_ERROR
+            self.error = error
+        for observer in self._observers:
+            observer.observe(self)
+
+    def _finish_after(self, stream):
+        """Wraps a streaming response, finishing the call
+        when the stream ends."""
+        self.is_streaming = True
+        error = None
+        try:
+            for chunk in stream:
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if isinstance(stream, GeneratorType):
+                stream.close()
+            self._finish(error)
+
+
+class Observer(object):
+    """The base class for objects that receive call records.
+
+    See :meth:`sijax.Sijax.add_observer`.
+
+    Most observers only need :meth:`observe`, which gets the finished
+    record. The other methods are called while the call is running,
+    for observers that need to act right away (like tracing).
+    Stages are reported in the thread that runs them.
+    """
+
+    def call_started(self, record):
+        """Called when a call starts, with its (empty) record."""
+        pass
+
+    def stage_started(self, record, name):
+        """Called right before a stage starts."""
+        pass
+
+    def stage_suspended(self, record, name):
+        """Called when a stage running a generator (a streaming
+        function) yields, and when it gets created."""
+        pass
+
+    def stage_resumed(self, record, name):
+        """Called when a suspended stage is about to continue."""
+        pass
+
+    def stage_finished(self, record, name, seconds, error=None):
+        """Called when a stage has finished (possibly by raising
+        the given exception)."""
+        pass
+
+    def observe(self, record):
+        """Called with the :class:`CallRecord` of every finished call.
+
+        For streaming functions, that's when the stream ends,
+        so this may be called from whatever thread iterates over it.
+        """
+        raise NotImplementedError
+
+
+class Histogram(object):
+    """A histogram of values (durations in seconds, by default),
+    with fixed buckets.
+
+    :param buckets: the upper bounds of the buckets, in ascending order
+                    (an additional bucket for larger values is implied)
+    """
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = self.__class__.DEFAULT_BUCKETS
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+
+        #: The number of observed values
+        self.count = 0
+
+        #: The sum of the observed values
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Adds a value to the histogram (not thread-safe)."""
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_buckets(self):
+        """Returns a list of (upper bound, cumulative count) tuples,
+        ending with ``float('inf')``."""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self._counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def get_quantile(self, q):
+        """Estimates the given quantile (0 to 1), interpolating linearly
+        within the bucket that contains it.
+
+        Returns None for empty histograms. Values in the last
+        (unbounded) bucket are estimated as the largest bucket bound.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        lower, previous = 0.0, 0
+        for bound, total in self.get_buckets():
+            if total >= rank:
+                if bound == float('inf'):
+                    return lower
+                in_bucket = total - previous
+                if in_bucket == 0:
+                    return bound
+                return lower + (bound - lower) * (rank - previous) / in_bucket
+            lower, previous = bound, total
+        return lower
+
+
+class HistogramAggregator(Observer):
+    """An observer keeping (in memory) a :class:`Histogram` of the time
+    spent in each stage, for each registered function::
+
+        aggregator = HistogramAggregator()
+        sijax_instance.add_observer(aggregator)
+
+        # later on
+        histogram = aggregator.get_histogram('my_func', CallRecord.STAGE_HANDLER)
+        print(histogram.count, histogram.get_quantile(0.99))
+
+    The duration of the whole call is kept under the ``'total'`` stage.
+    Calls to unknown functions are aggregated under the name ``None``,
+    so that clients can't make the aggregator grow without limits.
+
+    Stages recorded many times in a call (like flushes)
+    add a value to the histogram for every time.
+
+    :param buckets: the histogram buckets (see :class:`Histogram`)
+    """
+
+    #: The name of the stage containing the durations of whole calls
+    STAGE_TOTAL = 'total'
+
+    def __init__(self, buckets=None):
+        self._buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _get_key(self, record):
+        if record.status == CallRecord.STATUS_INVALID_REQUEST:
+            return None
+        return record.function_name
+
+    def observe(self, record):
+        name = self._get_key(record)
+        values = list(record.stages)
+        values.append((self.__class__.STAGE_TOTAL, record.duration))
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            for stage, seconds in values:
+                histogram = histograms.get(stage)
+                if histogram is None:
+                    histogram = histograms[stage] = Histogram(self._buckets)
+                histogram.observe(seconds)
+
+    def get_function_names(self):
+        """Returns the names of the functions seen so far."""
+        with self._lock:
+            return list(self._histograms)
+
+    def get_histogram(self, function_name, stage=STAGE_TOTAL):
+        """Returns the :class:`Histogram` for the given function and stage,
+        or None if nothing was recorded for them."""
+        with self._lock:
+            return self._histograms.get(function_name, {}).get(stage)
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self._histograms = {}
+
+
+class SlowCallLog(Observer):
+    """An observer logging the calls that take longer than a threshold,
+    along with what's needed to tell why they were slow::
+
+        sijax_instance.add_observer(SlowCallLog(threshold=0.5))
+
+    Each message tells how long every stage took, the size of the
+    arguments, the number of commands sent and the size of the response.
+    The same data is attached to the log record, as its ``sijax_call``
+    attribute (a dictionary), for structured logging handlers.
+
+    Streaming calls (Comet, long polling, etc.) mostly wait, so they're
+    judged by the time spent working on them (see
+    :attr:`CallRecord.busy_time`), rather than by how long they were open.
+
+    At most ``max_records`` calls are logged every ``interval`` seconds,
+    so that an incident can't flood the logs. The first message logged
+    after that tells how many slow calls were left out.
+
+    :param threshold: the duration (in seconds) above which calls are logged
+    :param thresholds: a dictionary of function name => threshold,
+                       for functions that need a different one
+    :param max_records: how many calls to log per ``interval``
+    :param interval: the rate limiting interval, in seconds
+    :param logger: the ``logging.Logger`` to log to
+                   (the ``sijax.slow_calls`` logger, by default)
+    """
+
+    def __init__(self, threshold=1.0, thresholds=None, max_records=10,
+                 interval=60, logger=None):
+        self.threshold = threshold
+        self.thresholds = thresholds or {}
+        self.max_records = max_records
+        self.interval = interval
+        self.logger = logger or logging.getLogger('sijax.slow_calls')
+        self._lock = threading.Lock()
+        self._window_started = 0
+        self._window_count = 0
+
+        #: How many slow calls were left out (and not reported yet),
+        #: because of rate limiting
+        self.suppressed_count = 0
+
+    def _acquire(self):
+        """Tells whether a record can be logged now,
+        returning the number of suppressed ones (or None)."""
+        now = time.time()
+        with self._lock:
+            if now - self._window_started >= self.interval:
+                self._window_started = now
+                self._window_count = 0
+            if self._window_count >= self.max_records:
+                self.suppressed_count += 1
+                return None
+            self._window_count += 1
+            suppressed, self.suppressed_count = self.suppressed_count, 0
+            return suppressed
+
+    def observe(self, record):
+        threshold = self.thresholds.get(record.function_name, self.threshold)
+        if record.is_streaming:
+            elapsed = record.busy_time
+        else:
+            elapsed = record.duration
+        if elapsed < threshold:
+            return
+        suppressed = self._acquire()
+        if suppressed is None:
+            return
+
+        stages = {}
+        for name, seconds in record.stages:
+            stages[name] = stages.get(name, 0) + seconds
+        data = {
+            'function': record.function_name,
+            'status': record.status,
+            'duration': elapsed,
+            'streaming': record.is_streaming,
+            'stages': stages,
+            'request_bytes': record.request_size,
+            'commands': record.commands_count,
+            'response_bytes': record.response_size,
+            'suppressed': suppressed,
+        }
+        timings = ', '.join('%s %.3fs' % (name, stages[name])
+                            for name, _ in sorted(stages.items(),
+                                                  key=lambda item: -item[1]))
+        message = ('Slow Sijax call: %s took %.3fs (%s); '
+                   '%d bytes of arguments, %d commands, %d bytes sent')
+        args = [record.function_name, elapsed, timings,
+                record.request_size, record.commands_count, record.response_size]
+        if record.is_streaming:
+            message += '; streamed for %.3fs'
+            args.append(record.duration)
+        if suppressed:
+            message += '; %d slow calls not logged before this one'
+            args.append(suppressed)
+        self.logger.warning(message, *args, extra={'sijax_call': data})
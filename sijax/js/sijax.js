@@ -2,9 +2,32 @@ var Sijax = {};
 
 Sijax.PARAM_REQUEST = 'sijax_rq';
 Sijax.PARAM_ARGS = 'sijax_args';
+Sijax.PARAM_FORMAT = 'sijax_format';
+Sijax.PARAM_CODEC = 'sijax_codec';
+Sijax.PARAM_REFS = 'sijax_refs';
+Sijax.PARAM_ARG_PREFIX = 'sijax_arg_';
+Sijax.PARAM_TRANSPORT = 'sijax_transport';
+
+Sijax.FORMAT_COMPACT = 'compact';
+
+Sijax.CODEC_MSGPACK = 'msgpack';
+
+Sijax.TRANSPORT_XHR = 'xhr';
+Sijax.TRANSPORT_FETCH = 'fetch';
 
 Sijax.requestUri = null;
 
+//Response format to ask the server for (null means the default one)
+Sijax.responseFormat = null;
+
+//Codec to ask the server for (null means JSON)
+Sijax.codec = null;
+
+//String arguments longer than this are sent out-of-band (as separate
+//multipart fields), instead of being JSON-encoded inside PARAM_ARGS.
+//null (the default) sends all strings inside PARAM_ARGS.
+Sijax.largeArgThreshold = null;
+
 Sijax.setRequestUri = function (uri) {
 	Sijax.requestUri = uri;
 };
@@ -20,7 +43,367 @@ Sijax.setJsonUri = function (uri) {
 	jQuery.getScript(uri);
 };
 
+Sijax.setResponseFormat = function (format) {
+	Sijax.responseFormat = format;
+};
+
+Sijax.setCodec = function (codec) {
+	Sijax.codec = codec;
+};
+
+Sijax.isBinaryCodecSupported = function () {
+	return (typeof(ArrayBuffer) !== "undefined" && typeof(DataView) !== "undefined" &&
+		typeof(window.btoa) !== "undefined");
+};
+
+Sijax.isFormDataSupported = function () {
+	return (typeof(FormData) !== "undefined" && typeof(Blob) !== "undefined");
+};
+
+Sijax.isLargeArg = function (value) {
+	if (typeof(Blob) !== "undefined" && value instanceof Blob) {
+		return true;
+	}
+	return (Sijax.largeArgThreshold !== null && typeof(value) === 'string' &&
+		value.length > Sijax.largeArgThreshold);
+};
+
+Sijax.getRequestData = function (functionName, callArgs, outOfBand) {
+	//If an outOfBand object is given, large arguments (and Blobs/Files)
+	//are moved to it and replaced by placeholders (field names)
+	var data = {},
+		refs = [],
+		i;
+
+	if (outOfBand) {
+		callArgs = callArgs.slice(0);
+		for (i = 0; i < callArgs.length; i += 1) {
+			if (Sijax.isLargeArg(callArgs[i])) {
+				outOfBand[Sijax.PARAM_ARG_PREFIX + i] = callArgs[i];
+				callArgs[i] = Sijax.PARAM_ARG_PREFIX + i;
+				refs.push(i);
+			}
+		}
+	}
+
+	data[Sijax.PARAM_REQUEST] = functionName;
+	if (Sijax.codec === Sijax.CODEC_MSGPACK && Sijax.isBinaryCodecSupported()) {
+		data[Sijax.PARAM_CODEC] = Sijax.codec;
+		data[Sijax.PARAM_ARGS] = window.btoa(Sijax.msgpack.encode(callArgs));
+	} else {
+		data[Sijax.PARAM_ARGS] = JSON.stringify(callArgs);
+	}
+	if (Sijax.responseFormat) {
+		data[Sijax.PARAM_FORMAT] = Sijax.responseFormat;
+	}
+	if (refs.length !== 0) {
+		data[Sijax.PARAM_REFS] = JSON.stringify(refs);
+	}
+	return data;
+};
+
+Sijax.getFormData = function (data, outOfBand) {
+	var formData = new FormData();
+	jQuery.each(data, function (name, value) {
+		formData.append(name, value);
+	});
+	jQuery.each(outOfBand, function (name, value) {
+		if (! (value instanceof Blob)) {
+			value = new Blob([value], {"type": "text/plain; charset=utf-8"});
+		}
+		//Sent as a file, so that the server can stream-read it
+		formData.append(name, value, name);
+	});
+	return formData;
+};
+
+Sijax.msgpack = {};
+
+//Encodes the value, returning a binary string (one character per byte)
+Sijax.msgpack.encode = function (value) {
+	var out = [];
+
+	function pushUint(value, bytesCount) {
+		for (var i = bytesCount - 1; i >= 0; i -= 1) {
+			out.push(String.fromCharCode(Math.floor(value / Math.pow(2, 8 * i)) & 0xff));
+		}
+	}
+
+	function pushHeader(length, fixPrefix, fixMax, codes) {
+		if (fixPrefix !== null && length <= fixMax) {
+			out.push(String.fromCharCode(fixPrefix | length));
+		} else if (codes[0] !== null && length < 0x100) {
+			out.push(String.fromCharCode(codes[0]));
+			pushUint(length, 1);
+		} else if (length < 0x10000) {
+			out.push(String.fromCharCode(codes[1]));
+			pushUint(length, 2);
+		} else {
+			out.push(String.fromCharCode(codes[2]));
+			pushUint(length, 4);
+		}
+	}
+
+	function encode(value) {
+		var i, key, keys, bytes, view;
+
+		if (value === null || typeof(value) === 'undefined') {
+			out.push('\xc0');
+		} else if (value === true || value === false) {
+			out.push(value ? '\xc3' : '\xc2');
+		} else if (typeof(value) === 'number') {
+			if (value % 1 === 0 && value >= 0 && value < 0x100000000) {
+				if (value < 0x80) {
+					pushUint(value, 1);
+				} else if (value < 0x100) {
+					out.push('\xcc');
+					pushUint(value, 1);
+				} else if (value < 0x10000) {
+					out.push('\xcd');
+					pushUint(value, 2);
+				} else {
+					out.push('\xce');
+					pushUint(value, 4);
+				}
+			} else if (value % 1 === 0 && value < 0 && value >= -0x80000000) {
+				if (value >= -32) {
+					pushUint(value + 0x100, 1);
+				} else {
+					out.push('\xd2');
+					pushUint(value + 0x100000000, 4);
+				}
+			} else {
+				bytes = new ArrayBuffer(8);
+				view = new DataView(bytes);
+				view.setFloat64(0, value);
+				out.push('\xcb');
+				for (i = 0; i < 8; i += 1) {
+					out.push(String.fromCharCode(view.getUint8(i)));
+				}
+			}
+		} else if (typeof(value) === 'string' || value instanceof String) {
+			bytes = unescape(encodeURIComponent(String(value)));
+			pushHeader(bytes.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+			out.push(bytes);
+		} else if (jQuery.isArray(value)) {
+			pushHeader(value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+			for (i = 0; i < value.length; i += 1) {
+				encode(value[i]);
+			}
+		} else {
+			keys = [];
+			for (key in value) {
+				if (value.hasOwnProperty(key)) {
+					keys.push(key);
+				}
+			}
+			pushHeader(keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+			for (i = 0; i < keys.length; i += 1) {
+				encode(keys[i]);
+				encode(value[keys[i]]);
+			}
+		}
+	}
+
+	encode(value);
+	return out.join('');
+};
+
+//Decodes the given ArrayBuffer. Binary values are decoded to Uint8Array objects.
+Sijax.msgpack.decode = function (buffer) {
+	var view = new DataView(buffer),
+		offset = 0;
+
+	function readUint(bytesCount) {
+		var value = 0;
+		for (var i = 0; i < bytesCount; i += 1) {
+			value = value * 256 + view.getUint8(offset);
+			offset += 1;
+		}
+		return value;
+	}
+
+	function readString(length) {
+		var chars = [];
+		for (var i = 0; i < length; i += 1) {
+			chars.push(String.fromCharCode(view.getUint8(offset + i)));
+		}
+		offset += length;
+		return decodeURIComponent(escape(chars.join('')));
+	}
+
+	function readBinary(length) {
+		var value = new Uint8Array(buffer.slice(offset, offset + length));
+		offset += length;
+		return value;
+	}
+
+	function readArray(length) {
+		var value = [];
+		for (var i = 0; i < length; i += 1) {
+			value.push(decode());
+		}
+		return value;
+	}
+
+	function readMap(length) {
+		var value = {};
+		for (var i = 0; i < length; i += 1) {
+			var key = decode();
+			value[key] = decode();
+		}
+		return value;
+	}
+
+	function readSigned(bytesCount) {
+		var value = readUint(bytesCount),
+			limit = Math.pow(2, 8 * bytesCount);
+		return (value >= limit / 2 ? value - limit : value);
+	}
+
+	function decode() {
+		var type = readUint(1),
+			value;
+
+		if (type < 0x80) {
+			return type;
+		} else if (type < 0x90) {
+			return readMap(type & 0x0f);
+		} else if (type < 0xa0) {
+			return readArray(type & 0x0f);
+		} else if (type < 0xc0) {
+			return readString(type & 0x1f);
+		} else if (type >= 0xe0) {
+			return type - 0x100;
+		}
+
+		switch (type) {
+		case 0xc0: return null;
+		case 0xc2: return false;
+		case 0xc3: return true;
+		case 0xc4: return readBinary(readUint(1));
+		case 0xc5: return readBinary(readUint(2));
+		case 0xc6: return readBinary(readUint(4));
+		case 0xca:
+			value = view.getFloat32(offset);
+			offset += 4;
+			return value;
+		case 0xcb:
+			value = view.getFloat64(offset);
+			offset += 8;
+			return value;
+		case 0xcc: return readUint(1);
+		case 0xcd: return readUint(2);
+		case 0xce: return readUint(4);
+		case 0xcf: return readUint(8);
+		case 0xd0: return readSigned(1);
+		case 0xd1: return readSigned(2);
+		case 0xd2: return readSigned(4);
+		case 0xd3: return readSigned(8);
+		case 0xd9: return readString(readUint(1));
+		case 0xda: return readString(readUint(2));
+		case 0xdb: return readString(readUint(4));
+		case 0xdc: return readArray(readUint(2));
+		case 0xdd: return readArray(readUint(4));
+		case 0xde: return readMap(readUint(2));
+		case 0xdf: return readMap(readUint(4));
+		}
+
+		throw new Error('Unsupported MessagePack type: ' + type);
+	}
+
+	return decode();
+};
+
+Sijax.decodeResponse = function (buffer) {
+	var firstByte = new Uint8Array(buffer, 0, 1)[0];
+	//The server falls back to JSON, if it can't do MessagePack.
+	//JSON responses start with `[` or `{`, which are never
+	//the first bytes of a MessagePack encoded commands list/object.
+	if (firstByte === 0x5b || firstByte === 0x7b) {
+		var bytes = new Uint8Array(buffer),
+			chars = [];
+		for (var i = 0; i < bytes.length; i += 1) {
+			chars.push(String.fromCharCode(bytes[i]));
+		}
+		return JSON.parse(decodeURIComponent(escape(chars.join(''))));
+	}
+	return Sijax.msgpack.decode(buffer);
+};
+
+Sijax.requestBinary = function (requestParams) {
+	//jQuery.ajax can't deal with binary (ArrayBuffer) responses
+	var xhr = new XMLHttpRequest();
+	xhr.open(requestParams.type, requestParams.url, true);
+	xhr.responseType = 'arraybuffer';
+	xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+	if (requestParams.timeout) {
+		xhr.timeout = requestParams.timeout;
+	}
+	if (requestParams.uploadProgress && xhr.upload) {
+		xhr.upload.onprogress = function (event) {
+			requestParams.uploadProgress(event.loaded, event.lengthComputable ? event.total : null);
+		};
+	}
+	xhr.onload = function () {
+		if (xhr.status >= 200 && xhr.status < 300) {
+			requestParams.success(Sijax.decodeResponse(xhr.response));
+		} else if (requestParams.error) {
+			requestParams.error(xhr, 'error');
+		}
+	};
+	xhr.onerror = function () {
+		if (requestParams.error) {
+			requestParams.error(xhr, 'error');
+		}
+	};
+	if (Sijax.isFormDataSupported() && requestParams.data instanceof FormData) {
+		xhr.send(requestParams.data);
+	} else {
+		xhr.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded; charset=UTF-8');
+		xhr.send(jQuery.param(requestParams.data));
+	}
+};
+
+Sijax.expandCommands = function (payload) {
+	//Expands the compact format: {t: stringTable, c: [[key, value, ..], ..]}
+	var table = payload.t,
+		commands = [];
+
+	jQuery.each(payload.c, function (idx, encoded) {
+		var command = {},
+			i,
+			key,
+			value;
+
+		for (i = 0; i < encoded.length; i += 2) {
+			key = encoded[i];
+			value = encoded[i + 1];
+			if (key < 0) {
+				//Interned field with a literal (non-string) value
+				command[table[~key]] = value;
+			} else if (jQuery.inArray(table[key], Sijax.COMPACT_INTERNED_FIELDS) === -1) {
+				command[table[key]] = value;
+			} else if (jQuery.isArray(value)) {
+				//Selector sent as a [prefix, suffix] pair
+				command[table[key]] = table[value[0]] + table[value[1]];
+			} else {
+				command[table[key]] = table[value];
+			}
+		}
+		commands.push(command);
+	});
+
+	return commands;
+};
+
+Sijax.COMPACT_INTERNED_FIELDS = ['type', 'selector', 'key', 'setType'];
+
 Sijax.processCommands = function (commandsArray) {
+	if (! jQuery.isArray(commandsArray)) {
+		commandsArray = Sijax.expandCommands(commandsArray);
+	}
+
 	jQuery.each(commandsArray, function (idx, command) {
 		var callback = Sijax.getCommandProcessor(command.type);
 		callback(command);
@@ -74,8 +457,52 @@ Sijax.process_remove = function (params) {
 
 Sijax.process_call = function (params) {
 	var callbackString = params.call,
-		callback = eval(callbackString);
-	callback.apply(null, params.params);
+		callback = eval(callbackString),
+		callParams = params.params;
+
+	if (params.typed) {
+		callParams = callParams.slice(0);
+		jQuery.each(params.typed, function (idx, paramIdx) {
+			callParams[paramIdx] = Sijax.decodeTypedArray(callParams[paramIdx]);
+		});
+	}
+
+	callback.apply(null, callParams);
+};
+
+Sijax.TYPED_ARRAYS = {
+	'int8': 'Int8Array',
+	'uint8': 'Uint8Array',
+	'int16': 'Int16Array',
+	'uint16': 'Uint16Array',
+	'int32': 'Int32Array',
+	'uint32': 'Uint32Array',
+	'int64': 'BigInt64Array',
+	'uint64': 'BigUint64Array',
+	'float32': 'Float32Array',
+	'float64': 'Float64Array'
+};
+
+Sijax.decodeTypedArray = function (spec) {
+	//spec is {dtype: .., shape: [..], data: base64 string (JSON) or Uint8Array (MessagePack)}
+	var bytes = spec.data,
+		TypedArray = window[Sijax.TYPED_ARRAYS[spec.dtype]],
+		binary,
+		result,
+		i;
+
+	if (typeof(bytes) === 'string') {
+		binary = window.atob(bytes);
+		bytes = new Uint8Array(binary.length);
+		for (i = 0; i < binary.length; i += 1) {
+			bytes[i] = binary.charCodeAt(i);
+		}
+	}
+
+	result = new TypedArray(bytes.buffer, bytes.byteOffset,
+		bytes.byteLength / TypedArray.BYTES_PER_ELEMENT);
+	result.shape = spec.shape;
+	return result;
 };
 
 Sijax.request = function (functionName, callArgs, requestParams) {
@@ -95,9 +522,24 @@ Sijax.request = function (functionName, callArgs, requestParams) {
 		"success": Sijax.processCommands
 	};
 
+	var outOfBand = (Sijax.isFormDataSupported() ? {} : null),
+		isBinary;
+
 	requestParams = jQuery.extend(defaultRequestParams, requestParams);
-	requestParams.data[Sijax.PARAM_REQUEST] = functionName;
-	requestParams.data[Sijax.PARAM_ARGS] = JSON.stringify(callArgs);
+	jQuery.extend(requestParams.data, Sijax.getRequestData(functionName, callArgs, outOfBand));
+	isBinary = (requestParams.data[Sijax.PARAM_CODEC] === Sijax.CODEC_MSGPACK);
+
+	if (outOfBand && ! jQuery.isEmptyObject(outOfBand)) {
+		//Large arguments go as separate multipart fields
+		requestParams.data = Sijax.getFormData(requestParams.data, outOfBand);
+		requestParams.processData = false;
+		requestParams.contentType = false;
+	}
+
+	if (isBinary) {
+		Sijax.requestBinary(requestParams);
+		return;
+	}
 
 	jQuery.ajax(requestParams);
 };
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.loadtest
+    ~~~~~~~~~~~~~~
+
+    Records real Sijax requests (in production), and replays them
+    against an in-process WSGI application or a local server,
+    reporting throughput, latency percentiles and errors.
+
+    Replay a recording from the command line using::
+
+        python -m sijax.loadtest requests.ndjson.gz --url http://127.0.0.1:5000/ -c 8 -r 200
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import gzip
+import io
+import math
+import random
+import sys
+import threading
+import time
+from wsgiref.util import setup_testing_defaults
+
+from six import string_types
+from six.moves import queue
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlencode
+from six.moves.urllib.request import urlopen
+
+from .core import Sijax
+from .helper import json
+from .instrument import (Observer, clock)
+
+
+class RequestRecorder(Observer):
+    """Records the Sijax requests of the instances it tracks
+    to a file (gzipped, one JSON object per line)::
+
+        recorder = RequestRecorder('/var/tmp/requests.ndjson.gz',
+                                   anonymize=anonymize_args({
+                                       'login': lambda args: ['user', 'secret'],
+                                   }))
+
+        # for every request (Sijax instance)
+        recorder.track(sijax_instance)
+
+        # when done (the file is only complete once closed)
+        recorder.close()
+
+    The recorder can also be used as a context manager, which closes it.
+
+    All the text values of the request data are recorded (``sijax_rq``,
+    ``sijax_args``, upload form values, etc.). Files are not, except for
+    out-of-band call arguments, which are recorded as text (so that the
+    calls can be replayed). Requests with out-of-band arguments that
+    can't be (larger than :attr:`MAX_FIELD_SIZE`, not UTF-8 text,
+    or not seekable) are not recorded.
+
+    :param path: the file to write to
+    :param anonymize: a function getting the data of every request
+                      (a dictionary), and returning what should be
+                      recorded instead (None skips the request)
+    :param sample_rate: the fraction of the requests to record (0 to 1)
+    :param max_requests: stop recording after that many requests
+    """
+
+    #: The maximum size of an out-of-band argument to record, in bytes
+    MAX_FIELD_SIZE = 1024 * 1024
+
+    def __init__(self, path, anonymize=None, sample_rate=1.0, max_requests=None):
+        self.path = path
+        self.anonymize = anonymize
+        self.sample_rate = sample_rate
+        self.max_requests = max_requests
+
+        #: The number of requests recorded so far
+        self.recorded_count = 0
+        self._started_at = None
+        self._fp = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+
+    def track(self, sijax_instance):
+        """Starts recording the requests made to the given Sijax instance."""
+        if self not in sijax_instance._observers:
+            sijax_instance.add_observer(self)
+        return self
+
+    def _should_record(self):
+        if self._fp is None:
+            return False
+        if self.max_requests is not None and self.recorded_count >= self.max_requests:
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def _read_field(self, value):
+        """Returns the text of an out-of-band argument (usually
+        a file-like object), or None if it can't be recorded."""
+        max_size = self.__class__.MAX_FIELD_SIZE
+        try:
+            position = value.tell()
+            value.seek(0)
+            try:
+                content = value.read(max_size + 1)
+            finally:
+                value.seek(position)
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        if len(content) > max_size:
+            return None
+        if isinstance(content, bytes):
+            try:
+                return content.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+        return content if isinstance(content, string_types) else None
+
+    def observe(self, record):
+        if record.request_data is None or not self._should_record():
+            return
+        data = {}
+        for key, value in record.request_data.items():
+            if isinstance(value, string_types):
+                data[key] = value
+            elif key.startswith(Sijax.PARAM_ARG_PREFIX):
+                # The call can't be replayed without it
+                value = self._read_field(value)
+                if value is None:
+                    return
+                data[key] = value
+        if self.anonymize is not None:
+            data = self.anonymize(data)
+            if data is None:
+                return
+        with self._lock:
+            if self._fp is None:
+                return
+            if self._started_at is None:
+                self._started_at = record.started_at
+            line = json.dumps({
+                'offset': round(record.started_at - self._started_at, 6),
+                'data': data,
+                'status': record.status,
+                'duration': round(record.duration, 6),
+            }, separators=(',', ':'))
+            self._fp.write(line.encode('utf-8') + b'\n')
+            self.recorded_count += 1
+
+    def close(self):
+        """Stops recording, and closes the file.
+
+        The (gzipped) file is only complete after that.
+        """
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def anonymize_args(replacements):
+    """Returns an anonymizer (see :class:`RequestRecorder`) that replaces
+    the arguments of the given functions::
+
+        anonymize_args({
+            'login': lambda args: ['user', 'secret'],
+            'search': lambda args: [args[0][:3]],
+        })
+
+    Requests for those functions using a codec other than JSON
+    are not recorded (their arguments can't be replaced).
+    Out-of-band arguments are passed to the replacing function
+    along with the others, and the result is recorded inline.
+
+    :param replacements: a dictionary of function names to functions
+                         getting the (decoded) arguments list, and
+                         returning the one to record instead
+    """
+    def anonymize(data):
+        replace = replacements.get(data.get(Sijax.PARAM_REQUEST))
+        if replace is None or Sijax.PARAM_ARGS not in data:
+            return data
+        if data.get(Sijax.PARAM_CODEC, 'json') != 'json':
+            return None
+        try:
+            args = json.loads(data[Sijax.PARAM_ARGS])
+            for idx in json.loads(data.get(Sijax.PARAM_REFS, '[]')):
+                args[idx] = data[args[idx]]
+        except (ValueError, TypeError, KeyError, IndexError):
+            return None
+        data = dict((key, value) for key, value in data.items()
+                    if key != Sijax.PARAM_REFS and
+                    not key.startswith(Sijax.PARAM_ARG_PREFIX))
+        data[Sijax.PARAM_ARGS] = json.dumps(replace(args))
+        return data
+    return anonymize
+
+
+class RecordedRequest(object):
+    """A request loaded using :func:`load_requests`."""
+
+    def __init__(self, offset, data, status=None, duration=None):
+        #: When the request was made, in seconds since the first one
+        self.offset = offset
+
+        #: The request data (POST parameters)
+        self.data = data
+
+        #: The status of the recorded call
+        #: (see :class:`sijax.instrument.CallRecord`)
+        self.status = status
+
+        #: How long the recorded call took, in seconds
+        self.duration = duration
+
+    @property
+    def function_name(self):
+        return self.data.get(Sijax.PARAM_REQUEST)
+
+
+def load_requests(path):
+    """Loads the requests recorded using :class:`RequestRecorder`,
+    ordered by the time they were made."""
+    requests = []
+    with gzip.open(path, 'rb') as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            item = json.loads(line.decode('utf-8'))
+            requests.append(RecordedRequest(item['offset'], item['data'],
+                                            item.get('status'),
+                                            item.get('duration')))
+    requests.sort(key=lambda request: request.offset)
+    return requests
+
+
+class WSGITarget(object):
+    """Sends requests to a WSGI application, in-process.
+
+    :param app: the WSGI application
+    :param path: the path to send the requests to
+    """
+
+    def __init__(self, app, path='/'):
+        self.app = app
+        self.path = path
+
+    def __call__(self, data):
+        """Sends the request, returning its HTTP status code."""
+        body = urlencode(_encode_form(data)).encode('ascii')
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': self.path,
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        }
+        setup_testing_defaults(environ)
+        state = {}
+
+        def start_response(status, headers, exc_info=None):
+            state['status'] = int(status.split(' ', 1)[0])
+            return lambda chunk: None
+
+        app_iter = self.app(environ, start_response)
+        try:
+            for _ in app_iter:
+                pass
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        return state.get('status', 500)
+
+
+class HTTPTarget(object):
+    """Sends requests to a (local) HTTP server.
+
+    :param url: the URL to send the requests to
+    :param timeout: the timeout of each request, in seconds
+    """
+
+    def __init__(self, url, timeout=30):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, data):
+        """Sends the request, returning its HTTP status code."""
+        body = urlencode(_encode_form(data)).encode('ascii')
+        try:
+            response = urlopen(self.url, body, self.timeout)
+        except HTTPError as e:
+            e.close()
+            return e.code
+        try:
+            while response.read(65536):
+                pass
+        finally:
+            response.close()
+        return response.getcode()
+
+
+def _encode_form(data):
+    return [(key.encode('utf-8'), value.encode('utf-8'))
+            for key, value in sorted(data.items())]
+
+
+def _get_percentile(values, percent):
+    """Returns the percentile of the (sorted) values (nearest rank)."""
+    if not values:
+        return None
+    rank = int(math.ceil(len(values) * percent / 100.0))
+    return values[max(rank, 1) - 1]
+
+
+class ReplayReport(object):
+    """The results of :func:`replay`."""
+
+    def __init__(self, duration, latencies, errors):
+        #: How long the replay took, in seconds
+        self.duration = duration
+
+        #: The latencies of the requests, in seconds (sorted)
+        self.latencies = sorted(latencies)
+
+        #: A dictionary of errors (``status 500``, exception names, etc.)
+        #: to how many times they happened
+        self.errors = errors
+
+    @property
+    def requests_count(self):
+        return len(self.latencies)
+
+    @property
+    def errors_count(self):
+        return sum(self.errors.values())
+
+    @property
+    def throughput(self):
+        """The number of requests completed per second."""
+        if not self.duration:
+            return 0.0
+        return self.requests_count / self.duration
+
+    def get_percentile(self, percent):
+        """Returns the given latency percentile (50, 99, etc.), in seconds."""
+        return _get_percentile(self.latencies, percent)
+
+    def to_dict(self):
+        return {
+            'requests': self.requests_count,
+            'errors': dict(self.errors),
+            'duration': self.duration,
+            'throughput': self.throughput,
+            'latency': dict(('p%s' % percent, self.get_percentile(percent))
+                            for percent in (50, 90, 99, 100)),
+        }
+
+    def format(self):
+        """Returns the report, for humans."""
+        lines = ['Requests:   %d in %.2f s (%.1f/s)' % (
+            self.requests_count, self.duration, self.throughput)]
+        if self.latencies:
+            lines.append('Latency:    ' + ', '.join(
+                '%s %.2f ms' % (label, self.get_percentile(percent) * 1e3)
+                for label, percent in (('p50', 50), ('p90', 90),
+                                       ('p99', 99), ('max', 100))))
+        lines.append('Errors:     %d' % self.errors_count)
+        for error, count in sorted(self.errors.items()):
+            lines.append('  %-30s %d' % (error, count))
+        return '\n'.join(lines)
+
+
+def _schedule(requests, count, rate, speed):
+    """Yields (request, seconds after the start to send it at - or None,
+    to send it right away) tuples."""
+    span = requests[-1].offset - requests[0].offset
+    if span > 0:
+        # Leave a gap (the average one) between the last request
+        # of a round and the first request of the next one
+        span += span / max(len(requests) - 1, 1)
+    for idx in range(count):
+        request = requests[idx % len(requests)]
+        if rate:
+            yield request, idx / float(rate)
+        elif speed:
+            rounds = idx // len(requests)
+            offset = request.offset - requests[0].offset + rounds * span
+            yield request, offset / float(speed)
+        else:
+            yield request, None
+
+
+def replay(target, requests, concurrency=1, rate=None, count=None, speed=None):
+    """Replays the requests (see :func:`load_requests`) against the target,
+    from ``concurrency`` threads, returning a :class:`ReplayReport`::
+
+        requests = load_requests('requests.ndjson.gz')
+        report = replay(WSGITarget(app), requests, concurrency=8, rate=200)
+        print(report.format())
+
+    Requests are sent as fast as possible, unless paced by ``rate``
+    or ``speed``. When they're paced, latencies are measured from the
+    time each request should have been sent at, so that a slow server
+    (which delays the requests after it) shows up in the percentiles.
+
+    :param target: a function sending a request (data dictionary),
+                   returning its HTTP status code
+                   (:class:`WSGITarget` or :class:`HTTPTarget`)
+    :param concurrency: the number of requests in flight (threads)
+    :param rate: the number of requests to send per second
+    :param count: the number of requests to send (the recorded requests
+                  are replayed in a loop, if that's more than were recorded)
+    :param speed: replay the requests at the pace they were recorded,
+                  this many times faster (ignored if ``rate`` is given)
+    """
+    if not requests:
+        return ReplayReport(0.0, [], {})
+    if count is None:
+        count = len(requests)
+
+    jobs = queue.Queue()
+    for job in _schedule(requests, count, rate, speed):
+        jobs.put(job)
+
+    latencies, errors = [], {}
+    lock = threading.Lock()
+    started = clock()
+
+    def work():
+        while True:
+            try:
+                request, send_at = jobs.get_nowait()
+            except queue.Empty:
+                return
+            if send_at is None:
+                sent = clock()
+            else:
+                sent = started + send_at
+                delay = sent - clock()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                status = target(request.data)
+                error = None if status < 400 else 'status %d' % status
+            except Exception as e:
+                # Connection errors, timeouts, or errors of the application
+                error = e.__class__.__name__
+            latency = clock() - sent
+            with lock:
+                latencies.append(latency)
+                if error is not None:
+                    errors[error] = errors.get(error, 0) + 1
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return ReplayReport(clock() - started, latencies, errors)
+
+
+def _load_app(spec):
+    """Imports a WSGI application, given as ``module:name``."""
+    module_name, _, name = spec.partition(':')
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name or 'application')
+
+
+def main(argv=None):
+    """The command line interface (``python -m sijax.loadtest``)."""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m sijax.loadtest',
+                                     description='Replays recorded Sijax requests.')
+    parser.add_argument('path', help='the recorded requests file')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='send the requests to this (local) server')
+    target.add_argument('--app', metavar='MODULE:NAME',
+                        help='send the requests to this WSGI application, in-process')
+    parser.add_argument('--path-info', default='/',
+                        help='the path to send requests to (with --app)')
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+                        help='the number of requests in flight')
+    parser.add_argument('-r', '--rate', type=float,
+                        help='the number of requests to send per second')
+    parser.add_argument('-n', '--count', type=int,
+                        help='the number of requests to send')
+    parser.add_argument('-s', '--speed', type=float,
+                        help='replay at the recorded pace, this many times faster')
+    parser.add_argument('-o', '--output', help='save the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    if args.url:
+        send = HTTPTarget(args.url)
+    else:
+        send = WSGITarget(_load_app(args.app), args.path_info)
+    requests = load_requests(args.path)
+    report = replay(send, requests, args.concurrency, args.rate, args.count,
+                    args.speed)
+    print(report.format())
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(report.to_dict(), indent=2, sort_keys=True))
+    return 1 if report.errors_count else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.metrics
+    ~~~~~~~~~~~~~
+
+    Provides a metrics registry, collecting per-function call counts,
+    errors, payload sizes and latencies, and exposing them in the
+    Prometheus text format.
+
+    The registry is an observer (see :mod:`sijax.instrument`),
+    so nothing is collected for Sijax instances it isn't tracking.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import threading
+
+from .instrument import (CallRecord, Histogram, Observer)
+
+
+class _FunctionMetrics(object):
+
+    def __init__(self, latency_buckets, size_buckets):
+        # status => count
+        self.calls = {}
+        self.commands = 0
+        self.latency = Histogram(latency_buckets)
+        self.request_size = Histogram(size_buckets)
+        self.response_size = Histogram(size_buckets)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+
+class MetricsRegistry(Observer):
+    """Collects metrics about the calls of the Sijax instances
+    it tracks::
+
+        registry = MetricsRegistry()
+
+        # for every request (Sijax instance)
+        registry.track(sijax_instance)
+
+        # in whatever view serves the metrics
+        return registry.render_prometheus(), 200, {
+            'Content-Type': MetricsRegistry.CONTENT_TYPE}
+
+    For every function, it keeps:
+
+    - call counts, by status (see the ``STATUS_*`` constants of
+      :class:`sijax.instrument.CallRecord`), which include errors,
+      invalid requests and invalid calls
+    - the number of commands sent to the browser
+    - histograms of the call latency and of the request and response
+      payload sizes
+
+    Calls to unknown functions are counted under the :attr:`UNKNOWN`
+    function name, so that clients can't make the registry grow
+    without limits. The same goes for calls made using
+    :meth:`sijax.Sijax.execute_callback` directly.
+
+    Updating the registry takes a single (short) lock per call.
+
+    :param prefix: the prefix of the metric names
+    :param latency_buckets: the latency histogram buckets (in seconds)
+    :param size_buckets: the payload size histogram buckets (in bytes)
+    """
+
+    #: The content type of :meth:`render_prometheus` output
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    #: The function name that calls to unknown functions are counted under
+    UNKNOWN = '<unknown>'
+
+    DEFAULT_SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536,
+                            262144, 1048576)
+
+    def __init__(self, prefix='sijax_', latency_buckets=None,
+                 size_buckets=None):
+        if size_buckets is None:
+            size_buckets = self.__class__.DEFAULT_SIZE_BUCKETS
+        self.prefix = prefix
+        self._latency_buckets = latency_buckets
+        self._size_buckets = size_buckets
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def _get_function(self, name):
+        metrics = self._functions.get(name)
+        if metrics is None:
+            metrics = _FunctionMetrics(self._latency_buckets, self._size_buckets)
+            self._functions[name] = metrics
+        return metrics
+
+    def track(self, sijax_instance):
+        """Starts collecting metrics for the calls to the given
+        Sijax instance.
+
+        The functions registered with it so far are reported
+        (with zero counts) even before they get called.
+        """
+        with self._lock:
+            for name in sijax_instance._callbacks:
+                self._get_function(name)
+        if self not in sijax_instance._observers:
+            sijax_instance.add_observer(self)
+        return self
+
+    def observe(self, record):
+        name = record.function_name
+        if name is None or record.status == CallRecord.STATUS_INVALID_REQUEST:
+            name = self.__class__.UNKNOWN
+        with self._lock:
+            metrics = self._get_function(name)
+            metrics.calls[record.status] = metrics.calls.get(record.status, 0) + 1
+            metrics.commands += record.commands_count
+            metrics.latency.observe(record.duration)
+            metrics.request_size.observe(record.request_size)
+            metrics.response_size.observe(record.response_size)
+
+    def get_calls_count(self, function_name, status=None):
+        """Returns the number of calls of the given function
+        (with the given status, or with any status if None)."""
+        with self._lock:
+            metrics = self._functions.get(function_name)
+            if metrics is None:
+                return 0
+            if status is None:
+                return sum(metrics.calls.values())
+            return metrics.calls.get(status, 0)
+
+    def _render_histogram(self, lines, name, labels, histogram):
+        for bound, count in histogram.get_buckets():
+            lines.append('%s_bucket{%s,le="%s"} %s' % (
+                name, labels, _format_value(bound), _format_value(count)))
+        lines.append('%s_sum{%s} %s' % (name, labels,
+                                        _format_value(float(histogram.sum))))
+        lines.append('%s_count{%s} %s' % (name, labels,
+                                          _format_value(histogram.count)))
+
+    def render_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format
+        (see :attr:`CONTENT_TYPE`)."""
+        prefix = self.prefix
+        statuses = (CallRecord.STATUS_OK, CallRecord.STATUS_ERROR,
+                    CallRecord.STATUS_INVALID_REQUEST,
+                    CallRecord.STATUS_INVALID_CALL)
+        calls, commands, latency, request_size, response_size = [], [], [], [], []
+
+        with self._lock:
+            for name in sorted(self._functions):
+                metrics = self._functions[name]
+                labels = 'function="%s"' % _escape(name)
+                for status in statuses:
+                    count = metrics.calls.get(status, 0)
+                    if count == 0 and status == CallRecord.STATUS_INVALID_REQUEST:
+                        continue
+                    calls.append('%scalls_total{%s,status="%s"} %d' % (
+                        prefix, labels, status, count))
+                commands.append('%scommands_total{%s} %d' % (
+                    prefix, labels, metrics.commands))
+                self._render_histogram(latency, '%scall_duration_seconds' % prefix,
+                                       labels, metrics.latency)
+                self._render_histogram(request_size, '%srequest_size_bytes' % prefix,
+                                       labels, metrics.request_size)
+                self._render_histogram(response_size, '%sresponse_size_bytes' % prefix,
+                                       labels, metrics.response_size)
+
+        lines = []
+        for name, kind, help_text, samples in (
+                ('calls_total', 'counter', 'Calls, by function and status.', calls),
+                ('commands_total', 'counter', 'Commands sent to the browser.', commands),
+                ('call_duration_seconds', 'histogram', 'Call latency.', latency),
+                ('request_size_bytes', 'histogram', 'Size of the call arguments.',
+                 request_size),
+                ('response_size_bytes', 'histogram', 'Size of the responses.',
+                 response_size)):
+            lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+#: The registry used by :func:`render_prometheus` by default
+default_registry = MetricsRegistry()
+
+
+def render_prometheus(registry=None):
+    """Returns the metrics of the given registry (or of
+    :data:`default_registry`) in the Prometheus text format."""
+    if registry is None:
+        registry = default_registry
+    return registry.render_prometheus()
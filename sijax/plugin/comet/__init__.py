@@ -7,15 +7,22 @@ from __future__ import (absolute_import, unicode_literals)
     ~~~~~~~~~~~~~~~~~~
 
     Provides helpers to register Comet functions,
-    and the :class:`sijax.plugin.comet.CometResponse` class
-    used instead of :class:`sijax.response.BaseResponse`.
+    the :class:`sijax.plugin.comet.CometResponse` class
+    used instead of :class:`sijax.response.BaseResponse`,
+    and a publish/subscribe hub (:class:`sijax.plugin.comet.Hub`).
 
     :copyright: (c) 2011 by Slavi Pantaleev.
     :license: BSD, see LICENSE.txt for more details.
 """
 
 
+from types import GeneratorType
+
 from ...response import StreamingIframeResponse
+from .hub import (Hub, Message, Subscription)
+from .backend import (BroadcastBackend, UnixSocketBackend, RedisBackend)
+from .scheduler import (Scheduler, SchedulingHint, Sleep, Wait, is_scheduled)
+from .history import (History, LongPollResponse, register_long_poll_callback)
 
 
 def _prepare_options(sijax_instance, options):
@@ -72,4 +79,60 @@ class CometResponse(StreamingIframeResponse):
     This class extends :class:`sijax.response.BaseResponse` and
     every available method from it works here too.
     """
-    pass
+
+    def sleep(self, seconds):
+        """Returns a hint to ``yield``, instead of calling ``time.sleep()``::
+
+            def comet_handler(obj_response):
+                for i in range(10):
+                    obj_response.html('#counter', i)
+                    yield obj_response.sleep(1)
+
+        Yielding it flushes the commands queued so far, like yielding
+        ``obj_response`` does. It then blocks for the given number of
+        seconds, unless the stream is driven by
+        a :class:`sijax.plugin.comet.Scheduler`, which resumes the
+        function later, serving other streams in the meantime.
+        """
+        return Sleep(seconds)
+
+    def wait(self, subscription, timeout=None):
+        """Returns a hint to ``yield``, to wait for messages
+        on the given :class:`sijax.plugin.comet.Subscription`::
+
+            def comet_handler(obj_response):
+                with hub.subscribe('prices', obj_response) as subscription:
+                    while not subscription.is_closed:
+                        yield obj_response.wait(subscription, timeout=30)
+
+        The received messages get sent on the next flush.
+        See :meth:`sleep` for how waiting works.
+        """
+        return Wait(subscription, timeout)
+
+    def _process_callback(self, callback, args):
+        """Processes a callback to a normal or a streaming function,
+        like :meth:`sijax.response.StreamingIframeResponse._process_callback`
+        does, also handling the scheduling hints yielded by the function.
+
+        Hints are passed on to the scheduler (if any), or block otherwise.
+        """
+        response = self._perform_handler_call(callback, args)
+        if not isinstance(response, GeneratorType):
+            for chunk in self._drain():
+                yield chunk
+            return
+
+        for value in response:
+            for chunk in self._drain():
+                yield chunk
+            if isinstance(value, SchedulingHint):
+                if is_scheduled():
+                    yield value
+                else:
+                    value.block()
+
+    def _encode_chunk(self, chunk):
+        if isinstance(chunk, SchedulingHint):
+            return chunk
+        return StreamingIframeResponse._encode_chunk(self, chunk)
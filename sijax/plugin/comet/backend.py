@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.plugin.comet.backend
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Provides broadcast backends, which deliver the messages published
+    to a :class:`sijax.plugin.comet.Hub` to the hubs of other processes.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import errno
+import os
+import socket
+import threading
+import uuid
+
+from ...helper import json
+from ...exception import SijaxError
+
+
+class BroadcastBackend(object):
+    """The base broadcast backend, which doesn't broadcast anything.
+
+    It's what hubs use by default, which is enough when there's
+    a single process. Other backends deliver messages to the hubs of
+    other processes (the publishing hub delivers to its own subscribers
+    directly, without going through the backend).
+
+    Backends need to implement :meth:`publish`, and call
+    :meth:`_receive` with the data published by other processes.
+    """
+
+    def __init__(self):
+        #: Identifies this backend, so that it can ignore
+        #: the messages it published itself
+        self.origin = uuid.uuid4().hex
+        self._deliver = None
+
+    def start(self, deliver):
+        """Starts receiving messages, passing them to ``deliver``.
+
+        :param deliver: a function, called with the channel name
+                        and a :class:`sijax.plugin.comet.Message`
+        """
+        self._deliver = deliver
+
+    def publish(self, channel, message):
+        """Sends the message to the other processes."""
+        pass
+
+    def close(self):
+        """Stops receiving messages and releases any resources."""
+        pass
+
+    def _encode(self, channel, message):
+        data = {'o': self.origin, 'c': channel, 'm': message._commands,
+                'k': message._keyed_commands}
+        return message.dumps(data).encode('utf-8')
+
+    def _receive(self, data):
+        """Delivers the (encoded) message, unless it was published
+        by this same backend, or it's malformed.
+
+        The data may be given as bytes or (already decoded) text.
+        """
+        from .hub import Message
+
+        try:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            data = json.loads(data)
+            origin, channel, commands = data['o'], data['c'], data['m']
+            keyed_commands = data.get('k') or {}
+        except (ValueError, KeyError, TypeError):
+            return
+        if origin == self.origin or self._deliver is None:
+            return
+        self._deliver(channel, Message(commands, keyed_commands))
+
+
+class UnixSocketBackend(BroadcastBackend):
+    """Broadcasts messages between processes on the same machine,
+    using Unix domain (datagram) sockets.
+
+    Each process binds a socket in the given directory,
+    and messages are sent to all the sockets found there.
+    Sockets left behind by processes that are gone get removed.
+
+    If the receiving side can't keep up (its socket buffer is full),
+    messages are dropped instead of blocking the publisher.
+
+    :param directory: a directory shared by all the processes
+    """
+
+    #: The maximum size of an encoded message, in bytes
+    MAX_MESSAGE_SIZE = 64 * 1024
+
+    #: How often (in seconds) the receiving thread checks whether
+    #: the backend was closed
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, directory):
+        BroadcastBackend.__init__(self)
+        self.directory = directory
+        self._path = os.path.join(directory, '%s.sock' % self.origin)
+        self._receiver = None
+        self._sender = None
+        self._is_closed = False
+        self._lock = threading.Lock()
+
+        #: How many messages couldn't be delivered, because the
+        #: receiving process wasn't keeping up
+        self.dropped_count = 0
+
+    def start(self, deliver):
+        BroadcastBackend.start(self, deliver)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self._receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._receiver.bind(self._path)
+        self._receiver.settimeout(self.__class__.POLL_INTERVAL)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+
+        thread = threading.Thread(target=self._receive_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _receive_loop(self):
+        max_size = self.__class__.MAX_MESSAGE_SIZE
+        while not self._is_closed:
+            try:
+                data = self._receiver.recv(max_size)
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                if self._is_closed:
+                    return
+                continue
+            self._receive(data)
+
+    def publish(self, channel, message):
+        data = self._encode(channel, message)
+        if len(data) > self.__class__.MAX_MESSAGE_SIZE:
+            raise SijaxError('The message is larger than %d bytes' %
+                             self.__class__.MAX_MESSAGE_SIZE)
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.sock') or path == self._path:
+                continue
+            try:
+                self._sender.sendto(data, path)
+            except (socket.error, OSError) as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # Left behind by a process that's gone
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    # Hubs may publish from several threads at once
+                    with self._lock:
+                        self.dropped_count += 1
+                else:
+                    raise
+
+    def close(self):
+        self._is_closed = True
+        for sock in (self._receiver, self._sender):
+            if sock is not None:
+                sock.close()
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+
+class RedisBackend(BroadcastBackend):
+    """Broadcasts messages between processes (on any machine),
+    using Redis pub/sub.
+
+    The backend works with a ``redis.Redis`` client object
+    (from the ``redis`` library), or anything with the same
+    ``publish()`` and ``pubsub()`` methods. Clients created with
+    ``decode_responses=True`` work as well::
+
+        import redis
+
+        hub = Hub(backend=RedisBackend(redis.Redis()))
+
+    :param client: the Redis client object
+    :param prefix: the prefix of the Redis channels to use
+    """
+
+    def __init__(self, client, prefix='sijax:'):
+        BroadcastBackend.__init__(self)
+        self._client = client
+        self._prefix = prefix
+        self._pubsub = None
+        self._is_closed = False
+
+    def start(self, deliver):
+        BroadcastBackend.start(self, deliver)
+        self._pubsub = self._client.pubsub()
+        self._pubsub.psubscribe('%s*' % self._prefix)
+
+        thread = threading.Thread(target=self._receive_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _receive_loop(self):
+        for item in self._pubsub.listen():
+            if self._is_closed:
+                return
+            if item['type'] in ('message', 'pmessage'):
+                self._receive(item['data'])
+
+    def publish(self, channel, message):
+        self._client.publish('%s%s' % (self._prefix, channel),
+                             self._encode(channel, message))
+
+    def close(self):
+        self._is_closed = True
+        if self._pubsub is not None:
+            self._pubsub.punsubscribe()
+            self._pubsub.close()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.plugin.comet.history
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Provides a per-channel history of published messages,
+    and a long-polling transport built on top of it.
+
+    Browsers that get disconnected (by proxies cutting long requests,
+    for example) reconnect with the cursor of the last message they've
+    seen and get everything they missed in one response.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import threading
+import time
+import uuid
+from collections import (deque, OrderedDict)
+
+from six import string_types
+
+from ...helper import json
+from ...instrument import get_size
+from ...response import BaseResponse
+
+
+class History(object):
+    """Keeps the recently published messages of each channel
+    (in a ring buffer), numbered by sequence numbers.
+
+    Pass it to a :class:`sijax.plugin.comet.Hub`, which adds
+    every message it delivers::
+
+        hub = Hub(history=History(max_bytes=512 * 1024, max_age=120))
+
+    Cursors (``<epoch>:<sequence number>``) tell where a browser is.
+    The epoch changes when the process restarts, so cursors from
+    another process (or from before a restart) are detected as invalid,
+    just like cursors pointing to messages evicted from the buffer.
+
+    Messages are kept serialized (as JSON lists of commands), which is
+    how they're measured and (usually) sent to browsers as well.
+
+    :param max_bytes: the maximum size of the (serialized) messages
+                      to keep for each channel
+    :param max_age: the maximum age (in seconds) of the messages to keep
+    """
+
+    #: How often (in seconds) the channels that nothing gets published
+    #: to anymore are checked for expired messages
+    PRUNE_INTERVAL = 10
+
+    #: How many of the forgotten channels (whose messages all expired)
+    #: to remember the last evicted message of, so that browsers behind it
+    #: still get reset
+    MAX_FORGOTTEN_CHANNELS = 10000
+
+    def __init__(self, max_bytes=1024 * 1024, max_age=300):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.epoch = uuid.uuid4().hex[:8]
+        # Sequence numbers are shared by all channels, so that channels
+        # can be forgotten (once their messages expire) without them
+        # ever getting reused
+        self._last_seq = 0
+        # channel => deque of (sequence number, time, size, serialized message)
+        self._entries = {}
+        self._sizes = {}
+        # channel => the sequence number of the last evicted message
+        # (cursors behind it missed some of the channel's messages)
+        self._evicted_seq = {}
+        # The same, for the channels that were forgotten (oldest first)
+        self._forgotten_seq = OrderedDict()
+        self._next_prune = 0
+        self._condition = threading.Condition()
+
+    def append(self, channel, message):
+        """Adds the message to the channel's history,
+        returning its sequence number."""
+        batch = message.dumps(message._commands)
+        size = get_size(batch)
+        now = time.time()
+        with self._condition:
+            self._last_seq += 1
+            seq = self._last_seq
+            if channel not in self._entries:
+                self._entries[channel] = deque()
+                self._sizes[channel] = 0
+                self._evicted_seq[channel] = self._forgotten_seq.pop(channel, 0)
+            self._entries[channel].append((seq, now, size, batch))
+            self._sizes[channel] += size
+            self._evict(channel, now)
+            if now >= self._next_prune:
+                for other_channel in list(self._entries):
+                    self._evict(other_channel, now)
+                self._next_prune = now + self.__class__.PRUNE_INTERVAL
+            self._condition.notify_all()
+        return seq
+
+    def _evict(self, channel, now):
+        entries = self._entries.get(channel)
+        if not entries:
+            return
+        oldest_allowed = now - self.max_age
+        while entries and (self._sizes[channel] > self.max_bytes or
+                           entries[0][1] < oldest_allowed):
+            seq, _, size, _ = entries.popleft()
+            self._sizes[channel] -= size
+            self._evicted_seq[channel] = seq
+        if not entries:
+            self._forget(channel)
+
+    def _forget(self, channel):
+        """Forgets the channel (all of its messages expired),
+        remembering only its last evicted message (see get_since)."""
+        forgotten_seq = self._forgotten_seq
+        forgotten_seq[channel] = self._evicted_seq.pop(channel)
+        while len(forgotten_seq) > self.__class__.MAX_FORGOTTEN_CHANNELS:
+            forgotten_seq.popitem(last=False)
+        del self._entries[channel]
+        del self._sizes[channel]
+
+    def get_size(self, channel):
+        """Returns the size (in bytes) of the channel's history."""
+        with self._condition:
+            return self._sizes.get(channel, 0)
+
+    def get_cursor(self, channel):
+        """Returns the cursor pointing after the latest message."""
+        with self._condition:
+            return '%s:%d' % (self.epoch, self._last_seq)
+
+    def _parse_cursor(self, cursor):
+        if not isinstance(cursor, string_types):
+            return None
+        epoch, _, seq = cursor.partition(':')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def get_since(self, channel, cursor):
+        """Returns the messages published after the given cursor.
+
+        :return: a tuple of (messages list, new cursor, is_complete),
+                 where the messages are serialized (JSON lists of commands),
+                 where ``is_complete`` is False if the cursor is invalid,
+                 or if some of the messages after it were evicted
+                 (in which case no messages are returned)
+        """
+        since = self._parse_cursor(cursor)
+        with self._condition:
+            self._evict(channel, time.time())
+            new_cursor = '%s:%d' % (self.epoch, self._last_seq)
+            if since is None or since > self._last_seq:
+                return [], new_cursor, False
+
+            evicted_seq = self._evicted_seq.get(channel)
+            if evicted_seq is None:
+                evicted_seq = self._forgotten_seq.get(channel, 0)
+            if since < evicted_seq:
+                return [], new_cursor, False
+
+            entries = self._entries.get(channel, ())
+
+            batches = [entry[3] for entry in entries if entry[0] > since]
+            return batches, new_cursor, True
+
+    def wait(self, channel, cursor, timeout):
+        """Like :meth:`get_since`, but waits (up to ``timeout`` seconds)
+        for messages to be published, if there are none."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                result = self.get_since(channel, cursor)
+                if result[0] or not result[2]:
+                    return result
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return result
+                self._condition.wait(remaining)
+
+
+class LongPollResponse(BaseResponse):
+    """The response of long-polling functions
+    (see :func:`register_long_poll_callback`).
+
+    The messages kept by a :class:`History` are already serialized.
+    They are sent as they are, unless the browser asked for another
+    format or codec, in which case they're decoded first.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # (index in the commands buffer, serialized commands list)
+        self._batches = []
+        BaseResponse.__init__(self, *args, **kwargs)
+
+    def _add_batch(self, batch):
+        """Adds a serialized list of commands, after the queued commands."""
+        self._batches.append((len(self._commands), batch))
+        return self
+
+    def clear_commands(self):
+        BaseResponse.clear_commands(self)
+        self._batches = []
+        return self
+
+    def _serialize(self):
+        if not self._batches:
+            return BaseResponse._serialize(self)
+
+        sijax = self._sijax
+        if sijax is not None and (sijax.codec.is_binary or
+                                  sijax.response_format == sijax.FORMAT_COMPACT):
+            commands = []
+            previous = 0
+            for idx, batch in self._batches:
+                commands.extend(self._commands[previous:idx])
+                commands.extend(json.loads(batch))
+                previous = idx
+            commands.extend(self._commands[previous:])
+            self._commands, self._batches = commands, []
+            return BaseResponse._serialize(self)
+
+        # Splices the batches into the JSON list of commands
+        pieces = []
+        previous = 0
+        for idx, batch in self._batches:
+            pieces.extend(self.dumps(command)
+                          for command in self._commands[previous:idx])
+            batch = batch.strip()[1:-1].strip()
+            if batch:
+                pieces.append(batch)
+            previous = idx
+        pieces.extend(self.dumps(command) for command in self._commands[previous:])
+        return '[%s]' % self.JSON_SEPARATORS[0].join(pieces)
+
+
+def register_long_poll_callback(sijax_instance, public_name, hub, channel,
+                                timeout=25, **options):
+    """Registers a regular Sijax function, which lets browsers
+    receive the messages published to a channel, using long-polling.
+
+    This works through proxies that cut long requests (which break
+    Comet streams), but needs the hub to keep a history
+    (see :class:`History`). The browser starts polling using::
+
+        sjxComet.poll('public_name');
+
+    Every request waits (up to ``timeout`` seconds) for messages
+    published after the last one the browser has seen, so messages
+    published while it was reconnecting are not lost.
+    If that's not possible (the messages were evicted from the history),
+    the ``sjxComet:reset`` event is triggered on the document instead,
+    so that the page can reload its state.
+
+    Waiting blocks the current thread.
+
+    :param sijax_instance: the :class:`sijax.Sijax` instance
+                           to register callbacks with
+    :param public_name: the name of the function that the browser calls
+    :param hub: the :class:`sijax.plugin.comet.Hub` to get messages from
+    :param channel: the name of the channel
+    :param timeout: how long to wait for messages
+    :param options: options to pass to :meth:`sijax.Sijax.register_callback`
+                    (the response class defaults to :class:`LongPollResponse`)
+    """
+    def handler(obj_response, cursor):
+        if cursor is None:
+            # Starting - only messages published from now on are needed
+            cursor = hub.history.get_cursor(channel)
+
+        batches, cursor, is_complete = hub.history.wait(channel, cursor, timeout)
+        if not is_complete:
+            obj_response.call('sjxComet.pollReset', [public_name])
+        for batch in batches:
+            if isinstance(obj_response, LongPollResponse):
+                obj_response._add_batch(batch)
+            else:
+                obj_response._commands.extend(json.loads(batch))
+        obj_response.call('sjxComet.pollCursor', [public_name, cursor])
+
+    options.setdefault(sijax_instance.__class__.PARAM_RESPONSE_CLASS,
+                       LongPollResponse)
+    sijax_instance.register_callback(public_name, handler, **options)
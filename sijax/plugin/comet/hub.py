@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.plugin.comet.hub
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Provides a publish/subscribe hub for Comet functions.
+
+    Instead of every Comet connection polling the same data source,
+    a single producer publishes messages to a named channel, and all the
+    Comet functions subscribed to it receive them.
+    Each message is serialized once (per response format), and the
+    resulting bytes are shared by all subscribers.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import threading
+import time
+from collections import deque
+
+from ...response import BaseResponse
+from .backend import BroadcastBackend
+
+
+class Message(BaseResponse):
+    """A list of commands to publish to a channel.
+
+    Commands are added the same way they're added to ``obj_response``::
+
+        message = Message()
+        message.html('#price', '10.50')
+        hub.publish('prices', message)
+
+    A message must not be modified after it's been published,
+    because it gets serialized only once and then shared.
+
+    :param commands: the initial list of commands
+    """
+
+    def __init__(self, commands=None, keyed_commands=None):
+        BaseResponse.__init__(self, None, [])
+        if commands is not None:
+            self._commands = commands
+        if keyed_commands is not None:
+            self._keyed_commands = keyed_commands
+        self._frames = {}
+        self._frames_lock = threading.Lock()
+
+    def get_frame(self, obj_response):
+        """Returns the message framed and encoded for the given
+        streaming response object (bytes), serializing it only
+        the first time it's needed for that kind of response
+        (class, format and framing)."""
+        key = obj_response._get_frame_key()
+        try:
+            return self._frames[key]
+        except KeyError:
+            pass
+
+        with self._frames_lock:
+            if key not in self._frames:
+                payload = obj_response._get_commands_payload(self._commands)
+                frame = obj_response._frame(obj_response.dumps(payload))
+                self._frames[key] = frame.encode('utf-8')
+            return self._frames[key]
+
+    @classmethod
+    def merge(cls, messages):
+        """Merges the given messages into a new one.
+
+        Commands having a ``key`` supersede the earlier commands with
+        the same key, so the merged message may contain fewer commands.
+        """
+        merged = cls()
+        for message in messages:
+            keys = dict((idx, key) for key, idx in message._keyed_commands.items())
+            for idx, command in enumerate(message._commands):
+                merged._add_command(command['type'], dict(command), keys.get(idx))
+        return merged
+
+
+class Subscription(object):
+    """A subscription of a Comet response to a channel.
+
+    Messages are kept in a bounded queue, until the Comet function
+    gets to send them. What happens when the queue fills up
+    (the browser is too slow) depends on the overflow policy
+    (see :class:`Hub`).
+
+    Iterating over a subscription pushes the received messages
+    to the response and pauses, so that they can be flushed::
+
+        def comet_handler(obj_response):
+            with hub.subscribe('prices', obj_response) as subscription:
+                for _ in subscription:
+                    yield obj_response
+
+    Instances are created using :meth:`Hub.subscribe`.
+    """
+
+    def __init__(self, hub, channel, obj_response, queue_size, timeout,
+                 overflow, block_timeout):
+        self._hub = hub
+        self.channel = channel
+        self._obj_response = obj_response
+        self._queue = deque()
+        self._queue_size = queue_size
+        self._timeout = timeout
+        self._overflow = overflow
+        self._block_timeout = block_timeout
+        self._condition = threading.Condition()
+        self._is_closed = False
+        # Called (once) when a message arrives (see Scheduler)
+        self._waiter = None
+
+        #: How many messages were dropped, because the queue was full
+        self.dropped_count = 0
+
+        #: How many commands were superseded by newer ones,
+        #: while merging queued messages
+        self.merged_count = 0
+
+        #: How many times publishing had to wait for the queue
+        self.blocked_count = 0
+
+    @property
+    def is_closed(self):
+        return self._is_closed
+
+    def _make_room(self, message):
+        """Makes room for the new message in the full queue, according to
+        the overflow policy, returning the message to queue and the
+        counters that were increased, as a list of (name, value) tuples.
+
+        Must be called with the condition held, which guards the counters
+        (many publishers and backend threads may deliver at once).
+        """
+        overflow = self._overflow
+        if overflow == Hub.OVERFLOW_MERGE:
+            merged = Message.merge(list(self._queue) + [message])
+            self._queue.clear()
+            self.merged_count += merged.superseded_count
+            return merged, [('merged', merged.superseded_count)]
+
+        counts = []
+        if overflow == Hub.OVERFLOW_BLOCK:
+            self.blocked_count += 1
+            counts.append(('blocked', 1))
+            deadline = time.time() + self._block_timeout
+            while len(self._queue) >= self._queue_size and not self._is_closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if len(self._queue) < self._queue_size:
+                return message, counts
+
+        self._queue.popleft()
+        self.dropped_count += 1
+        counts.append(('dropped', 1))
+        return message, counts
+
+    def _put(self, message):
+        counts = ()
+        with self._condition:
+            if len(self._queue) >= self._queue_size:
+                message, counts = self._make_room(message)
+            self._queue.append(message)
+            self._condition.notify_all()
+            waiter, self._waiter = self._waiter, None
+        for name, value in counts:
+            self._hub._count(name, value)
+        if waiter is not None:
+            waiter()
+
+    def get_stats(self):
+        """Returns the ``dropped``, ``merged`` and ``blocked`` counters
+        of the subscription, read together (see :meth:`Hub.get_stats`)."""
+        with self._condition:
+            return {'dropped': self.dropped_count,
+                    'merged': self.merged_count,
+                    'blocked': self.blocked_count}
+
+    def _set_waiter(self, waiter):
+        """Makes ``waiter`` get called when a message arrives
+        (or right away, if there already are queued messages)."""
+        with self._condition:
+            if not self._queue and not self._is_closed:
+                self._waiter = waiter
+                return
+        waiter()
+
+    def _wait(self, timeout):
+        """Waits (up to ``timeout`` seconds, or forever if None)
+        for messages to arrive."""
+        with self._condition:
+            if timeout is None:
+                while not self._queue and not self._is_closed:
+                    self._condition.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self._queue and not self._is_closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+    def _push_pending(self):
+        """Pushes the queued messages to the response,
+        returning how many were pushed.
+
+        Messages that don't fit in the response's outbox (see
+        :attr:`sijax.response.StreamingIframeResponse.MAX_OUTBOX_BYTES`)
+        stay queued, until the function yields and they get sent.
+        """
+        obj_response = self._obj_response
+        with self._condition:
+            messages = list(self._queue)
+            self._queue.clear()
+            # Publishers may be waiting for room in the queue
+            self._condition.notify_all()
+        for idx, message in enumerate(messages):
+            frame = message.get_frame(obj_response)
+            if not obj_response._has_room(len(frame)):
+                self._requeue(messages[idx:])
+                return idx
+            obj_response.push_frame(frame)
+        return len(messages)
+
+    def _requeue(self, messages):
+        """Puts messages back in front of the queue, applying the overflow
+        policy if newer messages have filled it up in the meantime
+        (the oldest messages are dropped, unless merging)."""
+        counts = []
+        with self._condition:
+            queue = self._queue
+            queue.extendleft(reversed(messages))
+            excess = len(queue) - self._queue_size
+            if excess > 0:
+                if self._overflow == Hub.OVERFLOW_MERGE:
+                    merged = Message.merge(list(queue))
+                    queue.clear()
+                    queue.append(merged)
+                    self.merged_count += merged.superseded_count
+                    counts.append(('merged', merged.superseded_count))
+                else:
+                    for _ in range(excess):
+                        queue.popleft()
+                    self.dropped_count += excess
+                    counts.append(('dropped', excess))
+        for name, value in counts:
+            self._hub._count(name, value)
+
+    def __iter__(self):
+        """Waits for messages, pushes them to the response and pauses.
+
+        It also pauses when the timeout (given to :meth:`Hub.subscribe`)
+        passes without any messages arriving, so that the function can
+        do other things in the meantime (like checking whether it's
+        still needed).
+        The iteration stops when the subscription is closed.
+
+        Waiting blocks the current thread. To serve many subscribers
+        from a single thread, use ``obj_response.wait()`` with
+        a :class:`sijax.plugin.comet.Scheduler` instead.
+        """
+        try:
+            while not self._is_closed:
+                self._wait(self._timeout)
+                self._push_pending()
+                yield self
+        finally:
+            self.close()
+
+    def close(self):
+        """Unsubscribes from the channel."""
+        with self._condition:
+            if self._is_closed:
+                return
+            self._is_closed = True
+            self._condition.notify_all()
+            waiter, self._waiter = self._waiter, None
+        self._hub._unsubscribe(self)
+        if waiter is not None:
+            waiter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Hub(object):
+    """A publish/subscribe hub with named channels.
+
+    A typical setup has a single (application-wide) hub,
+    a producer publishing messages (from a background thread or from
+    regular Sijax functions) and Comet functions subscribing to channels::
+
+        hub = Hub()
+
+        def comet_handler(obj_response):
+            with hub.subscribe('prices', obj_response) as subscription:
+                for _ in subscription:
+                    yield obj_response
+
+        def producer():
+            while True:
+                message = Message()
+                message.html('#price', get_price())
+                hub.publish('prices', message)
+                time.sleep(1)
+
+    Each subscriber needs to be served by its own thread (or greenlet),
+    because waiting for messages blocks.
+
+    When running several processes, pass a broadcast backend
+    (like :class:`sijax.plugin.comet.UnixSocketBackend` or
+    :class:`sijax.plugin.comet.RedisBackend`), so that messages
+    published in one process reach the subscribers in all of them.
+
+    What happens when a subscriber's queue is full depends on
+    the ``overflow`` policy:
+
+    - :attr:`OVERFLOW_DROP` - the oldest message is dropped
+    - :attr:`OVERFLOW_MERGE` - the queued messages are merged into one,
+      where commands having a ``key`` supersede older commands with
+      the same key (see :class:`sijax.response.BaseResponse`)
+    - :attr:`OVERFLOW_BLOCK` - publishing waits for room in the queue,
+      for up to ``block_timeout`` seconds, dropping the oldest
+      message after that
+
+    :param queue_size: how many messages to keep per subscriber,
+                       while waiting for them to be sent
+    :param backend: the :class:`sijax.plugin.comet.BroadcastBackend`
+                    delivering messages to (and from) other processes
+    :param overflow: the overflow policy
+    :param block_timeout: how long to wait, with :attr:`OVERFLOW_BLOCK`
+    :param history: a :class:`sijax.plugin.comet.History` to keep
+                    the delivered messages in (needed for long-polling)
+    """
+
+    OVERFLOW_DROP = 'drop'
+    OVERFLOW_MERGE = 'merge'
+    OVERFLOW_BLOCK = 'block'
+
+    def __init__(self, queue_size=100, backend=None, overflow=OVERFLOW_DROP,
+                 block_timeout=1.0, history=None):
+        self._queue_size = queue_size
+        self._overflow = overflow
+        self._block_timeout = block_timeout
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._stats = {'dropped': 0, 'merged': 0, 'blocked': 0}
+        self.history = history
+        self.backend = backend if backend is not None else BroadcastBackend()
+        self.backend.start(self._deliver)
+
+    def subscribe(self, channel, obj_response, timeout=None):
+        """Subscribes the given (streaming) response to the channel.
+
+        :param channel: the name of the channel
+        :param obj_response: the response of the Comet function
+                             (a :class:`sijax.plugin.comet.CometResponse`)
+        :param timeout: pause iterating after this many seconds, even if
+                        there are no messages (None to wait forever)
+        :return: :class:`Subscription`
+        """
+        subscription = Subscription(self, channel, obj_response,
+                                    self._queue_size, timeout,
+                                    self._overflow, self._block_timeout)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._channels.get(subscription.channel)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._channels[subscription.channel]
+
+    def _count(self, name, value):
+        with self._lock:
+            self._stats[name] += value
+
+    def get_stats(self):
+        """Returns a dictionary of counters, for all channels:
+
+        - ``subscribers`` - the current number of subscribers
+        - ``dropped`` - messages dropped, because a queue was full
+        - ``merged`` - commands superseded, while merging messages
+        - ``blocked`` - times that publishing waited for room in a queue
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['subscribers'] = sum(len(subscriptions) for subscriptions
+                                       in self._channels.values())
+        return stats
+
+    def get_subscribers_count(self, channel):
+        """Returns the number of subscribers of the given channel."""
+        with self._lock:
+            return len(self._channels.get(channel, ()))
+
+    def publish(self, channel, message):
+        """Publishes the message to all the subscribers of the channel,
+        in this process and (through the backend) in the other ones.
+
+        The backend goes first, so that a message it rejects
+        (e.g. one that's too large) isn't delivered anywhere.
+
+        :param channel: the name of the channel
+        :param message: the :class:`Message` to publish
+        :return: the number of subscribers (in this process)
+                 that received the message
+        """
+        self.backend.publish(channel, message)
+        return self._deliver(channel, message)
+
+    def _deliver(self, channel, message):
+        if self.history is not None:
+            self.history.append(channel, message)
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription._put(message)
+        return len(subscriptions)
+
+    def close(self, channel):
+        """Closes all subscriptions to the channel, which makes
+        the subscribed Comet functions stop iterating."""
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.close()
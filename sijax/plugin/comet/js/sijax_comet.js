@@ -1,10 +1,30 @@
 var sjxComet = {};
 
+sjxComet.TRANSPORT_IFRAME = 'iframe';
+sjxComet.TRANSPORT_FETCH = 'fetch';
+
+//fetch() is only used where streamed response bodies are supported,
+//falling back to the iframe otherwise
+sjxComet.transport = sjxComet.TRANSPORT_IFRAME;
+
+sjxComet.setTransport = function (transport) {
+	sjxComet.transport = transport;
+};
+
+sjxComet.isFetchSupported = function () {
+	return (typeof(window.fetch) !== "undefined" && typeof(window.ReadableStream) !== "undefined" &&
+		typeof(window.TextDecoder) !== "undefined" && typeof(window.URLSearchParams) !== "undefined");
+};
+
 sjxComet.request = function (functionName, callArgs) {
 	if (callArgs === undefined) {
 		callArgs = [];
 	}
 
+	if (sjxComet.transport === sjxComet.TRANSPORT_FETCH && sjxComet.isFetchSupported()) {
+		return sjxComet.requestFetch(functionName, callArgs);
+	}
+
 	var iframe = document.createElement('iframe'),
 		frameId = 'frame4_' + functionName + '_' + (new Date().getTime());
 
@@ -30,22 +50,126 @@ sjxComet.request = function (functionName, callArgs) {
 		window.setTimeout(function () {
 			jQuery('#' + frameId).remove();
 			jQuery('#' + formId).remove();
+			//Error pages load like anything else, so they can't be told apart here
+			sjxComet.requestEnded(functionName, null);
 		});
 	});
 
 	var formObject = jQuery('#' + formId);
 
-	var element = document.createElement('input');
-	element.setAttribute('type', 'hidden');
-	element.setAttribute('name', Sijax.PARAM_REQUEST);
-	element.setAttribute('value', functionName);
-	formObject.append(element);
-
-	var element = document.createElement('input');
-	element.setAttribute('type', 'hidden');
-	element.setAttribute('name', Sijax.PARAM_ARGS);
-	element.setAttribute('value', JSON.stringify(callArgs));
-	formObject.append(element);
+	jQuery.each(Sijax.getRequestData(functionName, callArgs), function (name, value) {
+		var element = document.createElement('input');
+		element.setAttribute('type', 'hidden');
+		element.setAttribute('name', name);
+		element.setAttribute('value', value);
+		formObject.append(element);
+	});
 
 	formObject.trigger('submit');
 };
+
+sjxComet.requestFetch = function (functionName, callArgs) {
+	//The response is newline-delimited JSON - one line per flush
+	var body = new URLSearchParams(),
+		decoder = new TextDecoder('utf-8'),
+		buffer = '';
+
+	jQuery.each(Sijax.getRequestData(functionName, callArgs), function (name, value) {
+		body.append(name, value);
+	});
+	body.append(Sijax.PARAM_TRANSPORT, Sijax.TRANSPORT_FETCH);
+
+	function processLines(isLast) {
+		var lines = buffer.split('\n'),
+			i;
+
+		//The last line is incomplete, unless the stream has ended
+		buffer = (isLast ? '' : lines.pop());
+		for (i = 0; i < lines.length; i += 1) {
+			if (lines[i] !== '') {
+				Sijax.processCommands(JSON.parse(lines[i]));
+			}
+		}
+	}
+
+	return window.fetch(Sijax.getRequestUri(), {
+		"method": "POST",
+		"body": body,
+		"credentials": "same-origin",
+		"headers": {"X-Requested-With": "XMLHttpRequest"}
+	}).then(function (response) {
+		if (! response.ok) {
+			//Error pages are not NDJSON
+			throw new Error('Comet request failed: HTTP ' + response.status);
+		}
+
+		var reader = response.body.getReader();
+
+		function read() {
+			return reader.read().then(function (result) {
+				if (result.done) {
+					buffer += decoder.decode();
+					processLines(true);
+					return;
+				}
+				buffer += decoder.decode(result.value, {"stream": true});
+				processLines(false);
+				return read();
+			});
+		}
+
+		return read();
+	}).then(function () {
+		sjxComet.requestEnded(functionName, null);
+	}, function (error) {
+		//Network errors, error responses and malformed lines end up here
+		sjxComet.requestEnded(functionName, error);
+	});
+};
+
+sjxComet.requestEnded = function (functionName, error) {
+	//Called when a Comet request ends (with the error, if known),
+	//whichever transport was used
+	jQuery(document).trigger('sjxComet:end', [functionName, error]);
+};
+
+//Long-polling (see register_long_poll_callback())
+sjxComet.pollRetryDelay = 1000;
+sjxComet.pollCursors = {};
+sjxComet.pollStopped = {};
+
+sjxComet.poll = function (functionName) {
+	var cursor = sjxComet.pollCursors[functionName];
+
+	delete sjxComet.pollStopped[functionName];
+
+	Sijax.request(functionName, [cursor === undefined ? null : cursor], {
+		"success": function (data) {
+			Sijax.processCommands(data);
+			if (! sjxComet.pollStopped[functionName]) {
+				sjxComet.poll(functionName);
+			}
+		},
+		"error": function () {
+			//Reconnecting with the same cursor gets us what we missed
+			window.setTimeout(function () {
+				if (! sjxComet.pollStopped[functionName]) {
+					sjxComet.poll(functionName);
+				}
+			}, sjxComet.pollRetryDelay);
+		}
+	});
+};
+
+sjxComet.stopPolling = function (functionName) {
+	sjxComet.pollStopped[functionName] = true;
+};
+
+sjxComet.pollCursor = function (functionName, cursor) {
+	sjxComet.pollCursors[functionName] = cursor;
+};
+
+sjxComet.pollReset = function (functionName) {
+	//Some messages were missed and can't be recovered
+	jQuery(document).trigger('sjxComet:reset', [functionName]);
+};
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.plugin.comet.scheduler
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Provides a cooperative scheduler, which drives many Comet
+    streams from a single thread.
+
+    Comet functions don't block (``time.sleep()``, waiting for messages),
+    but yield scheduling hints instead::
+
+        def comet_handler(obj_response):
+            for i in range(10):
+                obj_response.html('#counter', i)
+                yield obj_response.sleep(1)
+
+    When a stream is driven by a :class:`Scheduler`, the hints are passed
+    to it and the stream gets resumed when the timer (or channel) fires.
+    Otherwise (when a regular WSGI server iterates over the response)
+    the hints simply block, so the same functions work everywhere.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from collections import deque
+
+
+_state = threading.local()
+
+
+def is_scheduled():
+    """Tells whether the current thread is running a stream
+    on behalf of a :class:`Scheduler`."""
+    return getattr(_state, 'scheduler', None) is not None
+
+
+class SchedulingHint(object):
+    """The base class for objects that Comet functions yield,
+    telling when they should be resumed."""
+
+    def block(self):
+        """Waits in the current thread (when not driven by a scheduler)."""
+        raise NotImplementedError
+
+    def _schedule(self, scheduler, task):
+        """Arranges for the task to be resumed by the scheduler."""
+        raise NotImplementedError
+
+    def _resume(self):
+        """Called (in the scheduler thread) right before resuming."""
+        pass
+
+
+class Sleep(SchedulingHint):
+    """Resume after the given number of seconds.
+
+    Created using :meth:`sijax.plugin.comet.CometResponse.sleep`.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def block(self):
+        time.sleep(self.seconds)
+
+    def _schedule(self, scheduler, task):
+        scheduler._add_timer(task, self.seconds, scheduler._suspend(task))
+
+
+class Wait(SchedulingHint):
+    """Resume when a message arrives on the subscription
+    (or when the timeout expires).
+
+    The received messages are pushed to the response before resuming,
+    to be sent on the next flush.
+
+    Created using :meth:`sijax.plugin.comet.CometResponse.wait`.
+    """
+
+    def __init__(self, subscription, timeout=None):
+        self.subscription = subscription
+        self.timeout = timeout
+
+    def block(self):
+        self.subscription._wait(self.timeout)
+        self._resume()
+
+    def _schedule(self, scheduler, task):
+        token = scheduler._suspend(task)
+        if self.timeout is not None:
+            scheduler._add_timer(task, self.timeout, token)
+        self.subscription._set_waiter(lambda: scheduler._wake(task, token))
+
+    def _resume(self):
+        self.subscription._push_pending()
+
+
+class _Task(object):
+
+    def __init__(self, stream, write, close):
+        self.stream = iter(stream)
+        self.closeable = stream
+        self.write = write
+        self.close = close
+        # Identifies the current suspension - wake-ups and timers
+        # carrying another token are stale and get ignored
+        self.token = None
+        self.hint = None
+
+
+class Scheduler(object):
+    """Drives many Comet streams from a single thread.
+
+    Each stream is the result of :meth:`sijax.Sijax.process_request`
+    for a Comet function, along with a function to write its chunks
+    (bytes) to the browser::
+
+        scheduler = Scheduler()
+        scheduler.spawn(sijax_instance.process_request(), connection.sendall,
+                        close=connection.close)
+        scheduler.run()
+
+    This needs a server that lets you take over the connection
+    (instead of the WSGI server iterating over the response itself),
+    and ``write`` should not block for long, because it blocks
+    all the other streams too.
+    The stream needs to be passed as it is (not wrapped by middleware),
+    because it yields scheduling hints along with the chunks.
+
+    Streams can be spawned from any thread, and messages published
+    from any thread wake up the streams waiting for them.
+    """
+
+    def __init__(self):
+        self._ready = deque()
+        self._timers = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._tasks_count = 0
+        self._is_stopped = False
+
+    @property
+    def tasks_count(self):
+        """The number of streams being driven."""
+        return self._tasks_count
+
+    def spawn(self, stream, write, close=None):
+        """Adds a stream to drive.
+
+        :param stream: the response iterable
+        :param write: a function called with each chunk (bytes)
+        :param close: an optional function called when the stream ends
+                      (or when writing to it fails)
+        """
+        task = _Task(stream, write, close)
+        with self._condition:
+            self._tasks_count += 1
+            self._ready.append(task)
+            self._condition.notify()
+
+    def _suspend(self, task):
+        task.token = object()
+        return task.token
+
+    def _wake(self, task, token):
+        with self._condition:
+            if task.token is not token:
+                return
+            task.token = None
+            self._ready.append(task)
+            self._condition.notify()
+
+    def _add_timer(self, task, seconds, token):
+        with self._condition:
+            heapq.heappush(self._timers, (time.time() + seconds,
+                                          next(self._counter), task, token))
+
+    def _finish(self, task):
+        # Streams get spawned from other threads
+        with self._condition:
+            self._tasks_count -= 1
+        try:
+            if hasattr(task.closeable, 'close'):
+                task.closeable.close()
+        finally:
+            if task.close is not None:
+                task.close()
+
+    def handle_error(self, task):
+        """Called when a stream raises an exception (the stream is
+        finished right after that). Prints the traceback by default."""
+        traceback.print_exc()
+
+    def _step(self, task):
+        """Resumes the task, until it yields a chunk or a hint."""
+        hint, task.hint = task.hint, None
+        _state.scheduler = self
+        try:
+            if hint is not None:
+                hint._resume()
+            value = next(task.stream)
+        except StopIteration:
+            self._finish(task)
+            return
+        except Exception:
+            self.handle_error(task)
+            self._finish(task)
+            return
+        finally:
+            _state.scheduler = None
+
+        if isinstance(value, SchedulingHint):
+            task.hint = value
+            value._schedule(self, task)
+            return
+
+        try:
+            task.write(value)
+        except Exception:
+            # The browser is gone
+            self._finish(task)
+            return
+
+        with self._condition:
+            self._ready.append(task)
+
+    def run_once(self, timeout=None):
+        """Waits (up to ``timeout`` seconds, or until something happens
+        if None) for streams to become ready, and resumes them."""
+        with self._condition:
+            if not self._ready:
+                wait_for = timeout
+                if self._timers:
+                    until_timer = max(0, self._timers[0][0] - time.time())
+                    if wait_for is None or until_timer < wait_for:
+                        wait_for = until_timer
+                if wait_for is None or wait_for > 0:
+                    self._condition.wait(wait_for)
+
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                task, token = heapq.heappop(self._timers)[2:]
+                if task.token is token:
+                    task.token = None
+                    self._ready.append(task)
+
+            ready = list(self._ready)
+            self._ready.clear()
+
+        for task in ready:
+            self._step(task)
+
+    def run(self, until_idle=False):
+        """Drives the streams, until :meth:`stop` gets called.
+
+        :param until_idle: return when there are no more streams to drive
+        """
+        self._is_stopped = False
+        while not self._is_stopped:
+            if until_idle and self._tasks_count == 0:
+                return
+            self.run_once()
+
+    def stop(self):
+        """Makes :meth:`run` return (can be called from any thread)."""
+        with self._condition:
+            self._is_stopped = True
+            self._condition.notify()
@@ -15,14 +15,30 @@ from __future__ import (absolute_import, unicode_literals)
 """
 
 
+import hashlib
+import os
+import tempfile
+from types import GeneratorType
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 from ...helper import json
-from ...response import StreamingIframeResponse
+from ...response import (BaseResponse, StreamingIframeResponse)
+from ...exception import UploadTooLargeError
+from .chunked import (ChunkedUploadStore, register_chunked_upload_callback)
 
 # Parameters with these names are passed to the client side (JS)
 # Modifying this would mean modifying the javascript files
 PARAM_FORM_ID = 'formId'
 PARAM_CALLBACK = 'callback'
 
+#: Uploaded files smaller than this stay in memory
+#: when using :func:`spooled_file_factory`
+SPOOL_MAX_MEMORY_SIZE = 512 * 1024
+
 
 def _prepare_options(sijax_instance, options):
     param_response_class = sijax_instance.__class__.PARAM_RESPONSE_CLASS
@@ -79,12 +95,202 @@ def register_upload_callback(sijax_instance, form_id, callback, **options):
     return 'jQuery(function() { sjxUpload.registerForm(%s); });' % js_params
 
 
+def spooled_file_factory(max_memory_size=SPOOL_MAX_MEMORY_SIZE):
+    """Returns a factory creating spooled temporary files for uploads.
+
+    Sijax doesn't parse multipart requests itself - the files that upload
+    functions receive are created by your framework.
+    Frameworks based on Werkzeug (like Flask) let you choose how to store
+    uploaded files, by overriding ``Request._get_file_stream``.
+    The returned factory has the same signature, and creates files which
+    are kept in memory until they grow larger than ``max_memory_size``,
+    at which point they are moved to disk::
+
+        factory = spooled_file_factory(1024 * 1024)
+
+        class Request(flask.Request):
+            def _get_file_stream(self, *args, **kwargs):
+                return factory(*args, **kwargs)
+
+    :param max_memory_size: the in-memory threshold, in bytes
+    """
+    def factory(total_content_length, content_type, filename=None,
+                content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=max_memory_size,
+                                             mode='w+b')
+    return factory
+
+
+class FormValues(Mapping):
+    """A read-only view of the submitted form values.
+
+    It's built on top of the request data, without copying it, and hides
+    the internal Sijax parameters (see :attr:`sijax.Sijax.SYSTEM_PARAMS`).
+
+    Multi-value dictionaries (like Werkzeug's ``MultiDict``) work the
+    same way they do without Sijax: item access returns the first value,
+    while ``getlist()`` returns all of them.
+    """
+
+    def __init__(self, data, hidden_keys):
+        self._data = data
+        self._hidden_keys = frozenset(hidden_keys)
+
+    def __getitem__(self, key):
+        if key in self._hidden_keys:
+            raise KeyError(key)
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key not in self._hidden_keys and key in self._data
+
+    def __iter__(self):
+        hidden_keys = self._hidden_keys
+        return (key for key in self._data if key not in hidden_keys)
+
+    def __len__(self):
+        hidden_count = sum(1 for key in self._hidden_keys if key in self._data)
+        return len(self._data) - hidden_count
+
+    def getlist(self, key):
+        """Returns all the values for the given key
+        (for multi-value dictionaries), or a single-item list."""
+        if key not in self:
+            return []
+        if hasattr(self._data, 'getlist'):
+            return self._data.getlist(key)
+        return [self._data[key]]
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, dict(self.items()))
+
+
+class StreamedFile(object):
+    """Consumes an uploaded file in chunks, reading it exactly once.
+
+    While reading, the data is written to the destination,
+    checksums are computed and the size limit is enforced.
+    Iterating over the object does the work, pausing after every
+    ``progress_interval`` bytes, after queueing a progress command
+    (``sjxUpload.progress``) to the response.
+    Instances are created using :meth:`UploadResponse.stream_file`.
+
+    When the iteration completes, the following attributes are available:
+
+    - ``size`` - the number of bytes read
+    - ``hexdigests`` - a dictionary of checksums (algorithm => hex digest)
+    """
+
+    def __init__(self, obj_response, file_obj, destination=None,
+                 hashes=('sha256', ), max_size=None, chunk_size=64 * 1024,
+                 progress_interval=1024 * 1024):
+        self._obj_response = obj_response
+        self._file_obj = file_obj
+        self._destination = destination
+        self._hashes = dict((name, hashlib.new(name)) for name in hashes)
+        self._max_size = max_size
+        self._chunk_size = chunk_size
+        self._progress_interval = progress_interval
+
+        #: The total size of the file, if it could be determined beforehand
+        self.total_size = self._determine_size(file_obj)
+        self.size = 0
+
+    @staticmethod
+    def _determine_size(file_obj):
+        size = getattr(file_obj, 'content_length', None)
+        if size:
+            return size
+        try:
+            position = file_obj.tell()
+            file_obj.seek(0, os.SEEK_END)
+            size = file_obj.tell() - position
+            file_obj.seek(position)
+            return size
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+
+    @property
+    def hexdigests(self):
+        """The checksums (algorithm name => hex digest) of the data read."""
+        return dict((name, hash_obj.hexdigest())
+                    for name, hash_obj in self._hashes.items())
+
+    def _open_destination(self):
+        if self._destination is None or hasattr(self._destination, 'write'):
+            return self._destination, False
+        return open(self._destination, 'wb'), True
+
+    def _progress(self):
+        if not self._obj_response.is_streaming:
+            # XHR uploads get progress events from the browser itself
+            return
+        # Unflushed progress reports are useless, once there's a newer one
+        self._obj_response.call('sjxUpload.progress', [
+            self._obj_response.form_id, self.size, self.total_size
+        ], key='sjxUpload.progress')
+
+    def __iter__(self):
+        if (self._max_size is not None and self.total_size is not None and
+            self.total_size > self._max_size):
+            raise UploadTooLargeError('The file is larger than %d bytes' %
+                                      self._max_size)
+
+        destination, close_destination = self._open_destination()
+        completed = False
+        try:
+            next_progress_at = self._progress_interval
+            while True:
+                chunk = self._file_obj.read(self._chunk_size)
+                if not chunk:
+                    break
+
+                self.size += len(chunk)
+                if self._max_size is not None and self.size > self._max_size:
+                    raise UploadTooLargeError('The file is larger than %d bytes' %
+                                              self._max_size)
+
+                for hash_obj in self._hashes.values():
+                    hash_obj.update(chunk)
+                if destination is not None:
+                    destination.write(chunk)
+
+                if self.size >= next_progress_at:
+                    next_progress_at = self.size + self._progress_interval
+                    self._progress()
+                    yield self
+
+            # All written - nothing to remove if iterating stops here
+            completed = True
+            self._progress()
+            yield self
+        finally:
+            if close_destination:
+                destination.close()
+                if not completed:
+                    # Don't leave partially written files around
+                    os.unlink(self._destination)
+
+    def consume(self):
+        """Consumes the whole file at once, without pausing for progress
+        reports. Returns the object itself."""
+        for _ in self:
+            pass
+        return self
+
+
 class UploadResponse(StreamingIframeResponse):
     """Class used for Upload handler functions,
     instead of the :class:`sijax.response.BaseResponse` class.
 
     This class extends :class:`sijax.response.BaseResponse` and
     every available method from it works here too.
+
+    Forms are submitted to a hidden iframe by default, in which case the
+    response is streamed. Forms submitted using ``XMLHttpRequest``
+    (see :ref:`upload-xhr-transport`) get a regular (JSON) response
+    instead, containing all the commands - handler functions may still
+    ``yield``, but nothing gets flushed until they exit.
     """
 
     def __init__(self, *args, **kwargs):
@@ -100,16 +306,15 @@ class UploadResponse(StreamingIframeResponse):
 
         # Let's override the request arguments now
         # The upload handler function is to expect only one argument
-        # which is a dictionary of form values
+        # which is a mapping of form values
         # To get the form values from all the POST data,
-        # we simply need to get rid of some internal/system params
-
-        # We're creating a new dict, because the POST data dictionary
-        # may be immutable and/or we don't want to change it anyways.
-        # We want to work on a copy of it.
-        form_values = dict(self._sijax.get_data())
-        del form_values[self._sijax.__class__.PARAM_REQUEST]
-        del form_values[self._sijax.__class__.PARAM_ARGS]
+        # we simply need to hide some internal/system params
+
+        # We're not copying the POST data dictionary, as that could be
+        # expensive (many fields, eagerly materialized multi-dicts, etc.)
+        # A read-only view over it is enough.
+        form_values = FormValues(self._sijax.get_data(),
+                                 self._sijax.__class__.SYSTEM_PARAMS)
         self._request_args = [form_values]
 
     @property
@@ -121,6 +326,76 @@ class UploadResponse(StreamingIframeResponse):
         """
         return self._form_id
 
+    @property
+    def is_streaming(self):
+        """Tells whether flushing (``yield``) sends commands to the browser
+        immediately (iframe transport), or whether everything is sent
+        at once, in the end (XHR transport)."""
+        return self._sijax.transport != self._sijax.__class__.TRANSPORT_XHR
+
+    @classmethod
+    def get_content_type(cls, sijax_instance):
+        if sijax_instance.transport == sijax_instance.__class__.TRANSPORT_XHR:
+            return BaseResponse.get_content_type(sijax_instance)
+        return StreamingIframeResponse.get_content_type(sijax_instance)
+
+    def _process_call_chain(self, call_chain):
+        """Executes all the callbacks in the chain.
+
+        Returns a generator for iframe uploads (see
+        :meth:`sijax.response.StreamingIframeResponse._process_call_chain`),
+        or the serialized commands (like
+        :meth:`sijax.response.BaseResponse._process_call_chain` does)
+        for XHR uploads.
+        """
+        if self.is_streaming:
+            return StreamingIframeResponse._process_call_chain(self, call_chain)
+
+        for callback, args in call_chain:
+            response = self._perform_handler_call(callback, args)
+            if isinstance(response, GeneratorType):
+                # Nothing to flush to, just run the function to completion
+                for _ in response:
+                    pass
+        return self._get_output()
+
+    def stream_file(self, file_obj, destination=None, hashes=('sha256', ),
+                    max_size=None, chunk_size=64 * 1024,
+                    progress_interval=1024 * 1024):
+        """Reads an uploaded file in chunks, writing it to ``destination``
+        and computing its checksums in the same pass.
+
+        Iterate over the result and ``yield`` to push progress reports
+        to the browser (triggering the ``sjxUpload:progress`` event on
+        the form)::
+
+            def upload_handler(obj_response, files, form_values):
+                upload = obj_response.stream_file(files['file'], '/path/to/file',
+                                                  max_size=100 * 1024 * 1024)
+                try:
+                    for _ in upload:
+                        yield obj_response
+                except UploadTooLargeError:
+                    obj_response.alert('The file is too large!')
+                    return
+
+                checksum = upload.hexdigests['sha256']
+
+        :param file_obj: the uploaded file object to read from
+        :param destination: a path or a writable file-like object to copy
+                            the data to, or None to only compute checksums
+        :param hashes: names of :mod:`hashlib` algorithms to compute
+        :param max_size: the maximum allowed file size in bytes. If exceeded,
+                         :class:`sijax.exception.UploadTooLargeError` is
+                         raised and a partially written destination
+                         path is removed
+        :param chunk_size: how many bytes to read at once
+        :param progress_interval: report progress after this many bytes
+        :return: :class:`sijax.plugin.upload.StreamedFile`
+        """
+        return StreamedFile(self, file_obj, destination, hashes, max_size,
+                            chunk_size, progress_interval)
+
     def reset_form(self):
         """Resets the form to the state it was in at page loading time.
 
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.plugin.upload.chunked
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Provides chunked, resumable uploads.
+
+    The browser slices files (``Blob.slice``) and sends numbered chunks
+    using regular Sijax calls. The server appends each chunk to a partial
+    file and keeps an index of what has been committed, so an interrupted
+    upload continues from the last committed chunk.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import os
+import re
+import shutil
+
+from six import (string_types, integer_types)
+
+from ...helper import json
+from ...exception import ChunkedUploadError
+
+
+ACTION_BEGIN = 'begin'
+ACTION_CHUNK = 'chunk'
+ACTION_FINALIZE = 'finalize'
+
+_REGEX_UPLOAD_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def _replace(src, dst):
+    """Atomically replaces ``dst`` with ``src``, where possible."""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.unlink(dst)
+        os.rename(src, dst)
+
+
+class ChunkedUploadStore(object):
+    """Keeps partially uploaded files in a local directory.
+
+    For every upload id, the store keeps two files:
+
+    - ``<upload_id>.part`` - the data of all committed chunks, in order
+    - ``<upload_id>.json`` - the index, telling how many chunks
+      (and bytes) have been committed
+
+    The index is only updated after a chunk has been written completely,
+    so a chunk interrupted half-way is simply written again.
+
+    Upload ids are chosen by the browser, so make sure that different users
+    don't share a store (by using a directory per user, for example).
+
+    :param directory: the directory to keep partial uploads in
+    :param max_size: the maximum allowed size of a file (None for no limit)
+    """
+
+    #: How many bytes to copy at once, when writing chunks
+    COPY_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _get_paths(self, upload_id):
+        if (not isinstance(upload_id, string_types) or
+            _REGEX_UPLOAD_ID.match(upload_id) is None):
+            raise ChunkedUploadError('Invalid upload id')
+        base = os.path.join(self.directory, upload_id)
+        return base + '.part', base + '.json'
+
+    def get_state(self, upload_id):
+        """Returns the state of the upload (a dictionary with the ``chunks``,
+        ``offset``, ``size`` and ``name`` keys) or None if it's unknown."""
+        index_path = self._get_paths(upload_id)[1]
+        try:
+            with open(index_path, 'r') as fp:
+                return json.loads(fp.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_state(self, upload_id, state):
+        index_path = self._get_paths(upload_id)[1]
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(json.dumps(state))
+        _replace(tmp_path, index_path)
+
+    def begin(self, upload_id, size, name):
+        """Starts a new upload, or resumes an existing one.
+
+        :param upload_id: the id of the upload (chosen by the browser)
+        :param size: the total size of the file in bytes
+        :param name: the name of the file
+        :return: the upload state (see :meth:`get_state`)
+        """
+        if not isinstance(size, integer_types) or size < 0:
+            raise ChunkedUploadError('Invalid file size')
+        if self.max_size is not None and size > self.max_size:
+            raise ChunkedUploadError('The file is larger than %d bytes' %
+                                     self.max_size)
+
+        state = self.get_state(upload_id)
+        if state is not None and state['size'] == size:
+            return state
+
+        data_path = self._get_paths(upload_id)[0]
+        open(data_path, 'wb').close()
+        state = {'chunks': 0, 'offset': 0, 'size': size, 'name': name}
+        self._save_state(upload_id, state)
+        return state
+
+    def write_chunk(self, upload_id, number, data):
+        """Appends the chunk to the partial file and commits it.
+
+        Chunks that are already committed are ignored (the browser may send
+        a chunk again, if it didn't receive the acknowledgement).
+
+        :param upload_id: the id of the upload
+        :param number: the sequence number of the chunk (starting from 0)
+        :param data: a file-like object (out-of-band argument) or bytes
+        :return: the new upload state (see :meth:`get_state`)
+        """
+        if not isinstance(number, integer_types):
+            raise ChunkedUploadError('Invalid chunk number')
+        state = self.get_state(upload_id)
+        if state is None:
+            raise ChunkedUploadError('Unknown upload')
+        if number < state['chunks']:
+            return state
+        if number > state['chunks']:
+            raise ChunkedUploadError('Expected chunk %d, got %d' %
+                                     (state['chunks'], number))
+
+        data_path = self._get_paths(upload_id)[0]
+        offset = state['offset']
+        with open(data_path, 'r+b') as fp:
+            # Anything past the committed offset is a leftover
+            # of an interrupted write - overwrite it
+            fp.seek(offset)
+            fp.truncate()
+            if hasattr(data, 'read'):
+                while True:
+                    buf = data.read(self.__class__.COPY_BUFFER_SIZE)
+                    if not buf:
+                        break
+                    offset += len(buf)
+                    if offset > state['size']:
+                        raise ChunkedUploadError('Received more data than expected')
+                    fp.write(buf)
+            else:
+                if not isinstance(data, bytes):
+                    data = data.encode('utf-8')
+                offset += len(data)
+                if offset > state['size']:
+                    raise ChunkedUploadError('Received more data than expected')
+                fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        state['chunks'] += 1
+        state['offset'] = offset
+        self._save_state(upload_id, state)
+        return state
+
+    def finalize(self, upload_id, destination):
+        """Completes the upload, moving the file to ``destination``.
+
+        The chunks were appended in order, so there is nothing to assemble -
+        the partial file is simply moved (without reading it).
+
+        :return: the final upload state (see :meth:`get_state`)
+        """
+        state = self.get_state(upload_id)
+        if state is None:
+            raise ChunkedUploadError('Unknown upload')
+        if state['offset'] != state['size']:
+            raise ChunkedUploadError('The upload is not complete')
+
+        data_path, index_path = self._get_paths(upload_id)
+        shutil.move(data_path, destination)
+        os.unlink(index_path)
+        return state
+
+    def abort(self, upload_id):
+        """Removes everything that has been uploaded so far."""
+        for path in self._get_paths(upload_id):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def register_chunked_upload_callback(sijax_instance, public_name, store,
+                                     callback, **options):
+    """Registers a function handling chunked, resumable uploads.
+
+    The browser starts such uploads with::
+
+        sjxUpload.uploadChunked('public_name', fileObject);
+
+    When all chunks have been received, the file gets assembled
+    and ``callback`` is called like this::
+
+        def callback(obj_response, file_path, file_name):
+            # The file needs to be moved away from `file_path`,
+            # or it will be deleted after this function returns
+            shutil.move(file_path, '/some/where/%s' % safe_name(file_name))
+
+    Chunks are transferred as out-of-band Sijax call arguments,
+    so they are not JSON-encoded and never held in memory as a whole.
+
+    :param sijax_instance: the :class:`sijax.Sijax` instance
+                           to register callbacks with
+    :param public_name: the name of the function that the browser calls
+    :param store: the :class:`ChunkedUploadStore` to keep uploads in
+    :param callback: the function to call, once the upload is complete
+    :param options: options to pass to :meth:`sijax.Sijax.register_callback`
+    """
+    args_extra_count = len(options.get(sijax_instance.__class__.PARAM_ARGS_EXTRA) or [])
+
+    def invalid_call(obj_response):
+        event = sijax_instance.__class__.EVENT_INVALID_CALL
+        return sijax_instance.get_event(event)(obj_response, callback)
+
+    def handler(obj_response, *args):
+        args_extra = list(args[:args_extra_count])
+        args = args[args_extra_count:]
+        if len(args) < 2:
+            return invalid_call(obj_response)
+
+        action, upload_id, args = args[0], args[1], args[2:]
+        try:
+            if action == ACTION_BEGIN and len(args) == 2:
+                state = store.begin(upload_id, args[0], args[1])
+            elif action == ACTION_CHUNK and len(args) == 2:
+                state = store.write_chunk(upload_id, args[0], args[1])
+            elif action == ACTION_FINALIZE and len(args) == 0:
+                file_path = os.path.join(store.directory, '%s.done' % upload_id)
+                state = store.finalize(upload_id, file_path)
+                try:
+                    callback(obj_response, *(args_extra + [file_path, state['name']]))
+                finally:
+                    if os.path.exists(file_path):
+                        os.unlink(file_path)
+                obj_response.call('sjxUpload.chunkedComplete', [upload_id])
+                return
+            else:
+                return invalid_call(obj_response)
+        except ChunkedUploadError as e:
+            obj_response.call('sjxUpload.chunkedFailed', [upload_id, str(e)])
+            return
+
+        obj_response.call('sjxUpload.chunkedAck',
+                          [upload_id, state['chunks'], state['offset']])
+
+    sijax_instance.register_callback(public_name, handler, **options)
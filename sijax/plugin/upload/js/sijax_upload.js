@@ -2,6 +2,30 @@ var sjxUpload = {};
 
 sjxUpload.FIELD_FORM_ID = 'sjxUpload_formId';
 
+sjxUpload.TRANSPORT_IFRAME = 'iframe';
+sjxUpload.TRANSPORT_XHR = 'xhr';
+
+//How forms are submitted - XHR is only used where supported,
+//falling back to the iframe otherwise
+sjxUpload.transport = sjxUpload.TRANSPORT_IFRAME;
+
+//How many requests an XHR form submission makes at once
+//(files are sent in parallel, one file per request)
+sjxUpload.maxConcurrentRequests = 3;
+
+//Note that the XHR transport sends every selected file in its own request
+//(see sjxUpload.getXhrRequests), so the upload handler function gets called
+//once per file, seeing only that file - unlike the iframe transport,
+//which sends the whole form (all files) in a single request
+sjxUpload.setTransport = function (transport) {
+	sjxUpload.transport = transport;
+};
+
+sjxUpload.isXhrSupported = function () {
+	return (Sijax.isFormDataSupported() && typeof(XMLHttpRequest) !== "undefined" &&
+		typeof(new XMLHttpRequest().upload) !== "undefined");
+};
+
 sjxUpload.getFrameId = function (formId) {
 	return 'sjxUpload_iframe_' + formId;
 };
@@ -9,7 +33,6 @@ sjxUpload.getFrameId = function (formId) {
 sjxUpload.prepareForm = function (formId, callbackName) {
 	var frameId = sjxUpload.getFrameId(formId),
 		$object = jQuery('#' + formId),
-		requestArgs = JSON.stringify([formId]),
 		element,
         attrOrProp = (! $object.prop ? 'attr' : 'prop');
 
@@ -22,24 +45,19 @@ sjxUpload.prepareForm = function (formId, callbackName) {
 		$object[attrOrProp]('action', Sijax.getRequestUri());
 	}
 
-	if (! $object[attrOrProp](Sijax.PARAM_REQUEST)) {
-		//Initial registration
-		element = document.createElement('input');
-		element.setAttribute('type', 'hidden');
-		element.setAttribute('name', Sijax.PARAM_REQUEST);
-		element.setAttribute('value', callbackName);
-		$object.append(element);
-
-		element = document.createElement('input');
-		element.setAttribute('type', 'hidden');
-		element.setAttribute('name', Sijax.PARAM_ARGS);
-		element.setAttribute('value', requestArgs);
-		$object.append(element);
-	} else {
-		//The fields are already created, let's just "refresh" their contents
-		$object.find('input[name=' + Sijax.PARAM_REQUEST + ']').val(callbackName);
-		$object.find('input[name=' + Sijax.PARAM_ARGS + ']').val(requestArgs);
-	}
+	jQuery.each(Sijax.getRequestData(callbackName, [formId]), function (name, value) {
+		var $field = $object.find('input[name=' + name + ']');
+		if ($field.length === 0) {
+			//Initial registration
+			element = document.createElement('input');
+			element.setAttribute('type', 'hidden');
+			element.setAttribute('name', name);
+			$object.append(element);
+			$field = jQuery(element);
+		}
+		//The fields may already exist, in which case we "refresh" their contents
+		$field.val(value);
+	});
 };
 
 sjxUpload.resetForm = function (formId) {
@@ -61,6 +79,7 @@ sjxUpload.registerForm = function (params) {
 	iframe.setAttribute('name', frameId);
 	iframe.setAttribute('style', 'display: none');
 
+	jQuery('#' + frameId).remove();
 	jQuery('#' + formId).append(iframe);
 
 	if (window.frames[frameId].name !== frameId) {
@@ -70,8 +89,255 @@ sjxUpload.registerForm = function (params) {
 	}
 
 	sjxUpload.prepareForm(formId, callbackName);
+
+	//Registering a form again replaces its submit handler, instead of adding another one
+	jQuery('#' + formId).unbind('submit.sjxUpload').bind('submit.sjxUpload', function (event) {
+		if (sjxUpload.transport === sjxUpload.TRANSPORT_XHR && sjxUpload.isXhrSupported()) {
+			event.preventDefault();
+			sjxUpload.submitXhr(formId);
+		}
+	});
+};
+
+sjxUpload.getXhrRequests = function (form) {
+	//Builds the data for each request - one request per file,
+	//each one containing all the other (non-file) fields
+	var fields = jQuery(form).serializeArray(),
+		files = [],
+		requests = [];
+
+	jQuery(form).find('input[type=file]').each(function () {
+		var name = this.name;
+		if (! name || this.disabled) {
+			return;
+		}
+		jQuery.each(this.files, function (idx, file) {
+			files.push({"name": name, "file": file});
+		});
+	});
+
+	if (files.length === 0) {
+		files.push(null);
+	}
+
+	jQuery.each(files, function (idx, file) {
+		var formData = new FormData();
+		jQuery.each(fields, function (idx, field) {
+			formData.append(field.name, field.value);
+		});
+		formData.append(Sijax.PARAM_TRANSPORT, Sijax.TRANSPORT_XHR);
+		if (file !== null) {
+			formData.append(file.name, file.file, file.file.name);
+		}
+		requests.push({"data": formData, "size": (file === null ? 0 : file.file.size)});
+	});
+
+	return requests;
+};
+
+sjxUpload.submitXhr = function (formId) {
+	var $form = jQuery('#' + formId),
+		requests = sjxUpload.getXhrRequests($form[0]),
+		loaded = [],
+		totals = [],
+		pendingCount = requests.length,
+		nextIdx = 0,
+		i;
+
+	function sum(values) {
+		var total = 0;
+		for (var i = 0; i < values.length; i += 1) {
+			total += values[i];
+		}
+		return total;
+	}
+
+	function finished() {
+		pendingCount -= 1;
+		if (nextIdx < requests.length) {
+			start();
+		} else if (pendingCount === 0) {
+			$form.trigger('sjxUpload:complete');
+		}
+	}
+
+	function start() {
+		var idx = nextIdx;
+		nextIdx += 1;
+
+		Sijax.requestBinary({
+			"type": "POST",
+			"url": $form.attr('action'),
+			"data": requests[idx].data,
+			"uploadProgress": function (bytesDone, bytesTotal) {
+				loaded[idx] = bytesDone;
+				if (bytesTotal !== null) {
+					totals[idx] = bytesTotal;
+				}
+				$form.trigger('sjxUpload:progress', [sum(loaded), sum(totals)]);
+			},
+			"success": function (commands) {
+				Sijax.processCommands(commands);
+				finished();
+			},
+			"error": function (xhr) {
+				$form.trigger('sjxUpload:failed', [xhr.status]);
+				finished();
+			}
+		});
+	}
+
+	for (i = 0; i < requests.length; i += 1) {
+		loaded.push(0);
+		totals.push(requests[i].size);
+	}
+
+	for (i = 0; i < Math.min(sjxUpload.maxConcurrentRequests, requests.length); i += 1) {
+		start();
+	}
 };
 
 sjxUpload.processResponse = function (formId, commandsArray) {
 	Sijax.processCommands(commandsArray);
 };
+
+sjxUpload.progress = function (formId, bytesDone, bytesTotal) {
+	//bytesTotal is null if the server couldn't determine the file size
+	jQuery('#' + formId).trigger('sjxUpload:progress', [bytesDone, bytesTotal]);
+};
+
+//Chunked, resumable uploads (see register_chunked_upload_callback())
+sjxUpload.chunkSize = 1024 * 1024;
+sjxUpload.chunkedMaxRetries = 5;
+sjxUpload.chunkedUploads = {};
+
+sjxUpload.isChunkedSupported = function () {
+	return (Sijax.isFormDataSupported() && typeof(Blob.prototype.slice) !== "undefined");
+};
+
+sjxUpload.getUploadKey = function (file) {
+	return 'sjxUpload:' + [file.name, file.size, file.lastModified].join(':');
+};
+
+sjxUpload.generateUploadId = function (file) {
+	//The id is remembered (per file), so that uploads can continue after a page reload
+	var key = sjxUpload.getUploadKey(file),
+		uploadId = null,
+		randomValues,
+		i;
+
+	try {
+		uploadId = window.localStorage.getItem(key);
+	} catch (e) {}
+
+	if (uploadId === null) {
+		uploadId = '';
+		if (window.crypto && window.crypto.getRandomValues) {
+			randomValues = window.crypto.getRandomValues(new Uint32Array(4));
+			for (i = 0; i < randomValues.length; i += 1) {
+				uploadId += randomValues[i].toString(36);
+			}
+		} else {
+			uploadId = Math.random().toString(36).substr(2) + (new Date()).getTime().toString(36);
+		}
+
+		try {
+			window.localStorage.setItem(key, uploadId);
+		} catch (e) {}
+	}
+
+	return uploadId;
+};
+
+sjxUpload.uploadChunked = function (callbackName, file, params) {
+	//Events are triggered on params.target (the document, by default):
+	//sjxUpload:progress, sjxUpload:complete and sjxUpload:failed
+	//All of them receive the file as the first argument.
+	params = jQuery.extend({
+		"chunkSize": sjxUpload.chunkSize,
+		"target": document
+	}, params || {});
+
+	var uploadId = sjxUpload.generateUploadId(file);
+
+	sjxUpload.chunkedUploads[uploadId] = {
+		"callbackName": callbackName,
+		"file": file,
+		"chunkSize": params.chunkSize,
+		"target": params.target,
+		"retries": 0
+	};
+
+	sjxUpload.chunkedRequest(uploadId, ['begin', uploadId, file.size, file.name]);
+
+	return uploadId;
+};
+
+sjxUpload.chunkedRequest = function (uploadId, callArgs) {
+	var upload = sjxUpload.chunkedUploads[uploadId];
+
+	Sijax.request(upload.callbackName, callArgs, {
+		"error": function () {
+			upload.retries += 1;
+			if (upload.retries > sjxUpload.chunkedMaxRetries) {
+				sjxUpload.chunkedFailed(uploadId, 'Too many failed requests');
+				return;
+			}
+			//Ask the server where to continue from
+			window.setTimeout(function () {
+				sjxUpload.chunkedRequest(uploadId, ['begin', uploadId, upload.file.size, upload.file.name]);
+			}, 1000 * upload.retries);
+		}
+	});
+};
+
+sjxUpload.chunkedAck = function (uploadId, nextChunk, offset) {
+	var upload = sjxUpload.chunkedUploads[uploadId],
+		file;
+
+	if (! upload) {
+		return;
+	}
+
+	file = upload.file;
+	upload.retries = 0;
+	jQuery(upload.target).trigger('sjxUpload:progress', [file, offset, file.size]);
+
+	if (offset >= file.size) {
+		sjxUpload.chunkedRequest(uploadId, ['finalize', uploadId]);
+		return;
+	}
+
+	sjxUpload.chunkedRequest(uploadId, [
+		'chunk', uploadId, nextChunk, file.slice(offset, offset + upload.chunkSize)
+	]);
+};
+
+sjxUpload.chunkedFinished = function (uploadId, eventName, eventArgs, forget) {
+	var upload = sjxUpload.chunkedUploads[uploadId],
+		file;
+
+	if (! upload) {
+		return;
+	}
+
+	file = upload.file;
+	delete sjxUpload.chunkedUploads[uploadId];
+
+	if (forget) {
+		try {
+			window.localStorage.removeItem(sjxUpload.getUploadKey(file));
+		} catch (e) {}
+	}
+
+	jQuery(upload.target).trigger(eventName, [file].concat(eventArgs));
+};
+
+sjxUpload.chunkedComplete = function (uploadId) {
+	sjxUpload.chunkedFinished(uploadId, 'sjxUpload:complete', [], true);
+};
+
+sjxUpload.chunkedFailed = function (uploadId, message) {
+	//The upload id is remembered, so that the upload can be resumed later
+	sjxUpload.chunkedFinished(uploadId, 'sjxUpload:failed', [message], false);
+};
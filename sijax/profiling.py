@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.profiling
+    ~~~~~~~~~~~~~~~
+
+    Provides an opt-in profiler, which profiles a sampled fraction
+    of the calls to chosen functions, while the application is running.
+
+    Profiles are kept in a rolling per-function store, and can be dumped
+    as ``pstats`` files (``cProfile`` mode) or collapsed stacks
+    (stack sampler mode, for flame graph tools).
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import (Counter, deque)
+from types import GeneratorType
+
+from .exception import SijaxError
+
+
+def _collapse(frame):
+    """Returns the stack ending at the given frame, in the collapsed
+    format (``outer;inner;innermost``)."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class _StackSampler(object):
+    """Samples the stacks of the threads running profiled calls,
+    from a background thread (which exits when there's nothing to sample)."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        # thread id => Counter of collapsed stacks
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id, counter):
+        with self._lock:
+            self._active[thread_id] = counter
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, thread_id):
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            for thread_id, counter in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    counter[_collapse(frame)] += 1
+
+
+class CallProfiler(object):
+    """Profiles a sampled fraction of the calls to chosen functions.
+
+    Give it to the Sijax instance (see :meth:`sijax.Sijax.set_profiler`),
+    and switch profiling on and off at runtime::
+
+        profiler = CallProfiler()
+        sijax_instance.set_profiler(profiler)
+
+        # profile 5% of the calls to a function that got slow
+        profiler.enable('slow_function', rate=0.05)
+
+        # later on
+        profiler.dump('slow_function', '/tmp/slow_function.pstats')
+        profiler.disable('slow_function')
+
+    Two modes are available:
+
+    - :attr:`MODE_CPROFILE` - calls are profiled using ``cProfile``,
+      which is precise, but slows the profiled calls down a lot
+    - :attr:`MODE_SAMPLER` - the stack of the thread running the call
+      is sampled every ``interval`` seconds (from another thread),
+      which costs very little, but misses short calls
+
+    For streaming functions, only the time spent inside the function
+    is profiled (not the time the stream waits for the browser).
+    Calls made using :meth:`sijax.Sijax.execute_callback` directly
+    are profiled by the name of the callback function.
+    The last ``max_samples`` profiles of each function are kept.
+
+    Calls to functions that are not being profiled
+    (and calls that are not sampled) are not slowed down.
+
+    :param mode: :attr:`MODE_CPROFILE` or :attr:`MODE_SAMPLER`
+    :param max_samples: how many profiles to keep per function
+    :param interval: how often to sample stacks (sampler mode), in seconds
+    """
+
+    MODE_CPROFILE = 'cprofile'
+    MODE_SAMPLER = 'sampler'
+
+    def __init__(self, mode=MODE_CPROFILE, max_samples=100, interval=0.005):
+        if mode not in (self.__class__.MODE_CPROFILE, self.__class__.MODE_SAMPLER):
+            raise SijaxError('Unknown profiling mode: %s' % mode)
+        self.mode = mode
+        self.max_samples = max_samples
+        # function name => sampling rate
+        self._rates = {}
+        # function name => deque of profiles (or stack counters)
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._sampler = _StackSampler(interval)
+
+    def enable(self, function_name, rate=1.0):
+        """Starts profiling the given fraction (0 to 1)
+        of the calls to the function."""
+        self._rates[function_name] = rate
+        return self
+
+    def disable(self, function_name):
+        """Stops profiling calls to the function
+        (the profiles collected so far are kept)."""
+        self._rates.pop(function_name, None)
+        return self
+
+    def clear(self, function_name=None):
+        """Forgets the profiles of the given function (or of all of them)."""
+        with self._lock:
+            if function_name is None:
+                self._profiles = {}
+            else:
+                self._profiles.pop(function_name, None)
+
+    def _should_sample(self, function_name):
+        rate = self._rates.get(function_name)
+        return rate is not None and random.random() < rate
+
+    def _store(self, function_name, profile):
+        with self._lock:
+            profiles = self._profiles.get(function_name)
+            if profiles is None:
+                profiles = deque(maxlen=self.max_samples)
+                self._profiles[function_name] = profiles
+            profiles.append(profile)
+
+    def _start(self, profile):
+        """Starts profiling in the current thread,
+        returning False if that's not possible."""
+        if self.mode == self.__class__.MODE_SAMPLER:
+            self._sampler.start(threading.current_thread().ident, profile)
+            return True
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            return False
+        return True
+
+    def _stop(self, profile):
+        if self.mode == self.__class__.MODE_SAMPLER:
+            self._sampler.stop(threading.current_thread().ident)
+        else:
+            profile.disable()
+
+    def _profile(self, function_name, execute, *args, **kwargs):
+        """Runs ``execute`` (:meth:`sijax.Sijax.execute_callback`),
+        profiling it (and the stream it returns, if any)."""
+        if self.mode == self.__class__.MODE_SAMPLER:
+            profile = Counter()
+        else:
+            profile = cProfile.Profile()
+        if not self._start(profile):
+            return execute(*args, **kwargs)
+        try:
+            result = execute(*args, **kwargs)
+        finally:
+            self._stop(profile)
+        if isinstance(result, GeneratorType):
+            return self._profile_stream(function_name, profile, result)
+        self._store(function_name, profile)
+        return result
+
+    def _profile_stream(self, function_name, profile, stream):
+        try:
+            while True:
+                is_profiling = self._start(profile)
+                try:
+                    chunk = next(stream)
+                except StopIteration:
+                    return
+                finally:
+                    if is_profiling:
+                        self._stop(profile)
+                yield chunk
+        finally:
+            stream.close()
+            self._store(function_name, profile)
+
+    def get_samples_count(self, function_name):
+        """Returns the number of profiles kept for the function."""
+        with self._lock:
+            return len(self._profiles.get(function_name, ()))
+
+    def _get_profiles(self, function_name, mode):
+        if self.mode != mode:
+            raise SijaxError('Not available in %s mode' % self.mode)
+        with self._lock:
+            return list(self._profiles.get(function_name, ()))
+
+    def get_stats(self, function_name):
+        """Returns the profiles of the function, merged into
+        a ``pstats.Stats`` object (None if there are none).
+
+        Only available in :attr:`MODE_CPROFILE`.
+        """
+        profiles = self._get_profiles(function_name, self.__class__.MODE_CPROFILE)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def get_collapsed_stacks(self, function_name):
+        """Returns a dictionary of collapsed stacks (``outer;inner``)
+        to the number of times they were sampled, for the function.
+
+        Only available in :attr:`MODE_SAMPLER`.
+        """
+        profiles = self._get_profiles(function_name, self.__class__.MODE_SAMPLER)
+        stacks = Counter()
+        for profile in profiles:
+            stacks.update(profile)
+        return dict(stacks)
+
+    def dump(self, function_name, path):
+        """Writes the profiles of the function to the given file -
+        a ``pstats`` file (:attr:`MODE_CPROFILE`) or a collapsed stacks
+        file, one ``stack count`` line per stack (:attr:`MODE_SAMPLER`).
+
+        Returns False (writing nothing) if there are no profiles.
+        """
+        if self.mode == self.__class__.MODE_CPROFILE:
+            stats = self.get_stats(function_name)
+            if stats is None:
+                return False
+            stats.dump_stats(path)
+            return True
+
+        stacks = self.get_collapsed_stacks(function_name)
+        if not stacks:
+            return False
+        with io.open(path, 'w', encoding='utf-8') as fp:
+            for stack, count in sorted(stacks.items()):
+                fp.write('%s %d\n' % (stack, count))
+        return True
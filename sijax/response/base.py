@@ -15,16 +15,111 @@ from __future__ import (absolute_import, unicode_literals)
 
 
 from builtins import object
+from six import string_types
 from ..helper import json
 from ..exception import SijaxError
+from ..instrument import (CallRecord, get_size)
 from types import GeneratorType
 from functools import partial
+import array
+import base64
+import sys
+
+
+class _TypedArray(object):
+    """Wraps a buffer-protocol object (``array.array``, numpy arrays, etc.),
+    which is to be passed to a javascript function as a typed array.
+
+    The object's data is read when the response is serialized
+    (no view of it is kept until then, so it's not locked against resizing).
+    No copy of the data is made, unless the data is not contiguous
+    or not little-endian.
+    """
+
+    #: struct format character => (kind, signed)
+    _KINDS = {
+        'b': 'int', 'h': 'int', 'i': 'int', 'l': 'int', 'q': 'int',
+        'B': 'uint', 'H': 'uint', 'I': 'uint', 'L': 'uint', 'Q': 'uint',
+        'f': 'float', 'd': 'float',
+    }
+
+    #: array.array typecodes (unsigned) by item size, used for byte swapping
+    _SWAP_TYPECODES = {2: 'H', 4: 'I', 8: 'Q'}
+
+    def __init__(self, value, view):
+        self.value = value
+        # Unsupported formats are rejected right away
+        self._parse_format(view)
+
+    def _parse_format(self, view):
+        """Returns the dtype of the view and whether it's big-endian."""
+        fmt = view.format
+        big_endian = sys.byteorder == 'big'
+        if fmt[:1] in ('<', '>', '!', '=', '@'):
+            big_endian = fmt[0] in ('>', '!') or (fmt[0] in ('=', '@') and
+                                                  sys.byteorder == 'big')
+            fmt = fmt[1:]
+
+        if fmt not in self.__class__._KINDS:
+            raise SijaxError('Unsupported typed array format: %s' % view.format)
+        dtype = '%s%d' % (self.__class__._KINDS[fmt], view.itemsize * 8)
+        return dtype, big_endian
+
+    def to_dict(self, binary):
+        """Returns a serializable representation of the typed array
+        (with the data that it has right now).
+
+        :param binary: whether the data can be sent as raw bytes (binary
+                       codecs) or needs to be base64 encoded (JSON)
+        """
+        view = memoryview(self.value)
+        dtype, big_endian = self._parse_format(view)
+        shape = list(view.shape)
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes())
+        if big_endian and view.itemsize > 1:
+            # Javascript typed arrays use the platform's byte order,
+            # which is little-endian practically everywhere
+            swapped = array.array(
+                self.__class__._SWAP_TYPECODES[view.itemsize], view.tobytes())
+            swapped.byteswap()
+            view = memoryview(swapped)
+        data = view
+        if not binary:
+            data = base64.b64encode(view).decode('ascii')
+        return {'dtype': dtype, 'shape': shape, 'data': data}
+
+    @staticmethod
+    def wrap(value):
+        """Returns a typed array wrapper for buffer-protocol objects,
+        or None for any other value."""
+        if value is None or isinstance(value, (string_types, bytes, bool, int,
+                                               float, list, tuple, dict)):
+            return None
+        try:
+            view = memoryview(value)
+        except TypeError:
+            return None
+        try:
+            return _TypedArray(value, view)
+        finally:
+            if hasattr(view, 'release'):
+                view.release()
 
 
 class BaseResponse(object):
     """The response class is the way by which Sijax functions (handlers)
     pass information back to the browser. They do this by calling
     various methods, which queue commands until they're sent to the browser.
+
+    Every command method accepts an optional ``key`` argument.
+    A command queued with a key supersedes (takes the place of) a queued,
+    not yet sent, command with the same key. This is useful for progress
+    reports and other commands that only matter in their latest version::
+
+        for done in range(100):
+            obj_response.html('#progress', '%d%%' % done, key='progress')
+        # Only the last html() command gets sent
     """
 
     COMMAND_ALERT = 'alert'
@@ -41,6 +136,9 @@ class BaseResponse(object):
     JSON_INDENT = None
     JSON_SORT_KEYS = False
 
+    #: Command fields whose (string) values get interned in the
+    #: string table, when the compact response format is used.
+    COMPACT_INTERNED_FIELDS = ('type', 'selector', 'key', 'setType')
 
     def __init__(self, sijax_instance, request_args):
         """Constructs a new empty Sijax Response object.
@@ -56,11 +154,33 @@ class BaseResponse(object):
                              was invoked with
         """
         self._commands = []
+        # key => index in the commands list
+        self._keyed_commands = {}
         self._sijax = sijax_instance
+
+        #: How many queued commands got superseded by newer ones
+        #: (having the same ``key``)
+        self.superseded_count = 0
         self._request_args = request_args
+        # Set when the call is being timed (see Sijax.add_observer)
+        self._call_record = None
         self.dumps = partial(json.dumps, ensure_ascii=self.JSON_AS_ASCII,
                 separators=self.JSON_SEPARATORS, indent=self.JSON_INDENT,
-                sort_keys=self.JSON_SORT_KEYS)
+                sort_keys=self.JSON_SORT_KEYS, default=self._json_default)
+
+    @staticmethod
+    def _json_default(obj):
+        """Serializes objects that JSON doesn't support natively."""
+        if isinstance(obj, _TypedArray):
+            return obj.to_dict(binary=False)
+        raise TypeError('%r is not JSON serializable' % (obj, ))
+
+    @staticmethod
+    def _binary_default(obj):
+        """Serializes objects that binary codecs don't support natively."""
+        if isinstance(obj, _TypedArray):
+            return obj.to_dict(binary=True)
+        raise TypeError('%r is not serializable' % (obj, ))
 
     def _get_request_args(self):
         """Returns the arguments list to pass to callbacks.
@@ -70,12 +190,29 @@ class BaseResponse(object):
         """
         return self._request_args
 
-    def _add_command(self, cmd_type, params = None):
-        """Adds a raw command to the buffer to send to the client."""
+    def _add_command(self, cmd_type, params = None, key=None):
+        """Adds a raw command to the buffer to send to the client.
+
+        If a ``key`` is given, the command supersedes a queued command
+        with the same key (if any), which gets removed. The new command
+        is added at the end, so it still runs after the commands
+        queued before it.
+        """
         if params is None:
             params = {}
         params['type'] = cmd_type
 
+        if key is not None:
+            idx = self._keyed_commands.get(key)
+            if idx is not None:
+                del self._commands[idx]
+                keyed_commands = self._keyed_commands
+                for other_key, other_idx in keyed_commands.items():
+                    if other_idx > idx:
+                        keyed_commands[other_key] = other_idx - 1
+                self.superseded_count += 1
+            self._keyed_commands[key] = len(self._commands)
+
         self._commands.append(params)
         return self
 
@@ -91,9 +228,10 @@ class BaseResponse(object):
             # The alert() above got removed from the commands queue
         """
         self._commands = []
+        self._keyed_commands = {}
         return self
 
-    def alert(self, message):
+    def alert(self, message, key=None):
         """Sends a ``window.alert`` command to the browser.
 
         Example that shows a message box::
@@ -101,13 +239,13 @@ class BaseResponse(object):
             obj_response.alert('Alert message!')
         """
         params = {self.__class__.COMMAND_ALERT: message}
-        return self._add_command(self.__class__.COMMAND_ALERT, params)
+        return self._add_command(self.__class__.COMMAND_ALERT, params, key)
 
-    def _html(self, selector, html, set_type):
+    def _html(self, selector, html, set_type, key=None):
         params = {'selector': selector, 'html': html, 'setType': set_type}
-        return self._add_command(self.__class__.COMMAND_HTML, params)
+        return self._add_command(self.__class__.COMMAND_HTML, params, key)
 
-    def html(self, selector, html):
+    def html(self, selector, html, key=None):
         """Assigns the given html value to all elements
         matching the jQuery selector.
 
@@ -122,21 +260,21 @@ class BaseResponse(object):
         :param selector: the jQuery selector for which we'll replace the html
         :param html: the html text
         """
-        return self._html(selector, html, 'replace')
+        return self._html(selector, html, 'replace', key)
 
-    def html_append(self, selector, html):
+    def html_append(self, selector, html, key=None):
         """Same as :meth:`sijax.response.BaseResponse.html`,
         but appends instead of assigning a new value.
         """
-        return self._html(selector, html, "append")
+        return self._html(selector, html, "append", key)
 
-    def html_prepend(self, selector, html):
+    def html_prepend(self, selector, html, key=None):
         """Same as :meth:`sijax.response.BaseResponse.html`,
         but prepends instead of assigning a new value.
         """
-        return self._html(selector, html, 'prepend')
+        return self._html(selector, html, 'prepend', key)
 
-    def script(self, js):
+    def script(self, js, key=None):
         """Executes the given javascript code.
 
         Example::
@@ -148,9 +286,9 @@ class BaseResponse(object):
         the global namespace, unless you explicitly do it.
         """
         params = {self.__class__.COMMAND_SCRIPT: js}
-        return self._add_command(self.__class__.COMMAND_SCRIPT, params)
+        return self._add_command(self.__class__.COMMAND_SCRIPT, params, key)
 
-    def css(self, selector, property_name, value):
+    def css(self, selector, property_name, value, key=None):
         """Assigns a style property value to all elements
         matching the jQuery selector.
 
@@ -169,16 +307,16 @@ class BaseResponse(object):
         :param value: the new value to assign to the property
         """
         params = {'selector': selector, 'key': property_name, 'value': value}
-        return self._add_command(self.__class__.COMMAND_CSS, params)
+        return self._add_command(self.__class__.COMMAND_CSS, params, key)
 
-    def _attr(self, selector, property_name, value, set_type):
+    def _attr(self, selector, property_name, value, set_type, key=None):
         params = {
             'selector': selector, 'key': property_name,
             'value': value, 'setType': set_type
         }
-        return self._add_command(self.__class__.COMMAND_ATTR, params)
+        return self._add_command(self.__class__.COMMAND_ATTR, params, key)
 
-    def attr(self, selector, property_name, value):
+    def attr(self, selector, property_name, value, key=None):
         """Assigns an attribute value to all elements
         matching the jQuery selector.
 
@@ -193,19 +331,19 @@ class BaseResponse(object):
         :param property_name: the name of the property
         :param value: the new value to assign to the property
         """
-        return self._attr(selector, property_name, value, 'replace')
+        return self._attr(selector, property_name, value, 'replace', key)
 
-    def attr_append(self, selector, property_name, value):
+    def attr_append(self, selector, property_name, value, key=None):
         """Same as :meth:`sijax.response.BaseResponse.attr`,
         but appends instead of assigning a new value."""
-        return self._attr(selector, property_name, value, 'append')
+        return self._attr(selector, property_name, value, 'append', key)
 
-    def attr_prepend(self, selector, property_name, value):
+    def attr_prepend(self, selector, property_name, value, key=None):
         """Same as :meth:`sijax.response.BaseResponse.attr`,
         but prepends instead of assigning a new value."""
-        return self._attr(selector, property_name, value, 'prepend')
+        return self._attr(selector, property_name, value, 'prepend', key)
 
-    def remove(self, selector):
+    def remove(self, selector, key=None):
         """Removes all elements that match the jQuery selector from the DOM.
 
         Example which removes all DIV elements from the page::
@@ -215,10 +353,10 @@ class BaseResponse(object):
         Same as jQuery's: ``$(selector).remove()``
         """
         params = {self.__class__.COMMAND_REMOVE: selector}
-        return self._add_command(self.__class__.COMMAND_REMOVE, params)
+        return self._add_command(self.__class__.COMMAND_REMOVE, params, key)
 
 
-    def redirect(self, uri):
+    def redirect(self, uri, key=None):
         """Redirects the browser to the given URI.
 
         Example::
@@ -226,15 +364,28 @@ class BaseResponse(object):
             obj_response.redirect('http://example.com/')
 
         """
-        return self.script('window.location = %s;' % self.dumps(uri))
+        return self.script('window.location = %s;' % self.dumps(uri), key)
 
-    def call(self, js_func_name, func_params=None):
+    def call(self, js_func_name, func_params=None, key=None):
         """Calls the given javascript function with the given arguments list.
 
         Example which calls the browser's ``alert()`` function::
 
             obj_response.call('alert', ['Message'])
 
+        Arguments supporting the buffer protocol (``array.array``,
+        numpy arrays, etc.) are passed to the javascript function as
+        typed arrays (``Float64Array``, ``Int32Array``, etc.), without being
+        converted to lists first. Their (multi-dimensional) shape is
+        available as the ``shape`` property of the typed array::
+
+            obj_response.call('drawSeries', [array.array('d', points)])
+
+        Such arguments are read when the response is serialized (when it's
+        returned, or flushed by streaming functions), not when ``call()``
+        is called. They can still be changed (or resized) in the meantime,
+        and the changes are sent too - pass a copy to send the current data.
+
         :param js_func_name: the name of the javascript function to call
         :param func_params: a list of arguments to call the function with
         """
@@ -250,15 +401,126 @@ class BaseResponse(object):
             self.__class__.COMMAND_CALL: js_func_name,
             'params': func_params
         }
-        return self._add_command(self.__class__.COMMAND_CALL, params)
+
+        typed = []
+        for idx, value in enumerate(func_params):
+            typed_array = _TypedArray.wrap(value)
+            if typed_array is not None:
+                if not typed:
+                    params['params'] = func_params = list(func_params)
+                func_params[idx] = typed_array
+                typed.append(idx)
+        if typed:
+            # Tells the client which arguments to turn into typed arrays
+            params['typed'] = typed
+
+        return self._add_command(self.__class__.COMMAND_CALL, params, key)
+
+    @classmethod
+    def get_content_type(cls, sijax_instance):
+        """Returns the content type of responses of this class,
+        for the current request of the given Sijax instance."""
+        return sijax_instance.codec.content_type
+
+    def _get_compact_commands(self, commands=None):
+        """Returns the commands buffer list (or the given ``commands``)
+        in the compact format.
+
+        The compact format is an object containing a per-response
+        string table (``t``) and the list of commands (``c``).
+        Each command is a flat array of ``key, value`` pairs:
+
+        - the key is an index into the string table
+        - the value is an index into the string table for fields listed in
+          ``COMPACT_INTERNED_FIELDS``, or the literal value for other fields
+        - selectors are split after their last space and sent as
+          a ``[prefix, suffix]`` pair of indexes, because many commands
+          usually target elements under the same (long) selector prefix
+        - a negative key (``~index``) marks a literal value for an interned
+          field (used when that value is not a string)
+
+        ``Sijax.processCommands`` in ``sijax.js`` expands it back to
+        the regular list of command objects.
+        """
+        table = []
+        indexes = {}
+        interned_fields = self.__class__.COMPACT_INTERNED_FIELDS
+
+        def intern(string):
+            try:
+                return indexes[string]
+            except KeyError:
+                idx = indexes[string] = len(table)
+                table.append(string)
+                return idx
+
+        if commands is None:
+            commands = self._commands
+
+        encoded_commands = []
+        for command in commands:
+            encoded = []
+            for key, value in command.items():
+                if key not in interned_fields:
+                    encoded.extend((intern(key), value))
+                elif not isinstance(value, string_types):
+                    encoded.extend((~intern(key), value))
+                elif key == 'selector' and ' ' in value:
+                    split_at = value.rindex(' ') + 1
+                    encoded.extend((intern(key), [intern(value[:split_at]),
+                                                  intern(value[split_at:])]))
+                else:
+                    encoded.extend((intern(key), intern(value)))
+            encoded_commands.append(encoded)
+
+        return {'t': table, 'c': encoded_commands}
 
     def _get_json(self):
         """Returns a JSON representation of the commands buffer list.
 
         The client side code will loop over the list and execute all the
         commands in order.
+
+        If the client asked for the compact format, the commands are
+        encoded using :meth:`_get_compact_commands` first.
         """
-        return self.dumps(self._commands)
+        return self.dumps(self._get_commands_payload())
+
+    def _get_commands_payload(self, commands=None):
+        """Returns the (not yet serialized) commands buffer list
+        (or the given ``commands``), in the format that the client asked for."""
+        if commands is None:
+            commands = self._commands
+        sijax = self._sijax
+        if sijax is not None and sijax.response_format == sijax.FORMAT_COMPACT:
+            return self._get_compact_commands(commands)
+        return commands
+
+    def _get_output(self):
+        """Returns the serialized commands buffer, to be passed
+        to the browser.
+
+        This is JSON (see :meth:`_get_json`), unless the client asked for
+        a binary codec, in which case the result is bytes.
+        """
+        record = self._call_record
+        if record is None:
+            return self._serialize()
+        started = record._start_stage(CallRecord.STAGE_SERIALIZE)
+        output = self._serialize()
+        record.commands_count += len(self._commands)
+        record.response_size += get_size(output)
+        record._end_stage(CallRecord.STAGE_SERIALIZE, started)
+        return output
+
+    def _serialize(self):
+        """Implements :meth:`_get_output`."""
+        if self._sijax is not None:
+            codec = self._sijax.codec
+            if codec.is_binary:
+                return codec.dumps(self._get_commands_payload(),
+                                   default=self._binary_default)
+        return self._get_json()
 
     def _perform_handler_call(self, callback, args):
         """Performs the actual calling of the Sijax handler function.
@@ -268,6 +530,26 @@ class BaseResponse(object):
 
         Exceptions raised by the Sijax handler function won't be handled.
         """
+        record = self._call_record
+        if record is None:
+            return self._call_handler(callback, args)
+
+        stage = record._next_chain_stage()
+        started = record._start_stage(stage)
+        try:
+            response = self._call_handler(callback, args)
+        except Exception as e:
+            record._end_stage(stage, started, e)
+            raise
+        if isinstance(response, GeneratorType):
+            # The actual work happens while iterating
+            return record._time_generator(stage, response, started)
+        record._end_stage(stage, started)
+        return response
+
+    def _call_handler(self, callback, args):
+        """Calls the handler, handling bad calls
+        (see :meth:`_perform_handler_call`)."""
         try:
             return callback(self, *args)
         except TypeError:
@@ -280,6 +562,8 @@ class BaseResponse(object):
                 # TypeError raised from somewhere within the Sijax handler
                 raise
             # Invalid call to the handler (bad arguments)
+            if self._call_record is not None:
+                self._call_record.status = CallRecord.STATUS_INVALID_CALL
             evt_invalid_call = self._sijax.__class__.EVENT_INVALID_CALL
             return self._sijax.get_event(evt_invalid_call)(self, callback)
 
@@ -310,9 +594,10 @@ class BaseResponse(object):
         a list of commands that we need to pass to the browser (in order).
 
         :param call_chain: a list of two-tuples (callback, args list) to call
-        :return: JSON string to be passed to the browser
+        :return: JSON string (or bytes, for binary codecs)
+                 to be passed to the browser
         """
         for callback, args in call_chain:
             self._process_callback(callback, args)
-        return self._get_json()
+        return self._get_output()
 
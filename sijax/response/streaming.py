@@ -18,10 +18,13 @@ from __future__ import (absolute_import, unicode_literals)
 """
 
 
-from builtins import next
-from .base import BaseResponse
+from collections import deque
 from types import GeneratorType
 
+from .base import BaseResponse
+from ..exception import SijaxError
+from ..instrument import (CallRecord, get_size)
+
 
 class StreamingIframeResponse(BaseResponse):
     """A response class used with iframe-calls, that supports streaming.
@@ -49,46 +52,151 @@ class StreamingIframeResponse(BaseResponse):
 
     Your don't need to explicitly ``yield`` at the end of a streaming function.
     What remains unsent when the function exits will eventually get sent.
+
+    Clients that read the response using ``fetch()`` (see
+    :attr:`sijax.Sijax.TRANSPORT_FETCH`) get newline-delimited JSON
+    (NDJSON) instead of html markup - one line per flush, without
+    any padding.
     """
 
+    #: The maximum size (in bytes) of the chunks waiting to be sent
+    #: (pushed frames, see :meth:`push_frame`). Pushing more,
+    #: without yielding to get them sent, raises a :class:`SijaxError`
+    #: (Comet hub subscriptions keep such messages queued instead).
+    MAX_OUTBOX_BYTES = 8 * 1024 * 1024
+
     def __init__(self, *args, **kwargs):
         BaseResponse.__init__(self, *args, **kwargs)
         self._is_first_flush = True
-
-    def _flush(self):
-        """Generates command output to flush to the browser.
+        # Chunks waiting to be sent, in order (and their size in bytes)
+        self._outbox = deque()
+        self._outbox_size = 0
+        self._is_ndjson = self._is_ndjson_requested(self._sijax)
+
+    @staticmethod
+    def _is_ndjson_requested(sijax_instance):
+        if sijax_instance is None:
+            return False
+        return sijax_instance.transport == sijax_instance.__class__.TRANSPORT_FETCH
+
+    @classmethod
+    def get_content_type(cls, sijax_instance):
+        """Streaming responses are html markup (or NDJSON, for ``fetch()``),
+        regardless of the codec that the client asked for."""
+        if cls._is_ndjson_requested(sijax_instance):
+            return 'application/x-ndjson; charset=utf-8'
+        return 'text/html; charset=utf-8'
+
+    def _get_frame_key(self):
+        """Identifies the way :meth:`_frame` frames commands
+        (and serializes them) for this response."""
+        sijax = self._sijax
+        response_format = None if sijax is None else sijax.response_format
+        return (self.__class__, response_format, self._is_ndjson)
+
+    def _frame(self, json_string):
+        """Wraps the commands JSON in the markup that gets it
+        executed by the parent window.
 
         The output is not JSON, because it's evaluated in an
         iframe. We're generating some html markup with script tags
         to pass our commands JSON to the parent, which will then execute it.
 
-        We're also pushing some garbage content on the first flush,
-        to get around a buffering "issue" certain browsers employ.
-        Such browsers include IE and Google Chrome.
-        They're generally buffering the first ~1500 bytes of data,
-        before they start interpretting it.
+        For ``fetch()`` clients, it's a single line of JSON instead.
         """
-
-        output = """
+        if self._is_ndjson:
+            if '\n' in json_string:
+                # Only possible with JSON_INDENT (newlines inside
+                # strings are escaped), so it's safe to remove them
+                json_string = json_string.replace('\n', '')
+            return '%s\n' % json_string
+        return """
         <script type="text/javascript">
             window.parent.Sijax.processCommands(%s);
         </script>
-        """ % self._get_json()
+        """ % json_string
 
-        self.clear_commands()
+    def _get_padding(self):
+        """Returns the garbage content to push before the first flush
+        (or an empty string for the other ones).
+
+        Certain browsers (like IE and Google Chrome) generally buffer
+        the first ~1500 bytes of data, before they start interpretting it.
+        This doesn't apply to ``fetch()`` clients.
+        """
+        if not self._is_first_flush or self._is_ndjson:
+            return ''
+        self._is_first_flush = False
+        return "%s%s" % ("\n<script type='text/javascript'></script>\n\n",
+                         "\n" * 2000)
 
-        if self._is_first_flush:
-            # Push some more data initially, because certain
-            # browsers buffer the first X bytes of output
-            self._is_first_flush = False
-            output = "%s%s%s" % (
-                "\n<script type='text/javascript'></script>\n\n",
-                "\n" * 2000,
-                output
-            )
+    def _flush(self):
+        """Generates command output to flush to the browser.
 
+        See :meth:`_frame` and :meth:`_get_padding`.
+        """
+        record = self._call_record
+        if record is None:
+            return self._get_flush_output()
+        commands_count = len(self._commands)
+        started = record._start_stage(CallRecord.STAGE_FLUSH)
+        output = self._get_flush_output()
+        record.commands_count += commands_count
+        record.response_size += get_size(output)
+        record._end_stage(CallRecord.STAGE_FLUSH, started)
         return output
 
+    def _get_flush_output(self):
+        """Implements :meth:`_flush`."""
+        output = self._frame(self._get_json())
+        self.clear_commands()
+        return "%s%s" % (self._get_padding(), output)
+
+    def push_frame(self, frame):
+        """Queues an already framed and encoded (bytes) chunk,
+        to be sent on the next flush, after the commands queued so far.
+
+        This lets the same bytes be sent to many browsers,
+        without them being serialized for each one
+        (see :class:`sijax.plugin.comet.Hub`).
+
+        At most :attr:`MAX_OUTBOX_BYTES` can wait to be sent.
+        """
+        size = get_size(frame)
+        if not self._has_room(size):
+            raise SijaxError('Too many frames pushed without flushing '
+                             '(more than %d bytes)'
+                             % self.__class__.MAX_OUTBOX_BYTES)
+        if len(self._commands) != 0:
+            self._queue_chunk(self._flush())
+        padding = self._get_padding()
+        if padding:
+            self._queue_chunk(padding)
+        self._queue_chunk(frame, size)
+        if self._call_record is not None:
+            self._call_record.response_size += get_size(padding) + size
+        return self
+
+    def _has_room(self, size):
+        """Tells whether a frame of the given size can be pushed
+        (see :attr:`MAX_OUTBOX_BYTES`). A single frame always can."""
+        return (self._outbox_size == 0 or
+                self._outbox_size + size <= self.__class__.MAX_OUTBOX_BYTES)
+
+    def _queue_chunk(self, chunk, size=None):
+        self._outbox.append(chunk)
+        self._outbox_size += get_size(chunk) if size is None else size
+
+    def _drain(self):
+        """Generates everything that's waiting to be sent."""
+        if len(self._commands) != 0:
+            self._queue_chunk(self._flush())
+        outbox = self._outbox
+        while outbox:
+            chunk = outbox.popleft()
+            self._outbox_size -= get_size(chunk)
+            yield chunk
+
     def _process_callback(self, callback, args):
         """Processes a callback to a normal or a streaming function.
 
@@ -112,16 +220,22 @@ class StreamingIframeResponse(BaseResponse):
         response = self._perform_handler_call(callback, args)
         if isinstance(response, GeneratorType):
             # Real streaming function using a generator to flush
-            while True:
-                # we don't really care what it yields..
-                next(response)
-                if len(self._commands) != 0:
-                    yield self._flush()
+            # we don't really care what it yields..
+            for _ in response:
+                for chunk in self._drain():
+                    yield chunk
         else:
             # Normal (non-streaming) function
             # Let's flush implicitly for such functions
-            if len(self._commands) != 0:
-                yield self._flush()
+            for chunk in self._drain():
+                yield chunk
+
+    def _encode_chunk(self, chunk):
+        """Encodes a chunk of output, unless it's already encoded
+        (see :meth:`push_frame`)."""
+        if isinstance(chunk, bytes):
+            return chunk
+        return chunk.encode("utf-8")
 
     def _process_call_chain(self, call_chain):
         """Executes all the callbacks in the chain.
@@ -137,7 +251,7 @@ class StreamingIframeResponse(BaseResponse):
         for callback, args in call_chain:
             generator = self._process_callback(callback, args)
             for string in generator:
-                yield string.encode("utf-8")
+                yield self._encode_chunk(string)
 #                yield bytes(string, "utf-8")
 # in Python 3 every string is unicode and `bytes` will encode accordingly
 # in Python 2, using `bytes` from the future module ensures a byte string but
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.testing
+    ~~~~~~~~~~~~~
+
+    Provides a client for calling Sijax functions in-process (in tests
+    and benchmarks), with native Python arguments, getting back the
+    commands that were sent to the browser.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import base64
+import re
+
+from six import string_types
+
+from .exception import SijaxError
+from .helper import json
+from .instrument import (CallRecord, Observer)
+from .response import BaseResponse
+
+
+# The commands JSON inside a frame of an iframe streaming response
+_IFRAME_FRAME = re.compile(r'processCommands\((.*)\);\s*</script>\s*$', re.DOTALL)
+
+
+def expand_commands(payload):
+    """Returns the list of command objects in the given (decoded) payload,
+    expanding it first if it's in the compact format
+    (see :meth:`sijax.response.BaseResponse._get_compact_commands`)."""
+    if not isinstance(payload, dict):
+        return payload
+    table = payload['t']
+    interned = BaseResponse.COMPACT_INTERNED_FIELDS
+    commands = []
+    for encoded in payload['c']:
+        command = {}
+        for key, value in zip(encoded[::2], encoded[1::2]):
+            if key < 0:
+                command[table[~key]] = value
+            elif table[key] not in interned:
+                command[table[key]] = value
+            elif isinstance(value, list):
+                command[table[key]] = table[value[0]] + table[value[1]]
+            else:
+                command[table[key]] = table[value]
+        commands.append(command)
+    return commands
+
+
+class _UnserializedResponseMixin(object):
+    """Makes a response class hand out its commands buffer
+    as it is, instead of serializing it."""
+
+    def _serialize(self):
+        return list(self._commands)
+
+    def _get_flush_output(self):
+        commands = list(self._commands)
+        self.clear_commands()
+        return commands
+
+    def _encode_chunk(self, chunk):
+        return chunk
+
+
+_unserialized_classes = {}
+
+
+def _get_unserialized_class(response_class):
+    try:
+        return _unserialized_classes[response_class]
+    except KeyError:
+        name = str('Unserialized%s' % response_class.__name__)
+        cls = type(name, (_UnserializedResponseMixin, response_class), {})
+        _unserialized_classes[response_class] = cls
+        return cls
+
+
+class _RecordCollector(Observer):
+
+    def __init__(self):
+        self.records = []
+        # The status to start calls with (see Sijax.process_request)
+        self.status = None
+
+    def call_started(self, record):
+        if self.status is not None:
+            record.status = self.status
+
+    def observe(self, record):
+        self.records.append(record)
+
+
+class CallResult(object):
+    """The result of a :meth:`SijaxTestClient.call`."""
+
+    def __init__(self, batches, output, record, is_streaming, is_serialized):
+        #: The commands sent to the browser, as a list of batches -
+        #: one per flush for streaming functions, a single one otherwise
+        self.batches = batches
+
+        #: What the function returned, as it would be sent to the browser
+        #: (a string or bytes, or a list of chunks for streaming functions).
+        #: None if the call was not serialized.
+        self.output = output
+
+        #: The :class:`sijax.instrument.CallRecord` of the call
+        self.record = record
+        self.is_streaming = is_streaming
+        self.is_serialized = is_serialized
+
+    @property
+    def commands(self):
+        """All the commands sent to the browser, in order
+        (dictionaries, having a ``type`` key)."""
+        return [command for batch in self.batches for command in batch]
+
+    def get_commands(self, command_type):
+        """Returns the commands of the given type (``alert``, ``html``, etc.)."""
+        return [command for command in self.commands
+                if command.get('type') == command_type]
+
+    @property
+    def status(self):
+        """The status of the call (see :class:`sijax.instrument.CallRecord`)."""
+        return self.record.status
+
+    @property
+    def duration(self):
+        """How long the call took (including serialization), in seconds."""
+        return self.record.duration
+
+    def get_stage_time(self, name):
+        """Returns the time spent in the given stage of the call
+        (see :class:`sijax.instrument.CallRecord`)."""
+        return self.record.get_stage_time(name)
+
+    @property
+    def request_size(self):
+        """The size of the encoded arguments (0, if not serialized)."""
+        return self.record.request_size
+
+    @property
+    def response_size(self):
+        """The size of what was sent to the browser (None, if not serialized)."""
+        if not self.is_serialized:
+            return None
+        return self.record.response_size
+
+
+class SijaxTestClient(object):
+    """Calls the functions registered with a Sijax instance, the way
+    the browser would, and decodes the commands it gets back::
+
+        client = SijaxTestClient(sijax_instance)
+
+        result = client.call('say_hello', 'John')
+        self.assertEqual('Hello, John!', result.get_commands('alert')[0]['alert'])
+
+        # streaming functions (Comet, etc.) get a batch per flush
+        result = client.call('count_to', 3)
+        self.assertEqual(3, len(result.batches))
+
+    The arguments are encoded (using the codec that the call asks for)
+    and the response is decoded, so the call goes through the same
+    steps as a real request. Pass ``serialize=False`` to skip encoding
+    and serialization - the function gets the arguments as they are,
+    and its commands are collected before they're serialized. This is
+    useful for profiling functions separately from serialization.
+
+    The client uses the instance it's given, and is not meant to be
+    used from many threads at once.
+
+    :param sijax_instance: the :class:`sijax.Sijax` instance to call
+    """
+
+    _CALL_OPTIONS = ('data', 'codec', 'response_format', 'transport', 'serialize')
+
+    def __init__(self, sijax_instance):
+        self.sijax_instance = sijax_instance
+
+    def call(self, function_name, *args, **options):
+        """Calls the given function with the given arguments,
+        returning a :class:`CallResult`.
+
+        Streaming responses are consumed right away.
+
+        :param data: more request data (like form values, for uploads)
+        :param codec: the codec to ask for (``msgpack``, etc.)
+        :param response_format: the response format to ask for
+                                (see :attr:`sijax.Sijax.FORMAT_COMPACT`)
+        :param transport: the transport that the request claims to use
+                          (see :attr:`sijax.Sijax.TRANSPORT_FETCH`)
+        :param serialize: whether to encode the arguments and serialize
+                          the response (defaults to True)
+        """
+        for option in options:
+            if option not in self.__class__._CALL_OPTIONS:
+                raise SijaxError('Unknown option: %s' % option)
+        serialize = options.get('serialize', True)
+        inst = self.sijax_instance
+        cls = inst.__class__
+
+        data = dict(options.get('data') or {})
+        data[cls.PARAM_REQUEST] = function_name
+        for param, option in ((cls.PARAM_CODEC, 'codec'),
+                              (cls.PARAM_FORMAT, 'response_format'),
+                              (cls.PARAM_TRANSPORT, 'transport')):
+            if options.get(option) is not None:
+                data[param] = options[option]
+        if serialize:
+            data[cls.PARAM_ARGS] = self._encode_args(list(args), data)
+
+        collector = _RecordCollector()
+        inst.add_observer(collector)
+        try:
+            inst.set_data(data)
+            if serialize:
+                response = inst.process_request()
+            else:
+                if function_name not in inst._callbacks:
+                    collector.status = CallRecord.STATUS_INVALID_REQUEST
+                response = self._execute_unserialized(function_name, list(args))
+            is_streaming = not isinstance(response, (list, bytes) + string_types)
+            if is_streaming:
+                try:
+                    output = list(response)
+                finally:
+                    response.close()
+            else:
+                output = response
+        finally:
+            inst.remove_observer(collector)
+
+        if is_streaming:
+            batches = []
+            for chunk in output:
+                batches.extend(self._decode_chunk(chunk))
+        else:
+            batches = [self._decode_output(output)]
+        return CallResult(batches, output if serialize else None,
+                          collector.records[-1], is_streaming, serialize)
+
+    def _encode_args(self, args, data):
+        inst = self.sijax_instance
+        codec_name = data.get(inst.__class__.PARAM_CODEC)
+        codec = inst._codecs.get(codec_name, inst._default_codec)
+        encoded = codec.dumps(args)
+        if codec.is_binary:
+            # Binary codecs get their arguments base64 encoded
+            return base64.b64encode(encoded).decode('ascii')
+        return encoded
+
+    def _execute_unserialized(self, function_name, args):
+        inst = self.sijax_instance
+        cls = inst.__class__
+        if function_name in inst._callbacks:
+            options = dict(inst._callbacks[function_name])
+        else:
+            args = [function_name]
+            callback = inst.get_event(cls.EVENT_INVALID_REQUEST)
+            options = {cls.PARAM_CALLBACK: callback}
+        response_class = options.get(cls.PARAM_RESPONSE_CLASS, BaseResponse)
+        options[cls.PARAM_RESPONSE_CLASS] = _get_unserialized_class(response_class)
+        # Recorded like Sijax.process_request does it (there's always
+        # an observer - the collector). Outputs which are not serialized
+        # have no size (see sijax.instrument.get_size).
+        record = CallRecord(function_name, list(inst._observers), inst._data)
+        return inst._execute_callback(function_name, record, args, **options)
+
+    def _decode_output(self, output):
+        if isinstance(output, list):
+            return output
+        return expand_commands(self.sijax_instance.codec.loads(output))
+
+    def _decode_chunk(self, chunk):
+        """Returns the batches of commands in a chunk of a stream."""
+        if isinstance(chunk, list):
+            # Not serialized (only pushed frames are)
+            return [chunk] if chunk else []
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8')
+        if not isinstance(chunk, string_types):
+            return []
+
+        inst = self.sijax_instance
+        if inst.transport == inst.__class__.TRANSPORT_FETCH:
+            return [expand_commands(json.loads(line))
+                    for line in chunk.splitlines() if line.strip()]
+        match = _IFRAME_FRAME.search(chunk)
+        if match is None:
+            # Padding
+            return []
+        return [expand_commands(json.loads(match.group(1)))]
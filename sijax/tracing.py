@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals)
+
+"""
+    sijax.tracing
+    ~~~~~~~~~~~~~
+
+    Provides tracing spans for Sijax calls (the whole call, and each
+    of its stages - see :class:`sijax.instrument.CallRecord`).
+
+    Spans go to OpenTelemetry, when it's installed, so that Sijax calls
+    show up in the same traces as the spans of the code they run
+    (database queries, etc.). An in-memory tracer is provided as well,
+    for tests and for environments without OpenTelemetry.
+
+    :copyright: (c) 2011 by Slavi Pantaleev.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+
+
+import binascii
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .helper import (otel_trace, otel_context)
+from .instrument import Observer
+
+
+def _random_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+class Span(object):
+    """A span recorded by :class:`InMemoryTracer`."""
+
+    def __init__(self, name, parent):
+        self.name = name
+
+        #: The parent :class:`Span` (None for root spans)
+        self.parent = parent
+        self.trace_id = _random_id(16) if parent is None else parent.trace_id
+        self.span_id = _random_id(8)
+        self.attributes = {}
+
+        #: The exception that the span ended with (if any)
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def duration(self):
+        """How long the span took, in seconds (None while it's running)."""
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def __repr__(self):
+        return '<Span %s>' % self.name
+
+
+class InMemoryTracer(object):
+    """A tracer keeping the finished spans in memory, instead of
+    exporting them somewhere::
+
+        tracer = InMemoryTracer()
+        install_tracing(sijax_instance, tracer)
+
+        # after some calls
+        for span in tracer.get_finished_spans():
+            print(span.name, span.duration, span.attributes)
+
+    Application code can add its own spans, which become
+    children of the span being run in the current thread::
+
+        def handler(obj_response):
+            with tracer.span('query'):
+                run_query()
+
+    :param max_spans: how many finished spans to keep
+                      (the oldest ones are dropped)
+    """
+
+    def __init__(self, max_spans=10000):
+        self.max_spans = max_spans
+        self._finished = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_active(self):
+        active = getattr(self._local, 'active', None)
+        if active is None:
+            active = self._local.active = []
+        return active
+
+    @property
+    def current_span(self):
+        """The span that is active in the current thread (or None)."""
+        active = self._get_active()
+        return active[-1] if active else None
+
+    def start_span(self, name, parent=None):
+        """Starts a span, which is a child of ``parent``
+        (or of the current span, if None)."""
+        if parent is None:
+            parent = self.current_span
+        return Span(name, parent)
+
+    def set_attributes(self, span, attributes):
+        span.attributes.update(attributes)
+
+    def set_error(self, span, error):
+        span.error = error
+
+    def end_span(self, span):
+        span.end_time = time.time()
+        with self._lock:
+            self._finished.append(span)
+            if len(self._finished) > self.max_spans:
+                del self._finished[0]
+
+    def activate(self, span):
+        """Makes the span the current one (in this thread),
+        returning a token for :meth:`deactivate`."""
+        active = self._get_active()
+        active.append(span)
+        return len(active)
+
+    def deactivate(self, token):
+        del self._get_active()[token - 1:]
+
+    @contextmanager
+    def span(self, name):
+        """A context manager, running its block in a new
+        (child of the current) span."""
+        span = self.start_span(name)
+        token = self.activate(span)
+        try:
+            yield span
+        except Exception as e:
+            self.set_error(span, e)
+            raise
+        finally:
+            self.deactivate(token)
+            self.end_span(span)
+
+    def get_finished_spans(self):
+        """Returns the finished spans, in the order they finished."""
+        with self._lock:
+            return list(self._finished)
+
+    def clear(self):
+        """Forgets the finished spans."""
+        with self._lock:
+            self._finished = []
+
+
+class OpenTelemetryTracer(object):
+    """Creates spans using OpenTelemetry (the ``opentelemetry-api``
+    library), which exports them however it's been configured to.
+
+    :param tracer: the OpenTelemetry tracer to use (the one named
+                   ``sijax``, from the global tracer provider, if None)
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            tracer = otel_trace.get_tracer('sijax')
+        self._tracer = tracer
+
+    def start_span(self, name, parent=None):
+        context = None
+        if parent is not None:
+            context = otel_trace.set_span_in_context(parent)
+        return self._tracer.start_span(name, context=context)
+
+    def set_attributes(self, span, attributes):
+        span.set_attributes(attributes)
+
+    def set_error(self, span, error):
+        span.record_exception(error)
+        span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR,
+                                          str(error)))
+
+    def end_span(self, span):
+        span.end()
+
+    def activate(self, span):
+        return otel_context.attach(otel_trace.set_span_in_context(span))
+
+    def deactivate(self, token):
+        otel_context.detach(token)
+
+
+class _CallState(object):
+
+    def __init__(self, span):
+        self.span = span
+        # stage name => [span, activation token, commands, response size]
+        self.stages = {}
+
+
+class TracingObserver(Observer):
+    """An observer creating a span for every call (``sijax.call``),
+    with child spans for each of its stages (``sijax.handler``,
+    ``sijax.flush``, etc.).
+
+    Stage spans are the current ones while they run (for streaming
+    functions - while the function runs, not while the stream waits),
+    so the spans that the function creates become their children.
+
+    Spans get the following attributes:
+
+    - ``sijax.function`` - the name of the called function
+    - ``sijax.status`` - the status of the call (call spans only)
+    - ``sijax.request_bytes`` - the size of the arguments, in bytes
+      (call spans only; 0 for arguments sent as a file part)
+    - ``sijax.commands`` - the number of commands sent
+      (call, serialization and flush spans)
+    - ``sijax.response_bytes`` - the size of what was sent, in bytes
+      (call, serialization and flush spans)
+
+    Use :func:`install_tracing` to set it up.
+
+    :param tracer: the tracer to create spans with
+                   (:class:`OpenTelemetryTracer` or :class:`InMemoryTracer`),
+                   defaulting to OpenTelemetry, if it's installed
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None and otel_trace is not None:
+            tracer = OpenTelemetryTracer()
+        self.tracer = tracer
+
+    def _get_function_name(self, record):
+        return record.function_name or ''
+
+    def call_started(self, record):
+        if self.tracer is None:
+            return
+        span = self.tracer.start_span('sijax.call')
+        record.extra[self] = _CallState(span)
+
+    def stage_started(self, record, name):
+        state = record.extra.get(self)
+        if state is None:
+            return
+        tracer = self.tracer
+        span = tracer.start_span('sijax.%s' % name, state.span)
+        tracer.set_attributes(span, {'sijax.function': self._get_function_name(record)})
+        state.stages[name] = [span, tracer.activate(span), record.commands_count,
+                              record.response_size]
+
+    def stage_suspended(self, record, name):
+        state = record.extra.get(self)
+        if state is None or name not in state.stages:
+            return
+        stage = state.stages[name]
+        if stage[1] is not None:
+            self.tracer.deactivate(stage[1])
+            stage[1] = None
+
+    def stage_resumed(self, record, name):
+        state = record.extra.get(self)
+        if state is None or name not in state.stages:
+            return
+        stage = state.stages[name]
+        if stage[1] is None:
+            stage[1] = self.tracer.activate(stage[0])
+
+    def stage_finished(self, record, name, seconds, error=None):
+        state = record.extra.get(self)
+        if state is None or name not in state.stages:
+            return
+        span, token, commands_count, response_size = state.stages.pop(name)
+        tracer = self.tracer
+        if token is not None:
+            tracer.deactivate(token)
+        if record.commands_count != commands_count or record.response_size != response_size:
+            tracer.set_attributes(span, {
+                'sijax.commands': record.commands_count - commands_count,
+                'sijax.response_bytes': record.response_size - response_size,
+            })
+        if error is not None:
+            tracer.set_error(span, error)
+        tracer.end_span(span)
+
+    def observe(self, record):
+        state = record.extra.pop(self, None)
+        if state is None:
+            return
+        tracer = self.tracer
+        tracer.set_attributes(state.span, {
+            'sijax.function': self._get_function_name(record),
+            'sijax.status': record.status,
+            'sijax.request_bytes': record.request_size,
+            'sijax.commands': record.commands_count,
+            'sijax.response_bytes': record.response_size,
+        })
+        if record.error is not None:
+            tracer.set_error(state.span, record.error)
+        tracer.end_span(state.span)
+
+
+def install_tracing(sijax_instance, tracer=None):
+    """Makes the calls to the given Sijax instance get traced
+    (see :class:`TracingObserver`).
+
+    This does nothing (calls are not even timed) if no tracer is given
+    and OpenTelemetry is not installed.
+
+    :return: the :class:`TracingObserver` (or None, if tracing is not possible)
+    """
+    observer = TracingObserver(tracer)
+    if observer.tracer is None:
+        return None
+    sijax_instance.add_observer(observer)
+    return observer
@@ -25,6 +25,9 @@ from sijax.plugin.upload import register_upload_callback, UploadResponse
 
 from sijax.helper import init_static_path
 
+from sijax.compression import negotiate_encoding, compress_response, \
+     CompressionMiddleware, Compressor
+
 @contextmanager
 def temporary_dir(*args, **kwargs):
     path = tempfile.mkdtemp()
@@ -546,6 +549,173 @@ class SijaxMainTestCase(unittest.TestCase):
         try_call(1, False)
         try_call({'dictionary': 'here'}, False)
 
+    def test_response_method_call_sends_typed_arrays(self):
+        import array
+        import base64
+        from sijax.helper import json
+
+        series = array.array("d", [i / 7.0 for i in range(1000)])
+        matrix = memoryview(array.array("i", range(6))).cast("B").cast("i", [2, 3])
+        params = [series, "label", matrix, memoryview(series)[::2], bytearray(b"ab")]
+
+        def callback(obj_response):
+            obj_response.call("drawChart", params)
+            obj_response.call("noTypedArrays", ["string", 5, [1, 2]])
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("callback", callback)
+        inst.set_data({cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: "[]"})
+        commands = json.loads(inst.process_request())
+
+        # the original params list is not modified
+        self.assertTrue(params[0] is series)
+
+        call_typed, call_regular = commands
+        self.assertEqual([0, 2, 3, 4], call_typed["typed"])
+        self.assertFalse("typed" in call_regular)
+        self.assertEqual(["string", 5, [1, 2]], call_regular["params"])
+
+        def decode(spec, typecode):
+            values = array.array(typecode, base64.b64decode(spec["data"]))
+            return spec["dtype"], spec["shape"], values.tolist()
+
+        typed_params = call_typed["params"]
+        self.assertEqual(("float64", [1000], series.tolist()),
+                         decode(typed_params[0], "d"))
+        self.assertEqual("label", typed_params[1])
+        self.assertEqual(("int32", [2, 3], list(range(6))),
+                         decode(typed_params[2], "i"))
+        # non-contiguous data gets copied
+        self.assertEqual(("float64", [500], series.tolist()[::2]),
+                         decode(typed_params[3], "d"))
+        self.assertEqual(("uint8", [2], [97, 98]), decode(typed_params[4], "B"))
+
+        # the base64 encoded series is still smaller than the JSON list of floats
+        self.assertTrue(len(typed_params[0]["data"]) < len(json.dumps(series.tolist())))
+
+        # binary codecs send the raw bytes
+        from sijax.codec import MsgpackCodec
+        if MsgpackCodec().is_available():
+            from sijax.helper import msgpack
+            inst.set_data({cls.PARAM_REQUEST: "callback",
+                           cls.PARAM_ARGS: base64.b64encode(msgpack.packb([])),
+                           cls.PARAM_CODEC: "msgpack"})
+            commands = msgpack.unpackb(inst.process_request(), raw=False)
+            spec = commands[0]["params"][0]
+            self.assertEqual(series.tobytes(), spec["data"])
+
+        # unsupported formats are rejected
+        def callback_bad(obj_response):
+            obj_response.call("func", [memoryview(array.array("u", "abc"))])
+        inst.register_callback("callback", callback_bad)
+        inst.set_data({cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: "[]"})
+        self.assertRaises(SijaxError, inst.process_request)
+
+        # arrays are not locked after call(), and are read when serialized
+        def callback_changing(obj_response):
+            values = array.array("d", [1.0, 2.0])
+            obj_response.call("draw", [values])
+            values.append(3.0)
+            values[0] = 0.5
+
+        inst.register_callback("callback", callback_changing)
+        commands = json.loads(inst.process_request())
+        self.assertEqual(("float64", [3], [0.5, 2.0, 3.0]),
+                         decode(commands[0]["params"][0], "d"))
+
+    def test_keyed_commands_supersede_unsent_ones(self):
+        from sijax.helper import json
+
+        def callback(obj_response):
+            obj_response.html("#status", "Starting")
+            for done in range(100):
+                obj_response.html("#progress", "%d%%" % done, key="progress")
+            obj_response.alert("Done", key="done")
+            obj_response.call("finish", [], key="progress")
+            self.assertEqual(100, obj_response.superseded_count)
+
+        inst = Sijax()
+        commands = json.loads(inst.execute_callback([], callback=callback))
+        # superseded commands are removed, and superseding ones are
+        # added at the end, running after the commands queued before them
+        self.assertEqual(["html", "alert", "call"],
+                         [command["type"] for command in commands])
+        self.assertFalse("key" in commands[2])
+
+        def callback_many_keys(obj_response):
+            obj_response.html("#a", "1", key="a")
+            obj_response.html("#b", "1", key="b")
+            obj_response.html("#c", "1", key="c")
+            obj_response.html("#a", "2", key="a")
+            obj_response.html("#c", "2", key="c")
+            obj_response.html("#b", "2", key="b")
+            obj_response.html("#a", "3", key="a")
+
+        commands = json.loads(inst.execute_callback([], callback=callback_many_keys))
+        self.assertEqual([("#c", "2"), ("#b", "2"), ("#a", "3")],
+                         [(command["selector"], command["html"])
+                          for command in commands])
+
+        # only unsent commands get superseded
+        def streaming_callback(obj_response):
+            obj_response.html("#progress", "1%", key="progress")
+            yield obj_response
+            obj_response.html("#progress", "2%", key="progress")
+            obj_response.html("#progress", "3%", key="progress")
+
+        chunks = list(inst.execute_callback([], callback=streaming_callback,
+                                            response_class=StreamingIframeResponse))
+        self.assertEqual(2, len(chunks))
+        self.assertTrue(b"1%" in chunks[0])
+        self.assertFalse(b"2%" in chunks[1])
+        self.assertTrue(b"3%" in chunks[1])
+
+    def test_out_of_band_arguments_are_resolved(self):
+        from io import BytesIO
+        from sijax.helper import json
+
+        document = BytesIO(b"x" * (1024 * 1024))
+        calls = []
+
+        def callback(obj_response, title, body, count):
+            # file-like objects are passed as they are, unread
+            self.assertEqual(0, body.tell())
+            size = 0
+            for chunk in iter(lambda: body.read(65536), b""):
+                size += len(chunk)
+            calls.append((title, size, count))
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("callback", callback)
+
+        post = {
+            cls.PARAM_REQUEST: "callback",
+            cls.PARAM_ARGS: json.dumps(["Title", "sijax_arg_1", 5]),
+            cls.PARAM_REFS: "[1]",
+            "sijax_arg_1": document,
+        }
+        inst.set_data(post)
+        self.assertTrue(inst.request_args[1] is document)
+        inst.process_request()
+        self.assertEqual([("Title", 1024 * 1024, 5)], calls)
+
+        # Invalid references make the arguments list invalid as a whole
+        for refs, args in (("[3]", ["Title", "sijax_arg_1", 5]),
+                           ("[0]", ["Title", "sijax_arg_1", 5]),
+                           ('["1"]', ["Title", "sijax_arg_1", 5]),
+                           ("[true]", ["Title", "sijax_arg_1", 5]),
+                           ("{}", ["Title", "sijax_arg_1", 5]),
+                           (BytesIO(b"[1]"), ["Title", "sijax_arg_1", 5]),
+                           ([1], ["Title", "sijax_arg_1", 5]),
+                           ("[1]", ["Title", "sijax_arg_2", 5]),
+                           ("[1]", ["Title", cls.PARAM_REQUEST, 5])):
+            post[cls.PARAM_REFS] = refs
+            post[cls.PARAM_ARGS] = json.dumps(args)
+            inst.set_data(post)
+            self.assertEqual([], inst.request_args)
+
     def test_init_static_path_helper_works(self):
         import os
         import sijax
@@ -659,6 +829,894 @@ class SijaxMainTestCase(unittest.TestCase):
         try_response_class(14, False)
 
 
+    def test_compact_response_format_is_negotiated(self):
+        from sijax.helper import json
+
+        def expand(payload):
+            # mirrors Sijax.expandCommands() from sijax.js
+            table = payload["t"]
+            interned = BaseResponse.COMPACT_INTERNED_FIELDS
+            commands = []
+            for encoded in payload["c"]:
+                command = {}
+                for key, value in zip(encoded[::2], encoded[1::2]):
+                    if key < 0:
+                        command[table[~key]] = value
+                    elif table[key] not in interned:
+                        command[table[key]] = value
+                    elif isinstance(value, list):
+                        command[table[key]] = table[value[0]] + table[value[1]]
+                    else:
+                        command[table[key]] = table[value]
+                commands.append(command)
+            return commands
+
+        def callback(obj_response):
+            for row in range(20):
+                for col in range(10):
+                    selector = "#report-table tbody tr.row-%d td.col-%d" % (row, col)
+                    obj_response.html(selector, "%d" % (row * col))
+                    obj_response.css(selector, "backgroundColor", "red")
+            obj_response.css("#total", "width", 15)
+            obj_response.attr(["not", "a", "string"], "key", "value")
+            obj_response.call("updateChart", [[1, 2, 3], {"key": "value"}])
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("callback", callback)
+
+        # old clients don't send the format param
+        inst.set_data({cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: "[]"})
+        self.assertEqual(cls.FORMAT_DEFAULT, inst.response_format)
+        response_default = inst.process_request()
+        commands = json.loads(response_default)
+        self.assertTrue(isinstance(commands, list))
+
+        # unknown formats are ignored
+        inst.set_data({cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: "[]",
+                       cls.PARAM_FORMAT: "unknown"})
+        self.assertEqual(response_default, inst.process_request())
+
+        inst.set_data({cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: "[]",
+                       cls.PARAM_FORMAT: cls.FORMAT_COMPACT})
+        self.assertEqual(cls.FORMAT_COMPACT, inst.response_format)
+        response_compact = inst.process_request()
+        payload = json.loads(response_compact)
+        self.assertTrue(isinstance(payload, dict))
+        self.assertEqual(commands, expand(payload))
+
+        # 200 cells updated under the same selector prefix
+        self.assertTrue(len(response_compact) < len(response_default) * 0.6)
+
+    def test_codecs_are_negotiated(self):
+        import base64
+        from io import BytesIO
+        from sijax.codec import JsonCodec, MsgpackCodec
+        from sijax.helper import json
+
+        if not MsgpackCodec().is_available():
+            self.skipTest("msgpack is not installed")
+        from sijax.helper import msgpack
+
+        def callback(obj_response, numbers, label):
+            obj_response.call("drawChart", [numbers])
+            obj_response.html("#label", label)
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("callback", callback)
+        register_comet_callback(inst, "comet_callback", callback)
+
+        args = [[0.5 * i for i in range(100)], "Label"]
+        args_packed = msgpack.packb(args, use_bin_type=True)
+
+        # JSON is the default, also for unknown codecs
+        for codec in (None, "unknown"):
+            post = {cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: json.dumps(args)}
+            if codec is not None:
+                post[cls.PARAM_CODEC] = codec
+            inst.set_data(post)
+            self.assertEqual("json", inst.codec.name)
+            self.assertEqual("application/json", inst.response_content_type)
+            self.assertEqual(args, inst.request_args)
+            response_json = inst.process_request()
+            self.assertTrue(isinstance(response_json, string_types))
+
+        # Arguments as base64 or as a binary part of a multipart request
+        for args_value in (base64.b64encode(args_packed).decode("ascii"),
+                           BytesIO(args_packed)):
+            inst.set_data({cls.PARAM_REQUEST: "callback",
+                           cls.PARAM_ARGS: args_value,
+                           cls.PARAM_CODEC: "msgpack"})
+            self.assertEqual("msgpack", inst.codec.name)
+            self.assertEqual("application/x-msgpack", inst.response_content_type)
+            self.assertEqual(args, inst.request_args)
+            response = inst.process_request()
+            self.assertTrue(isinstance(response, bytes))
+            self.assertEqual(json.loads(response_json),
+                             msgpack.unpackb(response, raw=False))
+
+        # Compact format works with binary codecs too
+        inst.set_data({cls.PARAM_REQUEST: "callback",
+                       cls.PARAM_ARGS: base64.b64encode(args_packed),
+                       cls.PARAM_CODEC: "msgpack",
+                       cls.PARAM_FORMAT: cls.FORMAT_COMPACT})
+        self.assertTrue("t" in msgpack.unpackb(inst.process_request(), raw=False))
+
+        # Malformed arguments
+        inst.set_data({cls.PARAM_REQUEST: "callback",
+                       cls.PARAM_ARGS: "not base64 !!",
+                       cls.PARAM_CODEC: "msgpack"})
+        self.assertEqual([], inst.request_args)
+
+        # Streaming responses are html, regardless of the codec
+        inst.set_data({cls.PARAM_REQUEST: "comet_callback",
+                       cls.PARAM_ARGS: base64.b64encode(args_packed),
+                       cls.PARAM_CODEC: "msgpack"})
+        self.assertEqual("text/html; charset=utf-8", inst.response_content_type)
+        output = b"".join(inst.process_request())
+        self.assertTrue(b"drawChart" in output)
+
+        # Calls asking for unavailable codecs are rejected (in JSON),
+        # as their arguments can't be decoded
+        class UnavailableCodec(JsonCodec):
+            name = "unavailable"
+            def is_available(self):
+                return False
+
+        invalid_requests = []
+
+        def invalid_request(obj_response, func_name):
+            invalid_requests.append(func_name)
+            obj_response.alert("Invalid request")
+
+        inst.register_codec(UnavailableCodec())
+        inst.register_event(cls.EVENT_INVALID_REQUEST, invalid_request)
+        for name in ("callback", "comet_callback"):
+            inst.set_data({cls.PARAM_REQUEST: name,
+                           cls.PARAM_ARGS: json.dumps(args),
+                           cls.PARAM_CODEC: "unavailable"})
+            self.assertEqual("json", inst.codec.name)
+            self.assertEqual("application/json", inst.response_content_type)
+            commands = json.loads(inst.process_request())
+            self.assertEqual("Invalid request", commands[0]["alert"])
+        self.assertEqual(["callback", "comet_callback"], invalid_requests)
+
+    def test_observers_get_stage_timings(self):
+        from sijax.instrument import (CallRecord, HistogramAggregator,
+                                      Observer)
+
+        class RecordingObserver(Observer):
+            def __init__(self):
+                self.records = []
+
+            def observe(self, record):
+                self.records.append(record)
+
+        def regular(obj_response, arg):
+            obj_response.alert(arg)
+
+        def streaming(obj_response):
+            for idx in range(3):
+                obj_response.alert(idx)
+                yield obj_response
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("regular", regular)
+        inst.register_callback("streaming", streaming,
+                               response_class=StreamingIframeResponse)
+
+        # nothing gets timed without observers
+        inst.set_data({cls.PARAM_REQUEST: "regular", cls.PARAM_ARGS: '["hi"]'})
+        inst.process_request()
+
+        observer = RecordingObserver()
+        aggregator = HistogramAggregator()
+        inst.add_observer(observer).add_observer(aggregator)
+
+        inst.set_data({cls.PARAM_REQUEST: "regular", cls.PARAM_ARGS: '["hi"]'})
+        inst.process_request()
+        record = observer.records[-1]
+        self.assertEqual("regular", record.function_name)
+        self.assertEqual(CallRecord.STATUS_OK, record.status)
+        self.assertEqual([CallRecord.STAGE_DECODE_ARGS,
+                          CallRecord.STAGE_CREATE_RESPONSE,
+                          CallRecord.STAGE_BEFORE_PROCESSING,
+                          CallRecord.STAGE_HANDLER,
+                          CallRecord.STAGE_AFTER_PROCESSING,
+                          CallRecord.STAGE_SERIALIZE],
+                         [stage for stage, _ in record.stages])
+        self.assertTrue(record.duration >= sum(t for _, t in record.stages))
+
+        # streaming calls finish when the stream ends
+        inst.set_data({cls.PARAM_REQUEST: "streaming", cls.PARAM_ARGS: '[]'})
+        response = inst.process_request()
+        self.assertEqual(1, len(observer.records))
+        self.assertEqual(3, len(list(response)))
+        record = observer.records[-1]
+        stages = [stage for stage, _ in record.stages]
+        self.assertEqual(3, stages.count(CallRecord.STAGE_FLUSH))
+        self.assertEqual(1, stages.count(CallRecord.STAGE_HANDLER))
+
+        # bad calls and unknown functions
+        inst.set_data({cls.PARAM_REQUEST: "regular", cls.PARAM_ARGS: '[]'})
+        inst.process_request()
+        self.assertEqual(CallRecord.STATUS_INVALID_CALL, observer.records[-1].status)
+        inst.set_data({cls.PARAM_REQUEST: "unknown", cls.PARAM_ARGS: '[]'})
+        inst.process_request()
+        self.assertEqual(CallRecord.STATUS_INVALID_REQUEST,
+                         observer.records[-1].status)
+
+        def failing(obj_response):
+            raise KeyError("boom")
+
+        inst.register_callback("failing", failing)
+        inst.set_data({cls.PARAM_REQUEST: "failing", cls.PARAM_ARGS: '[]'})
+        self.assertRaises(KeyError, inst.process_request)
+        self.assertEqual(CallRecord.STATUS_ERROR, observer.records[-1].status)
+
+        self.assertEqual(set(["regular", "streaming", None, "failing"]),
+                         set(aggregator.get_function_names()))
+        self.assertEqual(2, aggregator.get_histogram("regular").count)
+        histogram = aggregator.get_histogram("streaming", CallRecord.STAGE_FLUSH)
+        self.assertEqual(3, histogram.count)
+        self.assertEqual(3, histogram.get_buckets()[-1][1])
+        self.assertTrue(histogram.get_quantile(0.5) >= 0)
+
+        inst.remove_observer(observer)
+        inst.set_data({cls.PARAM_REQUEST: "regular", cls.PARAM_ARGS: '["hi"]'})
+        inst.process_request()
+        self.assertEqual(5, len(observer.records))
+        self.assertEqual(3, aggregator.get_histogram("regular").count)
+
+    def test_observed_sizes_are_bytes(self):
+        from io import BytesIO
+        from sijax.codec import MsgpackCodec
+        from sijax.helper import json
+        from sijax.instrument import HistogramAggregator
+
+        class Records(HistogramAggregator):
+            def __init__(self):
+                HistogramAggregator.__init__(self)
+                self.records = []
+
+            def observe(self, record):
+                HistogramAggregator.observe(self, record)
+                self.records.append(record)
+
+        def greet(obj_response, name):
+            obj_response.alert("\u0417\u0434\u0440\u0430\u0432\u0435\u0439, %s" % name)
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("greet", greet)
+        observer = Records()
+        inst.add_observer(observer)
+
+        args = json.dumps(["\u0418\u0432\u0430\u043d"], ensure_ascii=False)
+        inst.set_data({cls.PARAM_REQUEST: "greet", cls.PARAM_ARGS: args})
+        response = inst.process_request()
+        record = observer.records[-1]
+        self.assertEqual(len(args.encode("utf-8")), record.request_size)
+        self.assertEqual(len(response.encode("utf-8")), record.response_size)
+        self.assertTrue(record.response_size > len(response))
+
+        if not MsgpackCodec().is_available():
+            return
+        from sijax.helper import msgpack
+
+        # Arguments sent as a file part of a multipart request have no size
+        inst.set_data({cls.PARAM_REQUEST: "greet", cls.PARAM_CODEC: "msgpack",
+                       cls.PARAM_ARGS: BytesIO(msgpack.packb(["Ivan"]))})
+        response = inst.process_request()
+        self.assertEqual(["\u0417\u0434\u0440\u0430\u0432\u0435\u0439, Ivan"],
+                         [command["alert"] for command in msgpack.unpackb(response)])
+        record = observer.records[-1]
+        self.assertEqual("ok", record.status)
+        self.assertEqual(0, record.request_size)
+        self.assertEqual(len(response), record.response_size)
+
+    def test_metrics_registry_renders_prometheus_text(self):
+        from sijax.metrics import MetricsRegistry
+
+        def say_hi(obj_response, name):
+            obj_response.alert("Hi, %s" % name)
+            obj_response.alert("Bye")
+
+        registry = MetricsRegistry()
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("say_hi", say_hi)
+        inst.register_callback('quo"ted', say_hi)
+        registry.track(inst).track(inst)
+
+        for args in ('["John"]', '["Jane"]', '[]'):
+            inst.set_data({cls.PARAM_REQUEST: "say_hi", cls.PARAM_ARGS: args})
+            inst.process_request()
+        inst.set_data({cls.PARAM_REQUEST: "missing", cls.PARAM_ARGS: "[]"})
+        inst.process_request()
+
+        self.assertEqual(3, registry.get_calls_count("say_hi"))
+        self.assertEqual(1, registry.get_calls_count("say_hi", "invalid_call"))
+        self.assertEqual(1, registry.get_calls_count(MetricsRegistry.UNKNOWN,
+                                                     "invalid_request"))
+
+        text = registry.render_prometheus()
+        lines = text.splitlines()
+        self.assertTrue(text.endswith("\n"))
+        self.assertTrue("# TYPE sijax_calls_total counter" in lines)
+        self.assertTrue("# TYPE sijax_call_duration_seconds histogram" in lines)
+        self.assertTrue('sijax_calls_total{function="say_hi",status="ok"} 2' in lines)
+        self.assertTrue('sijax_calls_total{function="say_hi",status="invalid_call"} 1'
+                        in lines)
+        self.assertTrue('sijax_calls_total{function="<unknown>",status="invalid_request"} 1'
+                        in lines)
+        # registered functions are reported before being called
+        self.assertTrue('sijax_calls_total{function="quo\\"ted",status="ok"} 0'
+                        in lines)
+        # 2 commands per successful call, 1 alert for the invalid call
+        self.assertTrue('sijax_commands_total{function="say_hi"} 5' in lines)
+        self.assertTrue('sijax_call_duration_seconds_count{function="say_hi"} 3'
+                        in lines)
+        self.assertTrue('sijax_call_duration_seconds_bucket{function="say_hi",le="+Inf"} 3'
+                        in lines)
+        self.assertTrue('sijax_request_size_bytes_bucket{function="say_hi",le="64"} 3'
+                        in lines)
+        self.assertTrue('sijax_request_size_bytes_sum{function="say_hi"} 18.0'
+                        in lines)
+
+    def test_profiler_samples_enabled_functions(self):
+        import time
+        from sijax.profiling import CallProfiler
+
+        def busy(obj_response):
+            time.sleep(0.05)
+            obj_response.alert("done")
+
+        def streaming(obj_response):
+            for idx in range(2):
+                time.sleep(0.01)
+                obj_response.alert(idx)
+                yield obj_response
+
+        def other(obj_response):
+            pass
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("busy", busy)
+        inst.register_callback("streaming", streaming,
+                               response_class=StreamingIframeResponse)
+        inst.register_callback("other", other)
+
+        def call(name):
+            inst.set_data({cls.PARAM_REQUEST: name, cls.PARAM_ARGS: "[]"})
+            response = inst.process_request()
+            if not isinstance(response, string_types):
+                response = list(response)
+            return response
+
+        profiler = CallProfiler(max_samples=2)
+        inst.set_profiler(profiler)
+        profiler.enable("busy").enable("streaming").enable("other", rate=0)
+        for name in ("busy", "busy", "busy", "streaming", "other"):
+            call(name)
+
+        # only the last profiles are kept
+        self.assertEqual(2, profiler.get_samples_count("busy"))
+        self.assertEqual(1, profiler.get_samples_count("streaming"))
+        self.assertEqual(0, profiler.get_samples_count("other"))
+        self.assertEqual(None, profiler.get_stats("other"))
+
+        stats = profiler.get_stats("busy")
+        functions = [func[2] for func in stats.stats]
+        self.assertTrue("busy" in functions)
+        functions = [func[2] for func in profiler.get_stats("streaming").stats]
+        self.assertTrue("streaming" in functions)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, "busy.pstats")
+            self.assertTrue(profiler.dump("busy", path))
+            self.assertTrue(os.path.getsize(path) > 0)
+            self.assertFalse(profiler.dump("other", path))
+
+            profiler.disable("busy")
+            call("busy")
+            self.assertEqual(2, profiler.get_samples_count("busy"))
+
+            # sampling the stacks
+            sampler = CallProfiler(CallProfiler.MODE_SAMPLER, interval=0.002)
+            inst.set_profiler(sampler.enable("busy"))
+            self.assertRaises(SijaxError, sampler.get_stats, "busy")
+            call("busy")
+            stacks = sampler.get_collapsed_stacks("busy")
+            self.assertTrue(sum(stacks.values()) > 0)
+            self.assertTrue(any("busy (" in stack for stack in stacks))
+
+            path = os.path.join(temp_dir, "busy.folded")
+            self.assertTrue(sampler.dump("busy", path))
+            with open(path) as fp:
+                line = fp.readline()
+            self.assertTrue(line.rstrip().split(" ")[-1].isdigit())
+        finally:
+            shutil.rmtree(temp_dir)
+
+        # calls not going through process_request() are profiled too
+        from sijax.testing import SijaxTestClient
+
+        profiler = CallProfiler()
+        inst.set_profiler(profiler.enable("busy"))
+        inst.execute_callback([], callback=busy)
+        self.assertEqual(1, profiler.get_samples_count("busy"))
+        SijaxTestClient(inst).call("busy")
+        self.assertEqual(2, profiler.get_samples_count("busy"))
+
+        self.assertRaises(SijaxError, CallProfiler, "unknown")
+
+    def test_tracing_creates_nested_spans(self):
+        from sijax.helper import otel_trace
+        from sijax.tracing import (InMemoryTracer, install_tracing)
+
+        tracer = InMemoryTracer()
+
+        def query(obj_response, arg):
+            with tracer.span("db.query"):
+                obj_response.alert(arg)
+
+        def streaming(obj_response):
+            for idx in range(2):
+                with tracer.span("db.query"):
+                    obj_response.alert(idx)
+                yield obj_response
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("query", query)
+        inst.register_callback("streaming", streaming,
+                               response_class=StreamingIframeResponse)
+        self.assertTrue(install_tracing(inst, tracer) is not None)
+        if otel_trace is None:
+            # nothing to trace with
+            self.assertEqual(None, install_tracing(Sijax()))
+
+        inst.set_data({cls.PARAM_REQUEST: "query", cls.PARAM_ARGS: '["hi"]'})
+        inst.process_request()
+
+        spans = dict((span.name, span) for span in tracer.get_finished_spans())
+        call = spans["sijax.call"]
+        self.assertEqual(None, call.parent)
+        self.assertEqual("query", call.attributes["sijax.function"])
+        self.assertEqual("ok", call.attributes["sijax.status"])
+        self.assertEqual(6, call.attributes["sijax.request_bytes"])
+        self.assertEqual(1, call.attributes["sijax.commands"])
+        for name in ("decode_args", "create_response", "before_processing",
+                     "handler", "after_processing", "serialize"):
+            self.assertTrue(spans["sijax.%s" % name].parent is call)
+        # spans created by the function are children of the handler span
+        self.assertTrue(spans["db.query"].parent is spans["sijax.handler"])
+        self.assertEqual(call.trace_id, spans["db.query"].trace_id)
+        self.assertEqual(1, spans["sijax.serialize"].attributes["sijax.commands"])
+        self.assertEqual(call.attributes["sijax.response_bytes"],
+                         spans["sijax.serialize"].attributes["sijax.response_bytes"])
+        self.assertEqual(None, tracer.current_span)
+
+        tracer.clear()
+        inst.set_data({cls.PARAM_REQUEST: "streaming", cls.PARAM_ARGS: "[]"})
+        self.assertEqual(2, len(list(inst.process_request())))
+        spans = tracer.get_finished_spans()
+        names = [span.name for span in spans]
+        self.assertEqual(2, names.count("sijax.flush"))
+        self.assertEqual("sijax.call", names[-1])
+        handler = spans[names.index("sijax.handler")]
+        queries = [span for span in spans if span.name == "db.query"]
+        self.assertEqual([handler, handler], [span.parent for span in queries])
+        flush = spans[names.index("sijax.flush")]
+        self.assertTrue(flush.parent is spans[-1])
+        self.assertEqual(1, flush.attributes["sijax.commands"])
+        self.assertEqual(None, tracer.current_span)
+
+        def failing(obj_response):
+            raise KeyError("boom")
+
+        tracer.clear()
+        inst.register_callback("failing", failing)
+        inst.set_data({cls.PARAM_REQUEST: "failing", cls.PARAM_ARGS: "[]"})
+        self.assertRaises(KeyError, inst.process_request)
+        spans = dict((span.name, span) for span in tracer.get_finished_spans())
+        self.assertTrue(isinstance(spans["sijax.handler"].error, KeyError))
+        self.assertEqual("error", spans["sijax.call"].attributes["sijax.status"])
+
+        # sizes are in bytes (UTF-8), and file parts have none
+        from io import BytesIO
+        from sijax.codec import MsgpackCodec
+
+        tracer.clear()
+        args = '["\u00e9t\u00e9"]'
+        inst.set_data({cls.PARAM_REQUEST: "query", cls.PARAM_ARGS: args})
+        response = inst.process_request()
+        spans = dict((span.name, span) for span in tracer.get_finished_spans())
+        call = spans["sijax.call"]
+        self.assertEqual(len(args) + 2, call.attributes["sijax.request_bytes"])
+        self.assertEqual(len(response.encode("utf-8")),
+                         call.attributes["sijax.response_bytes"])
+        if MsgpackCodec().is_available():
+            from sijax.helper import msgpack
+
+            tracer.clear()
+            inst.set_data({cls.PARAM_REQUEST: "query", cls.PARAM_CODEC: "msgpack",
+                           cls.PARAM_ARGS: BytesIO(msgpack.packb(["hi"]))})
+            response = inst.process_request()
+            spans = dict((span.name, span) for span in tracer.get_finished_spans())
+            self.assertEqual(0, spans["sijax.call"].attributes["sijax.request_bytes"])
+            self.assertEqual(len(response),
+                             spans["sijax.call"].attributes["sijax.response_bytes"])
+
+    def test_slow_call_log_is_rate_limited(self):
+        import logging
+        import time
+        from sijax.instrument import SlowCallLog
+
+        class ListHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record)
+
+        handler = ListHandler()
+        logger = logging.getLogger("sijax.tests.slow_calls")
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        def slow(obj_response, arg):
+            time.sleep(0.01)
+            obj_response.alert(arg)
+            obj_response.alert(arg)
+
+        def fast(obj_response):
+            pass
+
+        inst = Sijax()
+        cls = inst.__class__
+        inst.register_callback("slow", slow)
+        inst.register_callback("fast", fast)
+        slow_log = SlowCallLog(threshold=0.005, thresholds={"fast": 10},
+                               max_records=2, interval=0.2, logger=logger)
+        inst.add_observer(slow_log)
+
+        def call(name, args):
+            inst.set_data({cls.PARAM_REQUEST: name, cls.PARAM_ARGS: args})
+            inst.process_request()
+
+        call("fast", "[]")
+        self.assertEqual([], handler.records)
+
+        for _ in range(4):
+            call("slow", '["hello"]')
+        self.assertEqual(2, len(handler.records))
+        self.assertEqual(2, slow_log.suppressed_count)
+        data = handler.records[0].sijax_call
+        self.assertEqual("slow", data["function"])
+        self.assertEqual(9, data["request_bytes"])
+        self.assertEqual(2, data["commands"])
+        self.assertTrue(data["response_bytes"] > 0)
+        self.assertTrue(data["stages"]["handler"] >= 0.01)
+        self.assertEqual(0, data["suppressed"])
+        message = handler.records[0].getMessage()
+        self.assertTrue(message.startswith("Slow Sijax call: slow took"))
+        self.assertTrue("handler" in message)
+
+        time.sleep(0.2)
+        call("slow", '["hello"]')
+        self.assertEqual(3, len(handler.records))
+        self.assertEqual(2, handler.records[-1].sijax_call["suppressed"])
+        self.assertTrue("2 slow calls not logged" in handler.records[-1].getMessage())
+        self.assertEqual(0, slow_log.suppressed_count)
+
+        # streams are judged by the time spent working on them,
+        # not by how long they waited (sleeping, etc.)
+        from sijax.plugin.comet import register_comet_callback
+
+        def waiting(obj_response):
+            for _ in range(3):
+                obj_response.alert("tick")
+                yield obj_response.sleep(0.01)
+
+        def busy(obj_response):
+            for _ in range(2):
+                time.sleep(0.01)
+                yield obj_response
+
+        time.sleep(0.2)
+        register_comet_callback(inst, "waiting", waiting)
+        register_comet_callback(inst, "busy", busy)
+        inst.set_data({cls.PARAM_REQUEST: "waiting", cls.PARAM_ARGS: "[]"})
+        list(inst.process_request())
+        self.assertEqual(3, len(handler.records))
+
+        inst.set_data({cls.PARAM_REQUEST: "busy", cls.PARAM_ARGS: "[]"})
+        list(inst.process_request())
+        self.assertEqual(4, len(handler.records))
+        data = handler.records[-1].sijax_call
+        self.assertTrue(data["streaming"])
+        self.assertTrue(data["duration"] >= 0.02)
+        self.assertTrue("streamed for" in handler.records[-1].getMessage())
+        logger.removeHandler(handler)
+
+    def test_benchmarks_run_and_save_results(self):
+        from sijax import bench
+
+        ids = [bench.Benchmark.get_id(b.name, params)
+               for b in bench.get_benchmarks() for params in b.params]
+        self.assertTrue("dispatch.process_request[commands=100]" in ids)
+        self.assertTrue("upload.form_values[fields=10000]" in ids)
+
+        results = bench.run(["dispatch.process_request*", "streaming.flush*"],
+                            quick=True, repeat=2, min_time=0.001)
+        self.assertEqual(["dispatch.process_request[commands=1]",
+                          "streaming.flush[commands=1,transport=iframe]"],
+                         [result["id"] for result in results])
+        for result in results:
+            self.assertTrue(0 < result["min"] <= result["median"])
+            self.assertEqual(2, result["repeat"])
+        self.assertTrue(results[1]["info"]["bytes"] > 0)
+
+        with temporary_dir() as path:
+            results_path = os.path.join(path, "results.json")
+            bench.save_results(results, results_path)
+            data = bench.load_results(results_path)
+        self.assertEqual(bench.RESULTS_FORMAT_VERSION, data["version"])
+        self.assertEqual(results[0]["median"], data["results"][0]["median"])
+        self.assertTrue("python" in data["environment"])
+        self.assertEqual(bench.get_fingerprint(), data["environment"]["fingerprint"])
+        self.assertTrue(results[0]["peak_bytes"] > 0)
+        self.assertTrue(0 < results[0]["p99"])
+
+    def test_test_client_decodes_commands(self):
+        from sijax.instrument import CallRecord
+        from sijax.testing import SijaxTestClient
+
+        def greet(obj_response, name, times):
+            for _ in range(times):
+                obj_response.alert("Hello, %s!" % name)
+            obj_response.html("#list li.first", "<b>%s</b>" % name)
+
+        def count(obj_response, up_to):
+            for number in range(up_to):
+                obj_response.html("#counter", number)
+                yield obj_response
+
+        def upload(obj_response, form_values):
+            obj_response.alert(form_values["title"])
+
+        inst = Sijax()
+        inst.register_callback("greet", greet)
+        inst.register_callback("count", count,
+                               response_class=StreamingIframeResponse)
+        register_comet_callback(inst, "count_comet", count)
+        register_upload_callback(inst, "form", upload)
+        client = SijaxTestClient(inst)
+
+        expected = [{"type": "alert", "alert": "Hello, John!"},
+                    {"type": "alert", "alert": "Hello, John!"},
+                    {"type": "html", "selector": "#list li.first",
+                     "html": "<b>John</b>", "setType": "replace"}]
+        for options in ({}, {"response_format": Sijax.FORMAT_COMPACT},
+                        {"codec": "msgpack"}, {"serialize": False}):
+            result = client.call("greet", "John", 2, **options)
+            self.assertEqual(expected, result.commands)
+            self.assertEqual([expected], result.batches)
+            self.assertFalse(result.is_streaming)
+            self.assertEqual(CallRecord.STATUS_OK, result.status)
+            self.assertTrue(result.duration > 0)
+            self.assertEqual(1, len(result.get_commands("html")))
+
+        result = client.call("greet", "John", 2)
+        self.assertEqual(len(result.output), result.response_size)
+        self.assertEqual(len('["John",2]'), result.request_size)
+        self.assertTrue(result.get_stage_time(CallRecord.STAGE_SERIALIZE) > 0)
+        result = client.call("greet", "John", 2, serialize=False)
+        self.assertEqual(None, result.output)
+        self.assertEqual(None, result.response_size)
+        self.assertEqual(0, result.get_stage_time(CallRecord.STAGE_DECODE_ARGS))
+        # observers see unserialized calls by name, having no size
+        self.assertEqual("greet", result.record.function_name)
+        self.assertEqual(0, result.record.response_size)
+
+        for name in ("count", "count_comet"):
+            for options in ({}, {"transport": Sijax.TRANSPORT_FETCH},
+                            {"serialize": False}):
+                result = client.call(name, 3, **options)
+                self.assertTrue(result.is_streaming)
+                self.assertEqual(name, result.record.function_name)
+                if options.get("serialize") is False:
+                    self.assertEqual(0, result.record.response_size)
+                self.assertEqual([[{"type": "html", "selector": "#counter",
+                                    "html": number, "setType": "replace"}]
+                                  for number in range(3)], result.batches)
+
+        result = client.call("form_upload", "form", data={"title": "Report"})
+        self.assertEqual([[{"type": "alert", "alert": "Report"}]], result.batches)
+
+        # unknown functions and bad calls are handled like the real ones
+        for options in ({}, {"serialize": False}):
+            result = client.call("missing", **options)
+            self.assertEqual(CallRecord.STATUS_INVALID_REQUEST, result.status)
+            self.assertEqual(1, len(result.get_commands("alert")))
+            result = client.call("greet", **options)
+            self.assertEqual(CallRecord.STATUS_INVALID_CALL, result.status)
+
+        self.assertRaises(SijaxError, client.call, "greet", "John", 1, unknown=True)
+        self.assertEqual([], inst._observers)
+
+    def test_requests_are_recorded_and_replayed(self):
+        from io import BytesIO
+        from six.moves.urllib.parse import parse_qsl
+        from sijax.helper import json
+        from sijax.loadtest import RequestRecorder, anonymize_args, \
+             load_requests, replay, WSGITarget
+
+        calls = []
+
+        def login(obj_response, username, password):
+            calls.append((username, password))
+            obj_response.alert("Welcome, %s" % username)
+
+        def fail(obj_response):
+            raise ValueError("Something broke")
+
+        def save(obj_response, title, body):
+            if hasattr(body, "read"):
+                body = body.read()
+            calls.append((title, body))
+
+        def make_instance():
+            inst = Sijax()
+            inst.register_callback("login", login)
+            inst.register_callback("fail", fail)
+            inst.register_callback("save", save)
+            return inst
+
+        def app(environ, start_response):
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            body = environ["wsgi.input"].read(length).decode("utf-8")
+            inst = make_instance()
+            inst.set_data(dict(parse_qsl(body)))
+            try:
+                response = inst.process_request()
+            except ValueError:
+                start_response("500 Internal Server Error", [])
+                return [b""]
+            start_response("200 OK", [("Content-Type", "application/json")])
+            return [response.encode("utf-8")]
+
+        cls = Sijax
+        with temporary_dir() as path:
+            recording = os.path.join(path, "requests.ndjson.gz")
+            recorder = RequestRecorder(recording, anonymize=anonymize_args({
+                "login": lambda args: ["user", "*" * len(args[1])]}))
+            inst = make_instance()
+            recorder.track(inst)
+            recorder.track(inst)
+            self.assertEqual(1, len(inst._observers))
+            inst.set_data({cls.PARAM_REQUEST: "login",
+                           cls.PARAM_ARGS: json.dumps(["john", "secret"])})
+            inst.process_request()
+            inst.set_data({cls.PARAM_REQUEST: "fail", cls.PARAM_ARGS: "[]",
+                           "upload": object()})
+            self.assertRaises(ValueError, inst.process_request)
+            recorder.close()
+            inst.set_data({cls.PARAM_REQUEST: "login",
+                           cls.PARAM_ARGS: json.dumps(["jane", "secret"])})
+            inst.process_request()
+            self.assertEqual(2, recorder.recorded_count)
+
+            requests = load_requests(recording)
+
+        self.assertEqual(["login", "fail"],
+                         [request.function_name for request in requests])
+        self.assertEqual({cls.PARAM_REQUEST: "login",
+                          cls.PARAM_ARGS: '["user", "******"]'}, requests[0].data)
+        self.assertEqual("ok", requests[0].status)
+        self.assertEqual("error", requests[1].status)
+        # files (anything but text) are not recorded
+        self.assertEqual({cls.PARAM_REQUEST: "fail", cls.PARAM_ARGS: "[]"},
+                         requests[1].data)
+        self.assertEqual(0, requests[0].offset)
+
+        del calls[:]
+        report = replay(WSGITarget(app), requests, concurrency=3, count=10)
+        self.assertEqual(10, report.requests_count)
+        self.assertEqual({"status 500": 5}, report.errors)
+        self.assertEqual([("user", "******")] * 5, calls)
+        self.assertTrue(report.throughput > 0)
+        self.assertTrue(report.get_percentile(50) <= report.get_percentile(99))
+        self.assertTrue("Errors:     5" in report.format())
+        self.assertEqual(10, report.to_dict()["requests"])
+
+        # paced by rate (10 requests at 200/s take at least 45ms)
+        report = replay(WSGITarget(app), requests, concurrency=2, rate=200,
+                        count=10)
+        self.assertTrue(report.duration >= 0.045)
+        self.assertEqual(10, report.requests_count)
+
+        # out-of-band arguments are recorded as text, so that the calls
+        # can be replayed (anonymized ones are recorded inline)
+        with temporary_dir() as path:
+            recording = os.path.join(path, "requests.ndjson.gz")
+            with RequestRecorder(recording, anonymize=anonymize_args({
+                    "login": lambda args: ["user", "*" * len(args[1])]})) as recorder:
+                inst = make_instance()
+                recorder.track(inst)
+                for function_name, first, second in (("save", "Title", b"x" * 100),
+                                                     ("login", "john", b"secret"),
+                                                     ("save", "Binary", b"\xff")):
+                    inst.set_data({cls.PARAM_REQUEST: function_name,
+                                   cls.PARAM_ARGS: json.dumps([first, "sijax_arg_1"]),
+                                   cls.PARAM_REFS: "[1]",
+                                   "sijax_arg_1": BytesIO(second)})
+                    inst.process_request()
+            requests = load_requests(recording)
+
+        # not UTF-8 text, so not recorded
+        self.assertEqual(["save", "login"],
+                         [request.function_name for request in requests])
+        self.assertEqual("x" * 100, requests[0].data["sijax_arg_1"])
+        self.assertEqual({cls.PARAM_REQUEST: "login",
+                          cls.PARAM_ARGS: '["user", "******"]'}, requests[1].data)
+
+        del calls[:]
+        report = replay(WSGITarget(app), requests)
+        self.assertEqual({}, report.errors)
+        self.assertEqual([("Title", "x" * 100), ("user", "******")], calls)
+
+    def test_benchmark_baseline_comparison(self):
+        from sijax import bench
+        from sijax.bench import baseline
+
+        def result(case_id, timings, p99_runs, peak_bytes):
+            median = sorted(timings)[len(timings) // 2]
+            return {"id": case_id, "timings": timings, "ops_per_sec": 1.0 / median,
+                    "p99_runs": p99_runs, "p99": sorted(p99_runs)[len(p99_runs) // 2],
+                    "peak_bytes": peak_bytes, "allocated_blocks": 40}
+
+        old = {"results": [
+            result("slower", [1.0, 1.1, 1.0, 0.9, 1.0], [2.0] * 5, 4000),
+            result("noisy", [1.0, 2.0, 1.0, 1.0, 1.0], [2.0] * 5, 4000),
+            result("bigger", [1.0] * 5, [2.0] * 5, 4000),
+            result("removed", [1.0] * 5, [2.0] * 5, 4000),
+        ]}
+        new = {"results": [
+            result("slower", [1.3, 1.4, 1.3, 1.5, 1.3], [2.0] * 5, 4000),
+            result("noisy", [1.0, 1.0, 2.0, 1.0, 1.2], [2.0] * 5, 4500),
+            result("bigger", [1.0] * 5, [2.0] * 5, 8000),
+            result("added", [1.0] * 5, [2.0] * 5, 4000),
+        ]}
+        changes = baseline.compare_results(old, new, threshold=0.1)
+        self.assertEqual(12, len(changes))
+        regressions = [(change.case_id, change.metric)
+                       for change in changes if change.is_regression]
+        self.assertEqual([("slower", "ops_per_sec"), ("bigger", "peak_bytes")],
+                         regressions)
+        self.assertTrue(changes[0].p_value < 0.05)
+        self.assertAlmostEqual(0.23, changes[0].ratio, places=2)
+
+        diff = baseline.format_changes(changes)
+        self.assertEqual(2, len(diff.splitlines()))
+        self.assertTrue("slower" in diff and "REGRESSION" in diff)
+        self.assertEqual(12, len(baseline.format_changes(changes, verbose=True)
+                                 .splitlines()))
+
+        with temporary_dir() as path:
+            self.assertEqual(None, baseline.load_baseline(path))
+            baseline_path = baseline.save_baseline(new["results"], path)
+            self.assertEqual(baseline.get_baseline_path(path), baseline_path)
+            self.assertTrue(bench.get_fingerprint() in baseline_path)
+            self.assertEqual(new["results"], baseline.load_baseline(path)["results"])
+
 class SijaxStreamingTestCase(unittest.TestCase):
     """This tests the StreamingIframeResponse functionality, which is
     used behind the Comet and Upload plugins.
@@ -828,6 +1886,29 @@ class SijaxStreamingTestCase(unittest.TestCase):
                     'TypeError', 'TypeError2']
         self.assertEqual(expected, call_history)
 
+    def test_pushed_frames_are_bounded(self):
+        class SmallResponse(StreamingIframeResponse):
+            MAX_OUTBOX_BYTES = 5000
+
+        frame = b"x" * 1000
+
+        def callback(obj_response):
+            # the first flush carries the padding
+            obj_response.alert("Started")
+            yield obj_response
+            for _ in range(5):
+                obj_response.push_frame(frame)
+            self.assertRaises(SijaxError, obj_response.push_frame, frame)
+            yield obj_response
+            # there's room again, once the frames are sent
+            for _ in range(5):
+                obj_response.push_frame(frame)
+
+        chunks = list(Sijax().execute_callback([], callback=callback,
+                                               response_class=SmallResponse))
+        self.assertEqual(11, len(chunks))
+        self.assertEqual([frame] * 10, chunks[1:])
+
 
 class SijaxCometTestCase(unittest.TestCase):
     """Exercises certain Comet specific things. Most of the functionality
@@ -893,6 +1974,554 @@ class SijaxCometTestCase(unittest.TestCase):
         ]
         self.assertEqual(call_history_expected, call_history)
 
+    def test_hub_shares_published_messages(self):
+        from sijax.plugin.comet import Hub, Message
+
+        hub = Hub(queue_size=2)
+
+        def listen(obj_response):
+            obj_response.alert("Subscribed")
+            with hub.subscribe("news", obj_response, timeout=0.01) as subscription:
+                for _ in subscription:
+                    yield obj_response
+
+        def connect(response_format=None):
+            inst = Sijax()
+            cls = inst.__class__
+            register_comet_callback(inst, "listen", listen)
+            data = {cls.PARAM_REQUEST: "listen", cls.PARAM_ARGS: "[]"}
+            if response_format is not None:
+                data[cls.PARAM_FORMAT] = response_format
+            inst.set_data(data)
+            response = inst.process_request()
+            self.assertTrue("Subscribed" in next(response).decode("utf-8"))
+            return response
+
+        connections = [connect() for _ in range(3)]
+        compact = connect(Sijax.FORMAT_COMPACT)
+        self.assertEqual(4, hub.get_subscribers_count("news"))
+
+        message = Message()
+        message.html("#news", "Breaking news")
+        self.assertEqual(4, hub.publish("news", message))
+
+        # serialized once per response format, the bytes are shared
+        chunks = [next(response) for response in connections]
+        self.assertTrue(b"Breaking news" in chunks[0])
+        self.assertTrue(chunks[0] is chunks[1] is chunks[2])
+        compact_chunk = next(compact)
+        self.assertTrue(b"Breaking news" in compact_chunk)
+        self.assertFalse(compact_chunk is chunks[0])
+
+        # the queue is bounded - the oldest messages get dropped
+        for idx in range(3):
+            message = Message()
+            message.html("#news", "News %d" % idx)
+            hub.publish("news", message)
+        chunks = [next(connections[0]), next(connections[0])]
+        self.assertTrue(b"News 1" in chunks[0])
+        self.assertTrue(b"News 2" in chunks[1])
+
+        # closing the channel makes the functions exit
+        hub.close("news")
+        for response in connections + [compact]:
+            self.assertEqual([], [chunk for chunk in response if b"News" in chunk])
+        self.assertEqual(0, hub.get_subscribers_count("news"))
+
+    def test_fetch_transport_streams_ndjson(self):
+        from sijax.helper import json
+        from sijax.plugin.comet import Hub, Message
+
+        hub = Hub()
+
+        def listen(obj_response):
+            obj_response.alert("Subscribed")
+            with hub.subscribe("news", obj_response, timeout=0.01) as subscription:
+                for _ in subscription:
+                    yield obj_response
+
+        def connect(transport=None):
+            inst = Sijax()
+            cls = inst.__class__
+            register_comet_callback(inst, "listen", listen)
+            data = {cls.PARAM_REQUEST: "listen", cls.PARAM_ARGS: "[]"}
+            if transport is not None:
+                data[cls.PARAM_TRANSPORT] = transport
+            inst.set_data(data)
+            return inst, inst.process_request()
+
+        inst, response = connect(Sijax.TRANSPORT_FETCH)
+        self.assertEqual("application/x-ndjson; charset=utf-8",
+                         inst.response_content_type)
+
+        # no padding and no markup - a single line of JSON per flush
+        chunk = next(response).decode("utf-8")
+        self.assertTrue(chunk.endswith("\n"))
+        self.assertEqual(1, chunk.count("\n"))
+        commands = json.loads(chunk)
+        self.assertEqual("Subscribed", commands[0]["alert"])
+
+        iframe_inst, iframe_response = connect()
+        self.assertTrue("text/html" in iframe_inst.response_content_type)
+        next(iframe_response)
+
+        message = Message()
+        message.html("#news", "Line\nbreak")
+        hub.publish("news", message)
+        chunk = next(response)
+        self.assertEqual(b"\n", chunk[-1:])
+        self.assertEqual("Line\nbreak", json.loads(chunk.decode("utf-8"))[0]["html"])
+        # framed differently for each transport
+        iframe_chunk = next(iframe_response)
+        self.assertTrue(b"<script" in iframe_chunk)
+        self.assertFalse(b"<script" in chunk)
+
+        hub.close("news")
+        self.assertEqual([], list(response))
+
+    def test_scheduler_drives_many_streams_from_one_thread(self):
+        import time
+        from sijax.plugin.comet import Hub, Message, Scheduler
+
+        hub = Hub()
+        outputs = {}
+
+        def count(obj_response, name):
+            for i in range(3):
+                obj_response.alert("%s-%d" % (name, i))
+                yield obj_response.sleep(0.05)
+
+        def listen(obj_response, name):
+            with hub.subscribe("news", obj_response) as subscription:
+                obj_response.alert("%s-subscribed" % name)
+                while not subscription.is_closed:
+                    yield obj_response.wait(subscription, timeout=5)
+
+        inst = Sijax()
+        cls = inst.__class__
+        register_comet_callback(inst, "count", count)
+        register_comet_callback(inst, "listen", listen)
+
+        def spawn(scheduler, func_name, name):
+            inst.set_data({cls.PARAM_REQUEST: func_name,
+                           cls.PARAM_ARGS: '["%s"]' % name})
+            outputs[name] = []
+            scheduler.spawn(inst.process_request(), outputs[name].append)
+
+        scheduler = Scheduler()
+        for idx in range(200):
+            spawn(scheduler, "count", "c%d" % idx)
+        for idx in range(50):
+            spawn(scheduler, "listen", "l%d" % idx)
+
+        # everyone sleeps at the same time, instead of one after another
+        started = time.time()
+        while hub.get_subscribers_count("news") != 50 or scheduler.tasks_count != 50:
+            scheduler.run_once(timeout=1)
+        self.assertTrue(time.time() - started < 2)
+        for idx in range(200):
+            output = b"".join(outputs["c%d" % idx]).decode("utf-8")
+            self.assertTrue("c%d-2" % idx in output)
+
+        message = Message()
+        message.alert("Breaking news")
+        hub.publish("news", message)
+        hub.close("news")
+        scheduler.run(until_idle=True)
+
+        for idx in range(50):
+            chunks = outputs["l%d" % idx]
+            self.assertTrue(b"l%d-subscribed" % idx in chunks[0])
+            self.assertTrue(chunks[1] is message.get_frame(CometResponse(inst, [])))
+
+        # without a scheduler, hints block and never reach the server
+        inst.set_data({cls.PARAM_REQUEST: "count", cls.PARAM_ARGS: '["x"]'})
+        started = time.time()
+        chunks = list(inst.process_request())
+        self.assertTrue(time.time() - started >= 0.15)
+        self.assertEqual(3, len(chunks))
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+
+    def test_hub_overflow_policies(self):
+        import threading
+        from sijax.plugin.comet import Hub, Message
+
+        def publish(hub, key, value):
+            message = Message()
+            message.html("#%s" % key, value, key=key)
+            hub.publish("news", message)
+
+        def pending_html(subscription):
+            obj_response = subscription._obj_response
+            subscription._push_pending()
+            return b"".join(obj_response._encode_chunk(chunk)
+                            for chunk in obj_response._drain())
+
+        # dropping the oldest messages
+        hub = Hub(queue_size=2, overflow=Hub.OVERFLOW_DROP)
+        subscription = hub.subscribe("news", CometResponse(Sijax(), []))
+        for idx in range(5):
+            publish(hub, "price", "price-%d" % idx)
+        output = pending_html(subscription)
+        self.assertFalse(b"price-2" in output)
+        self.assertTrue(b"price-3" in output and b"price-4" in output)
+        self.assertEqual(3, subscription.dropped_count)
+        self.assertEqual({"subscribers": 1, "dropped": 3, "merged": 0,
+                          "blocked": 0}, hub.get_stats())
+
+        # merging keyed commands
+        hub = Hub(queue_size=2, overflow=Hub.OVERFLOW_MERGE)
+        subscription = hub.subscribe("news", CometResponse(Sijax(), []))
+        for idx in range(5):
+            publish(hub, "price", "price-%d" % idx)
+            publish(hub, "volume", "volume-%d" % idx)
+        output = pending_html(subscription)
+        for idx in range(4):
+            self.assertFalse(("price-%d" % idx).encode("utf-8") in output)
+        self.assertTrue(b"price-4" in output and b"volume-4" in output)
+        self.assertEqual(0, subscription.dropped_count)
+        self.assertTrue(subscription.merged_count > 0)
+        self.assertEqual(subscription.merged_count, hub.get_stats()["merged"])
+
+        # blocking, until there's room in the queue (or for some time)
+        hub = Hub(queue_size=1, overflow=Hub.OVERFLOW_BLOCK, block_timeout=5)
+        subscription = hub.subscribe("news", CometResponse(Sijax(), []))
+        publish(hub, "price", "price-0")
+        publisher = threading.Thread(target=publish, args=(hub, "price", "price-1"))
+        publisher.start()
+        while subscription.blocked_count == 0:
+            publisher.join(0.01)
+        self.assertTrue(b"price-0" in pending_html(subscription))
+        publisher.join()
+        self.assertTrue(b"price-1" in pending_html(subscription))
+        self.assertEqual(0, subscription.dropped_count)
+
+        hub = Hub(queue_size=1, overflow=Hub.OVERFLOW_BLOCK, block_timeout=0.01)
+        subscription = hub.subscribe("news", CometResponse(Sijax(), []))
+        publish(hub, "price", "price-0")
+        publish(hub, "price", "price-1")
+        self.assertEqual(1, subscription.dropped_count)
+        self.assertTrue(b"price-1" in pending_html(subscription))
+
+        # publishing from many threads at once keeps the counters right
+        hub = Hub(queue_size=1)
+        subscription = hub.subscribe("news", CometResponse(Sijax(), []))
+
+        def publish_many():
+            for idx in range(200):
+                publish(hub, "price", "price-%d" % idx)
+
+        publishers = [threading.Thread(target=publish_many) for _ in range(4)]
+        for thread in publishers:
+            thread.start()
+        for thread in publishers:
+            thread.join()
+        self.assertEqual({"dropped": 799, "merged": 0, "blocked": 0},
+                         subscription.get_stats())
+        self.assertEqual(799, hub.get_stats()["dropped"])
+
+        # messages that don't fit in the outbox stay queued, until sent
+        class SmallResponse(CometResponse):
+            MAX_OUTBOX_BYTES = 2500
+
+        def publish_large(hub, idx):
+            message = Message()
+            message.html("#news", "%d" % idx + "x" * 1000)
+            hub.publish("news", message)
+
+        for overflow, dropped in ((Hub.OVERFLOW_DROP, 1), (Hub.OVERFLOW_MERGE, 0)):
+            hub = Hub(queue_size=3, overflow=overflow)
+            obj_response = SmallResponse(Sijax(), [])
+            obj_response.alert("Subscribed")
+            list(obj_response._drain())
+            subscription = hub.subscribe("news", obj_response)
+            for idx in range(3):
+                publish_large(hub, idx)
+            self.assertEqual(2, subscription._push_pending())
+            self.assertEqual(1, len(subscription._queue))
+            for idx in range(3, 6):
+                publish_large(hub, idx)
+            # the full queue gets the overflow policy applied
+            subscription._push_pending()
+            self.assertEqual(dropped, subscription.dropped_count)
+            html = b"".join(obj_response._drain())
+            self.assertTrue(b"0x" in html and b"1x" in html)
+            self.assertFalse(b"2x" in html)
+            remaining = b""
+            while subscription._queue:
+                remaining += pending_html(subscription)
+            self.assertTrue(b"4x" in remaining and b"5x" in remaining)
+            self.assertEqual(overflow == Hub.OVERFLOW_MERGE, b"2x" in remaining)
+
+    def test_long_polling_resumes_from_the_cursor(self):
+        import time
+        import threading
+        from sijax.helper import json
+        from sijax.plugin.comet import Hub, Message, History, \
+             register_long_poll_callback
+
+        history = History(max_bytes=10 * 1024, max_age=60)
+        hub = Hub(history=history)
+        inst = Sijax()
+        cls = inst.__class__
+        register_long_poll_callback(inst, "poll", hub, "news", timeout=0.05)
+
+        def publish(text):
+            message = Message()
+            message.html("#news", text)
+            hub.publish("news", message)
+
+        def poll(cursor):
+            inst.set_data({cls.PARAM_REQUEST: "poll",
+                           cls.PARAM_ARGS: json.dumps([cursor])})
+            commands = json.loads(inst.process_request())
+            texts = [command["html"] for command in commands
+                     if command["type"] == "html"]
+            calls = dict((command["call"], command["params"])
+                         for command in commands if command["type"] == "call")
+            return texts, calls
+
+        # nothing is replayed for browsers that just started polling
+        publish("Old news")
+        texts, calls = poll(None)
+        self.assertEqual([], texts)
+        cursor = calls["sjxComet.pollCursor"][1]
+
+        # messages published while the browser reconnects are not lost
+        publish("News 1")
+        publish("News 2")
+        texts, calls = poll(cursor)
+        self.assertEqual(["News 1", "News 2"], texts)
+
+        # messages are kept serialized, and are decoded for other formats
+        batches = history.get_since("news", cursor)[0]
+        self.assertEqual([[{"type": "html", "selector": "#news",
+                            "html": "News 1", "setType": "replace"}]],
+                         [json.loads(batch) for batch in batches[:1]])
+        from sijax.testing import expand_commands
+        inst.set_data({cls.PARAM_REQUEST: "poll", cls.PARAM_ARGS: json.dumps([cursor]),
+                       cls.PARAM_FORMAT: cls.FORMAT_COMPACT})
+        commands = expand_commands(json.loads(inst.process_request()))
+        self.assertEqual(["News 1", "News 2"],
+                         [command["html"] for command in commands
+                          if command["type"] == "html"])
+        self.assertEqual("sjxComet.pollCursor", commands[-1]["call"])
+        cursor = calls["sjxComet.pollCursor"][1]
+
+        # waiting for new messages
+        timer = threading.Timer(0.01, publish, args=("News 3", ))
+        timer.start()
+        register_long_poll_callback(inst, "poll", hub, "news", timeout=5)
+        started = time.time()
+        texts, calls = poll(cursor)
+        timer.join()
+        self.assertEqual(["News 3"], texts)
+        self.assertTrue(time.time() - started < 4)
+        cursor = calls["sjxComet.pollCursor"][1]
+
+        # evicted messages (size limit) and unknown cursors lead to a reset
+        for idx in range(200):
+            publish("News %d" % idx)
+        self.assertTrue(history.get_size("news") <= 10 * 1024)
+        texts, calls = poll(cursor)
+        self.assertEqual([], texts)
+        self.assertEqual(["poll"], calls["sjxComet.pollReset"])
+        texts, calls = poll("another-process:1")
+        self.assertTrue("sjxComet.pollReset" in calls)
+
+        # old messages get evicted
+        history.max_age = 0
+        time.sleep(0.01)
+        self.assertEqual(([], history.get_cursor("news"), False),
+                         history.get_since("news", cursor))
+        self.assertEqual(0, history.get_size("news"))
+
+    def test_history_forgets_expired_channels(self):
+        import time
+        from sijax.plugin.comet import Message, History
+
+        def create_message(text):
+            message = Message()
+            message.html("#news", text)
+            return message
+
+        history = History(max_age=60)
+        idle_cursor = history.get_cursor("idle")
+        for idx in range(100):
+            history.append("channel-%d" % idx, create_message("News"))
+        cursor = history.get_cursor("channel-0")
+        self.assertEqual(100, len(history._entries))
+
+        history.max_age = 0
+        time.sleep(0.01)
+        history._next_prune = 0
+        history.append("news", create_message("News"))
+        self.assertEqual(["news"], list(history._entries))
+        self.assertEqual(["news"], list(history._evicted_seq))
+
+        # browsers that missed expired messages still get reset,
+        # and sequence numbers are not reused
+        self.assertEqual(False, history.get_since("channel-0", idle_cursor)[2])
+        history.max_age = 60
+        history.append("channel-0", create_message("Fresh news"))
+        messages, _, is_complete = history.get_since("channel-0", cursor)
+        self.assertTrue(is_complete)
+        self.assertEqual(1, len(messages))
+        self.assertEqual(False, history.get_since("channel-0", idle_cursor)[2])
+        self.assertEqual(([], history.get_cursor("idle"), True),
+                         history.get_since("idle", history.get_cursor("idle")))
+
+        # forgetting a channel doesn't reset the browsers of the other ones
+        history = History(max_age=60)
+        history.append("a", create_message("A1"))
+        cursor_a = history.get_cursor("a")
+        history.append("b", create_message("B1"))
+        history.append("b", create_message("B2"))
+        history.max_age = 0
+        time.sleep(0.01)
+        history._next_prune = 0
+        self.assertEqual(([], history.get_cursor("b"), True),
+                         history.get_since("b", history.get_cursor("b")))
+        self.assertFalse("b" in history._entries)
+        history.max_age = 60
+        history.append("a", create_message("A2"))
+        messages, cursor, is_complete = history.get_since("a", cursor_a)
+        self.assertTrue(is_complete)
+        self.assertEqual(1, len(messages))
+        self.assertEqual(history.get_cursor("a"), cursor)
+        # new channels start complete, for cursors older than them
+        history.append("c", create_message("C1"))
+        messages, _, is_complete = history.get_since("c", cursor_a)
+        self.assertTrue(is_complete)
+        self.assertEqual(1, len(messages))
+
+    def _connect_listener(self, hub, channel):
+        def listen(obj_response):
+            with hub.subscribe(channel, obj_response, timeout=5) as subscription:
+                obj_response.alert("Subscribed")
+                yield obj_response
+                for _ in subscription:
+                    yield obj_response
+
+        inst = Sijax()
+        cls = inst.__class__
+        register_comet_callback(inst, "listen", listen)
+        inst.set_data({cls.PARAM_REQUEST: "listen", cls.PARAM_ARGS: "[]"})
+        response = inst.process_request()
+        self.assertTrue(b"Subscribed" in next(response))
+        return response
+
+    def _assert_broadcasts(self, hub_one, hub_two):
+        from sijax.plugin.comet import Message
+
+        response_one = self._connect_listener(hub_one, "news")
+        response_two = self._connect_listener(hub_two, "news")
+
+        message = Message()
+        message.html("#news", "Breaking news")
+        # delivered locally right away, and to other processes via the backend
+        self.assertEqual(1, hub_one.publish("news", message))
+        self.assertTrue(b"Breaking news" in next(response_one))
+        self.assertTrue(b"Breaking news" in next(response_two))
+
+        message = Message()
+        message.alert("From the other side")
+        hub_two.publish("news", message)
+        self.assertTrue(b"From the other side" in next(response_one))
+        self.assertTrue(b"From the other side" in next(response_two))
+
+        hub_one.close("news")
+        hub_two.close("news")
+
+    def test_unix_socket_backend_broadcasts_between_hubs(self):
+        from sijax.plugin.comet import Hub, Message, UnixSocketBackend
+
+        with temporary_dir() as path:
+            backends = [UnixSocketBackend(path) for _ in range(2)]
+            hubs = [Hub(backend=backend) for backend in backends]
+
+            # sockets left behind by processes that are gone get removed
+            stale_path = os.path.join(path, "stale.sock")
+            import socket
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            stale.bind(stale_path)
+            stale.close()
+
+            self._assert_broadcasts(hubs[0], hubs[1])
+            self.assertFalse(os.path.exists(stale_path))
+
+            # messages too large to broadcast aren't delivered locally either
+            subscription = hubs[0].subscribe("news", CometResponse(Sijax(), []))
+            message = Message()
+            message.html("#news", "x" * UnixSocketBackend.MAX_MESSAGE_SIZE)
+            self.assertRaises(SijaxError, hubs[0].publish, "news", message)
+            self.assertEqual(0, len(subscription._queue))
+
+            for backend in backends:
+                backend.close()
+            self.assertEqual([], os.listdir(path))
+
+    def test_redis_backend_broadcasts_between_hubs(self):
+        import fnmatch
+        import threading
+        from six.moves import queue
+        from sijax.plugin.comet import Hub, RedisBackend
+
+        class FakePubSub(object):
+            def __init__(self, server):
+                self.server = server
+                self.patterns = []
+                self.queue = queue.Queue()
+
+            def psubscribe(self, pattern):
+                self.patterns.append(pattern)
+
+            def punsubscribe(self):
+                self.patterns = []
+                self.queue.put(None)
+
+            def close(self):
+                pass
+
+            def listen(self):
+                while True:
+                    item = self.queue.get()
+                    if item is None:
+                        return
+                    yield item
+
+        class FakeRedis(object):
+            def __init__(self, decode_responses=False):
+                self.decode_responses = decode_responses
+                self.pubsubs = []
+                self.lock = threading.Lock()
+
+            def pubsub(self):
+                pubsub = FakePubSub(self)
+                with self.lock:
+                    self.pubsubs.append(pubsub)
+                return pubsub
+
+            def publish(self, channel, data):
+                with self.lock:
+                    pubsubs = list(self.pubsubs)
+                if self.decode_responses:
+                    data = data.decode("utf-8")
+                for pubsub in pubsubs:
+                    for pattern in pubsub.patterns:
+                        if fnmatch.fnmatchcase(channel, pattern):
+                            pubsub.queue.put({"type": "pmessage", "pattern": pattern,
+                                              "channel": channel, "data": data})
+
+        # clients may also hand out already decoded (text) data
+        for decode_responses in (False, True):
+            server = FakeRedis(decode_responses)
+            backends = [RedisBackend(server) for _ in range(2)]
+            hubs = [Hub(backend=backend) for backend in backends]
+            self._assert_broadcasts(hubs[0], hubs[1])
+            for backend in backends:
+                backend.close()
+
 
 class SijaxUploadTestCase(unittest.TestCase):
     """Exercises certain Comet specific things. Most of the functionality
@@ -979,12 +2608,576 @@ class SijaxUploadTestCase(unittest.TestCase):
         self.assertEqual(call_history_expected, call_history)
 
 
+    def test_form_values_are_a_read_only_view(self):
+        from sijax.plugin.upload import FormValues
+
+        class MultiDict(dict):
+            def getlist(self, key):
+                return ["first", "second"]
+
+        cls = Sijax
+        data = MultiDict({cls.PARAM_REQUEST: "func", cls.PARAM_ARGS: "[]",
+                          "name": "value", "multi": "first"})
+        form_values = FormValues(data, cls.SYSTEM_PARAMS)
+
+        self.assertEqual(2, len(form_values))
+        self.assertEqual(set(["name", "multi"]), set(form_values))
+        self.assertEqual({"name": "value", "multi": "first"}, form_values)
+        self.assertFalse(cls.PARAM_REQUEST in form_values)
+        self.assertRaises(KeyError, lambda: form_values[cls.PARAM_ARGS])
+        self.assertEqual(None, form_values.get(cls.PARAM_ARGS))
+        self.assertEqual(["first", "second"], form_values.getlist("multi"))
+        self.assertEqual([], form_values.getlist(cls.PARAM_REQUEST))
+        self.assertEqual(["value"], FormValues({"name": "value"}, []).getlist("name"))
+
+        def assign():
+            form_values["name"] = "other"
+        self.assertRaises(TypeError, assign)
+
+        # changes to the underlying data are visible (no copy was made)
+        data["late"] = "value"
+        self.assertTrue("late" in form_values)
+
+    def test_form_values_do_not_copy_the_request_data(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            self.skipTest("tracemalloc is not available")
+
+        from io import BytesIO
+
+        inst = Sijax()
+        cls = inst.__class__
+        post = dict(("field_%d" % i, BytesIO(b"")) for i in range(20000))
+        post[cls.PARAM_REQUEST] = "form_upload"
+        post[cls.PARAM_ARGS] = '["form"]'
+        inst.set_data(post)
+
+        def callback(obj_response, form_values):
+            self.assertEqual(20000, len(form_values))
+
+        register_upload_callback(inst, "form", callback)
+
+        tracemalloc.start()
+        try:
+            for string in inst.process_request():
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        # a copy of the dictionary alone would take more than 500kB
+        self.assertTrue(peak < 64 * 1024, "Peak memory: %d bytes" % peak)
+
+    def test_streaming_files_reports_progress_and_checksums(self):
+        import hashlib
+        from io import BytesIO
+        from sijax.exception import UploadTooLargeError
+        from sijax.plugin.upload import StreamedFile
+
+        content = os.urandom(300 * 1024)
+        results = {}
+
+        def callback(obj_response, files, form_values):
+            upload = obj_response.stream_file(files["file"], files["destination"],
+                                              hashes=["sha256", "md5"],
+                                              max_size=files["max_size"],
+                                              chunk_size=16 * 1024,
+                                              progress_interval=100 * 1024)
+            try:
+                for _ in upload:
+                    yield obj_response
+            except UploadTooLargeError:
+                obj_response.alert("Too large!")
+                return
+            results["size"] = upload.size
+            results["total_size"] = upload.total_size
+            results["hexdigests"] = upload.hexdigests
+
+        def process(max_size, destination):
+            inst = Sijax()
+            cls = inst.__class__
+            files = {"file": BytesIO(content), "destination": destination,
+                     "max_size": max_size}
+            register_upload_callback(inst, "form", callback, args_extra=[files])
+            inst.set_data({cls.PARAM_REQUEST: "form_upload",
+                           cls.PARAM_ARGS: '["form"]'})
+            return [chunk.decode("utf-8") for chunk in inst.process_request()]
+
+        with temporary_dir() as path:
+            destination = os.path.join(path, "file.bin")
+
+            chunks = process(None, destination)
+            # progress after every 100kB (reached after 112kB and 224kB,
+            # with 16kB chunks) and once at the end
+            self.assertEqual(3, len(chunks))
+            self.assertTrue("sjxUpload.progress" in chunks[-1])
+            self.assertTrue('["form",%d,%d]' % (len(content), len(content))
+                            in chunks[-1])
+
+            self.assertEqual(len(content), results["size"])
+            self.assertEqual(len(content), results["total_size"])
+            self.assertEqual(hashlib.sha256(content).hexdigest(),
+                             results["hexdigests"]["sha256"])
+            self.assertEqual(hashlib.md5(content).hexdigest(),
+                             results["hexdigests"]["md5"])
+            with open(destination, "rb") as fp:
+                self.assertEqual(content, fp.read())
+
+            # the size limit is enforced and the partial file gets removed
+            os.unlink(destination)
+            results.clear()
+            chunks = process(100 * 1024, destination)
+            self.assertTrue("Too large!" in chunks[-1])
+            self.assertEqual({}, results)
+            self.assertFalse(os.path.exists(destination))
+
+            # completely written files are kept, even if the iteration
+            # stops at the final (progress) pause
+            class Response(object):
+                is_streaming = False
+
+            upload = iter(StreamedFile(Response(), BytesIO(content), destination))
+            next(upload)
+            upload.close()
+            with open(destination, "rb") as fp:
+                self.assertEqual(content, fp.read())
+
+        # writing to file-like objects, or not writing at all
+        output = BytesIO()
+        process(None, output)
+        self.assertEqual(content, output.getvalue())
+        process(None, None)
+        self.assertEqual(len(content), results["size"])
+
+    def test_spooled_file_factory_keeps_small_files_in_memory(self):
+        from sijax.plugin.upload import spooled_file_factory
+
+        factory = spooled_file_factory(1024)
+        fp = factory(2048, "multipart/form-data", "file.txt", 2048)
+        fp.write(b"x" * 1000)
+        self.assertFalse(fp._rolled)
+        fp.write(b"x" * 1000)
+        self.assertTrue(fp._rolled)
+        fp.seek(0)
+        self.assertEqual(2000, len(fp.read()))
+        fp.close()
+
+    def test_xhr_uploads_get_a_regular_response(self):
+        from io import BytesIO
+        from sijax.helper import json
+
+        def callback(obj_response, files, form_values):
+            obj_response.alert("Started")
+            yield obj_response
+            upload = obj_response.stream_file(files["file"],
+                                              chunk_size=1024,
+                                              progress_interval=1024)
+            for _ in upload:
+                yield obj_response
+            obj_response.alert("%d %s" % (upload.size, form_values["title"]))
+
+        inst = Sijax()
+        cls = inst.__class__
+        files = {"file": BytesIO(b"x" * 4096)}
+        register_upload_callback(inst, "form", callback, args_extra=[files])
+
+        inst.set_data({cls.PARAM_REQUEST: "form_upload",
+                       cls.PARAM_ARGS: '["form"]',
+                       cls.PARAM_TRANSPORT: cls.TRANSPORT_XHR,
+                       "title": "Title"})
+        self.assertEqual(cls.TRANSPORT_XHR, inst.transport)
+        self.assertEqual("application/json", inst.response_content_type)
+
+        # everything in a single response, without progress reports
+        response = inst.process_request()
+        self.assertTrue(isinstance(response, string_types))
+        commands = json.loads(response)
+        self.assertEqual(["Started", "4096 Title"],
+                         [command["alert"] for command in commands])
+
+        # unknown transports are ignored
+        inst.set_data({cls.PARAM_REQUEST: "form_upload",
+                       cls.PARAM_ARGS: '["form"]',
+                       cls.PARAM_TRANSPORT: "unknown",
+                       "title": "Title"})
+        files["file"].seek(0)
+        self.assertEqual(cls.TRANSPORT_DEFAULT, inst.transport)
+        self.assertEqual("text/html; charset=utf-8", inst.response_content_type)
+        chunks = list(inst.process_request())
+        self.assertTrue(len(chunks) > 2)
+
+    def test_chunked_uploads_can_be_resumed(self):
+        from io import BytesIO
+        from sijax.helper import json
+        from sijax.plugin.upload import ChunkedUploadStore, \
+             register_chunked_upload_callback
+
+        content = os.urandom(100 * 1024)
+        chunk_size = 30 * 1024
+        received = []
+
+        def callback(obj_response, user, file_path, file_name):
+            with open(file_path, "rb") as fp:
+                received.append((user, file_name, fp.read()))
+
+        def request(inst, args, chunk=None):
+            cls = inst.__class__
+            post = {cls.PARAM_REQUEST: "upload", cls.PARAM_ARGS: json.dumps(args)}
+            if chunk is not None:
+                post[cls.PARAM_REFS] = "[3]"
+                post["sijax_arg_3"] = BytesIO(chunk)
+            inst.set_data(post)
+            return json.loads(inst.process_request())
+
+        with temporary_dir() as path:
+            store = ChunkedUploadStore(os.path.join(path, "user"))
+            inst = Sijax()
+            register_chunked_upload_callback(inst, "upload", store, callback,
+                                             args_extra=["user"])
+
+            response = request(inst, ["begin", "abc", len(content), "a.bin"])
+            self.assertEqual(["abc", 0, 0], response[0]["params"])
+
+            for number in (0, 1):
+                chunk = content[number * chunk_size:(number + 1) * chunk_size]
+                response = request(inst, ["chunk", "abc", number, "sijax_arg_3"], chunk)
+            self.assertEqual(["abc", 2, 2 * chunk_size], response[0]["params"])
+
+            # a chunk that was already committed is ignored,
+            # while chunks out of order are rejected
+            request(inst, ["chunk", "abc", 1, "sijax_arg_3"], b"garbage")
+            response = request(inst, ["chunk", "abc", 3, "sijax_arg_3"], b"garbage")
+            self.assertEqual("sjxUpload.chunkedFailed", response[0]["call"])
+            self.assertEqual(2 * chunk_size, store.get_state("abc")["offset"])
+
+            # an interrupted write leaves garbage behind, which gets overwritten
+            with open(os.path.join(store.directory, "abc.part"), "ab") as fp:
+                fp.write(b"garbage")
+
+            # beginning again (after a page reload) resumes the upload
+            response = request(inst, ["begin", "abc", len(content), "a.bin"])
+            self.assertEqual(["abc", 2, 2 * chunk_size], response[0]["params"])
+
+            # finalizing early is not allowed
+            response = request(inst, ["finalize", "abc"])
+            self.assertEqual("sjxUpload.chunkedFailed", response[0]["call"])
+            self.assertEqual([], received)
+
+            for number in (2, 3):
+                chunk = content[number * chunk_size:(number + 1) * chunk_size]
+                request(inst, ["chunk", "abc", number, "sijax_arg_3"], chunk)
+            response = request(inst, ["finalize", "abc"])
+            self.assertEqual("sjxUpload.chunkedComplete", response[0]["call"])
+            self.assertEqual([("user", "a.bin", content)], received)
+            self.assertEqual([], os.listdir(store.directory))
+
+            # upload ids can't be used to escape the directory
+            response = request(inst, ["begin", "../abc", 10, "a.bin"])
+            self.assertEqual("sjxUpload.chunkedFailed", response[0]["call"])
+            # sizes over the limit are refused
+            store.max_size = 10
+            response = request(inst, ["begin", "abc", 11, "a.bin"])
+            self.assertEqual("sjxUpload.chunkedFailed", response[0]["call"])
+
+class SijaxCompressionTestCase(unittest.TestCase):
+    """Tests the gzip/deflate compression helpers and WSGI middleware."""
+
+    def test_encoding_negotiation_respects_quality_values(self):
+        self.assertEqual(None, negotiate_encoding(None))
+        self.assertEqual(None, negotiate_encoding(""))
+        self.assertEqual(None, negotiate_encoding("identity"))
+        self.assertEqual("gzip", negotiate_encoding("gzip, deflate"))
+        self.assertEqual("gzip", negotiate_encoding("deflate, gzip"))
+        self.assertEqual("deflate", negotiate_encoding("gzip;q=0, deflate"))
+        self.assertEqual("deflate", negotiate_encoding("DEFLATE"))
+        self.assertEqual("gzip", negotiate_encoding("*"))
+        self.assertEqual(None, negotiate_encoding("*;q=0"))
+        self.assertEqual(None, negotiate_encoding("gzip", encodings=("deflate", )))
+
+    def test_compress_response_handles_regular_responses(self):
+        import zlib
+
+        inst = Sijax()
+        cls = inst.__class__
+
+        def callback(obj_response):
+            for i in range(50):
+                obj_response.html("#table-cell-%d" % i, "<strong>Value</strong>")
+
+        inst.set_data({cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: "[]"})
+        inst.register_callback("callback", callback)
+        response = inst.process_request()
+
+        body, encoding = compress_response(response, "gzip")
+        self.assertEqual("gzip", encoding)
+        self.assertTrue(len(body) < len(response.encode("utf-8")) / 5)
+        decompressed = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.assertEqual(response.encode("utf-8"), decompressed)
+
+        body, encoding = compress_response(response, "br")
+        self.assertEqual(None, encoding)
+        self.assertTrue(body is response)
+
+    def test_streaming_responses_are_flushed_after_every_chunk(self):
+        import zlib
+
+        inst = Sijax()
+        cls = inst.__class__
+
+        def callback(obj_response):
+            for i in range(3):
+                obj_response.html("#progress", "Step %d" % i)
+                yield obj_response
+
+        inst.set_data({cls.PARAM_REQUEST: "callback", cls.PARAM_ARGS: "[]"})
+        register_comet_callback(inst, "callback", callback)
+
+        body, encoding = compress_response(inst.process_request(), "deflate")
+        self.assertEqual("deflate", encoding)
+
+        # Every compressed piece should be decompressable immediately,
+        # without waiting for the stream to finish
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        pieces = list(body)
+        for i, piece in enumerate(pieces[:-1]):
+            chunk = decompressor.decompress(piece)
+            self.assertTrue(("Step %d" % i).encode("utf-8") in chunk)
+        self.assertEqual(b"", decompressor.decompress(pieces[-1]))
+
+    def test_middleware_compresses_negotiated_responses(self):
+        import zlib
+
+        closed = []
+
+        class AppIter(object):
+            def __iter__(self):
+                yield b"first chunk " * 30
+                yield b"second chunk " * 30
+
+            def close(self):
+                closed.append(True)
+
+        def app(environ, start_response):
+            headers = [("Content-Type", environ["test.content_type"])]
+            start_response("200 OK", headers)
+            return AppIter()
+
+        def call(accept_encoding, content_type="text/html; charset=utf-8",
+                 level=6):
+            result = {}
+            def start_response(status, headers, exc_info=None):
+                result["headers"] = dict(headers)
+            environ = {"test.content_type": content_type}
+            if accept_encoding is not None:
+                environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+            middleware = CompressionMiddleware(app, level=level)
+            result["body"] = list(middleware(environ, start_response))
+            return result
+
+        raw = b"first chunk " * 30 + b"second chunk " * 30
+
+        result = call("gzip")
+        self.assertEqual("gzip", result["headers"]["Content-Encoding"])
+        self.assertEqual("Accept-Encoding", result["headers"]["Vary"])
+        body = b"".join(result["body"])
+        self.assertEqual(raw, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        self.assertEqual(1, len(closed))
+
+        # compression levels are configurable
+        fast = b"".join(call("gzip", level=1)["body"])
+        self.assertEqual(raw, zlib.decompress(fast, 16 + zlib.MAX_WBITS))
+        self.assertRaises(SijaxError, CompressionMiddleware, app, level=0)
+        self.assertRaises(SijaxError, Compressor, "gzip", 0)
+
+        # No Accept-Encoding, or a content type which is not compressible
+        for result in (call(None), call("gzip", "image/png")):
+            self.assertFalse("Content-Encoding" in result["headers"])
+            self.assertEqual(raw, b"".join(result["body"]))
+        # the uncompressed app iterator is returned as is (not closed by us)
+        self.assertEqual(3, len(closed))
+
+        # compressible responses vary by Accept-Encoding, even when
+        # they're not compressed (caches mustn't serve them to everyone)
+        self.assertEqual("Accept-Encoding", call(None)["headers"]["Vary"])
+        self.assertFalse("Vary" in call("gzip", "image/png")["headers"])
+
+        def app_varying(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/html"),
+                                      ("Vary", "Cookie")])
+            return [raw]
+
+        for accept_encoding in (None, "gzip"):
+            headers = []
+            environ = {}
+            if accept_encoding is not None:
+                environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+            list(CompressionMiddleware(app_varying)(
+                environ, lambda status, h, exc_info=None: headers.extend(h)))
+            self.assertEqual([("Vary", "Cookie, Accept-Encoding")],
+                             [h for h in headers if h[0] == "Vary"])
+
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+@unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+class SijaxMemoryTestCase(unittest.TestCase):
+    """Tests the memory (peak bytes and allocated blocks, measured using
+    tracemalloc) that representative requests take, against budgets."""
+
+    #: scenario => (peak bytes, allocated blocks)
+    BUDGETS = {
+        "small": (16 * 1024, 100),
+        # 1MB of html - the html string, its JSON and the response
+        "large_html": (3500 * 1000, 100),
+        "many_commands": (1300 * 1000, 400),
+        # flushed commands are let go of, so the flush count doesn't matter
+        "streaming": (48 * 1024, 300),
+        "comet": (48 * 1024, 300),
+        # the form values are not copied
+        "upload": (32 * 1024, 100),
+    }
+
+    def setUp(self):
+        from sijax.plugin.comet import register_comet_callback
+
+        def small(obj_response):
+            obj_response.alert("Hello")
+
+        def large_html(obj_response, size):
+            obj_response.html("#content", "x" * size)
+
+        def many_commands(obj_response, count):
+            for idx in range(count):
+                obj_response.html("#item-%d" % idx, "value")
+
+        def streaming(obj_response, count):
+            for _ in range(count):
+                obj_response.html("#progress", "x" * 1000)
+                yield obj_response
+
+        def upload(obj_response, form_values):
+            obj_response.alert(form_values["field_0"])
+
+        inst = Sijax()
+        inst.register_callback("small", small)
+        inst.register_callback("large_html", large_html)
+        inst.register_callback("many_commands", many_commands)
+        inst.register_callback("streaming", streaming,
+                               response_class=StreamingIframeResponse)
+        register_comet_callback(inst, "comet", streaming)
+        register_upload_callback(inst, "form", upload)
+        self.inst = inst
+
+    def _measure(self, function_name, args, data=None):
+        from sijax.bench import measure_memory
+        from sijax.helper import json
+
+        cls = self.inst.__class__
+        request = {cls.PARAM_REQUEST: function_name,
+                   cls.PARAM_ARGS: json.dumps(args)}
+        request.update(data or {})
+
+        def process():
+            self.inst.set_data(request)
+            response = self.inst.process_request()
+            if isinstance(response, string_types):
+                return response
+            for _ in response:
+                pass
+
+        # Warm up caches, so that only what every request needs is counted
+        process()
+        return measure_memory(process)
+
+    def assertWithinBudget(self, scenario, usage):
+        peak_bytes, allocated_blocks = self.__class__.BUDGETS[scenario]
+        self.assertTrue(usage["peak_bytes"] <= peak_bytes,
+                        "%s: peak of %d bytes, over the budget of %d" % (
+                            scenario, usage["peak_bytes"], peak_bytes))
+        self.assertTrue(usage["allocated_blocks"] <= allocated_blocks,
+                        "%s: %d blocks allocated, over the budget of %d" % (
+                            scenario, usage["allocated_blocks"], allocated_blocks))
+
+    def test_regular_responses_stay_within_budget(self):
+        self.assertWithinBudget("small", self._measure("small", []))
+        self.assertWithinBudget("large_html",
+                                self._measure("large_html", [1000 * 1000]))
+        self.assertWithinBudget("many_commands",
+                                self._measure("many_commands", [1000]))
+
+    def test_streaming_responses_stay_within_budget(self):
+        few = self._measure("streaming", [10])
+        many = self._measure("streaming", [1000])
+        self.assertWithinBudget("streaming", few)
+        self.assertWithinBudget("streaming", many)
+        self.assertTrue(many["peak_bytes"] < few["peak_bytes"] * 2)
+
+        fetch = {Sijax.PARAM_TRANSPORT: Sijax.TRANSPORT_FETCH}
+        self.assertWithinBudget("streaming",
+                                self._measure("streaming", [1000], fetch))
+        self.assertWithinBudget("comet", self._measure("comet", [100]))
+
+    def test_upload_responses_stay_within_budget(self):
+        data = dict(("field_%d" % idx, "v" * 100) for idx in range(1000))
+        usage = self._measure("form_upload", ["form"], data)
+        self.assertWithinBudget("upload", usage)
+
+    def test_streamed_files_are_not_held_in_memory(self):
+        from sijax.bench import measure_memory
+        from sijax.plugin.upload import spooled_file_factory
+
+        size = 8 * 1024 * 1024
+        files = {}
+
+        def stream(obj_response, form_values):
+            upload = obj_response.stream_file(files["file"], files["destination"])
+            for _ in upload:
+                yield obj_response
+            obj_response.alert(upload.hexdigests["sha256"])
+
+        register_upload_callback(self.inst, "stream", stream)
+        cls = self.inst.__class__
+
+        def process():
+            files["file"].seek(0)
+            self.inst.set_data({cls.PARAM_REQUEST: "stream_upload",
+                                cls.PARAM_ARGS: '["stream"]'})
+            for _ in self.inst.process_request():
+                pass
+
+        with temporary_dir() as path:
+            # spooled to disk, the way Werkzeug would store the upload
+            factory = spooled_file_factory()
+            files["file"] = factory(size, "application/octet-stream",
+                                    "file.bin", size)
+            chunk = os.urandom(64 * 1024)
+            for _ in range(size // len(chunk)):
+                files["file"].write(chunk)
+            files["destination"] = os.path.join(path, "file.bin")
+
+            process()
+            usage = measure_memory(process)
+            files["file"].close()
+            self.assertEqual(size, os.path.getsize(files["destination"]))
+
+        # a few chunks at most, nowhere near the size of the file
+        self.assertTrue(usage["peak_bytes"] < size // 16,
+                        "peak of %d bytes" % usage["peak_bytes"])
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(SijaxMainTestCase))
     suite.addTest(unittest.makeSuite(SijaxStreamingTestCase))
     suite.addTest(unittest.makeSuite(SijaxCometTestCase))
     suite.addTest(unittest.makeSuite(SijaxUploadTestCase))
+    suite.addTest(unittest.makeSuite(SijaxCompressionTestCase))
+    suite.addTest(unittest.makeSuite(SijaxMemoryTestCase))
 
     return suite
 